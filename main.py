@@ -11,6 +11,14 @@ Web Server example.
 # from web_server.step02_static_file import main; main()
 # Run Step 03: Routing
 # from web_server.step03_routing import main; main()
+# Run Step 03: Routing with asyncio server
+# from web_server.step03_routing import main; main(mode='async')
+# Run Step 03: Routing performance test
+# from web_server.step03_routing.perf_test import main; main()
+# Run Step 03: Load test for each concurrency mode
+# from web_server.step03_routing.load_test import main; main()
+# Run tests of Step 03
+# from web_server.step03_routing.test_server import main; main()
 
 
 """
@@ -30,6 +38,8 @@ Template Engine example.
 # from template_engine.step05_if_block.test_template import main; main()
 # Run Step 05: Performance Test
 # from template_engine.step06_perf_test.perf_test import main; main()
+# Run Step 05: Benchmark suite, results as JSON to compare with a previous run
+# from template_engine.step06_perf_test.benchmark import main; main(['--output', 'benchmark.json'])
 
 
 """
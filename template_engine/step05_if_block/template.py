@@ -1,12 +1,186 @@
+import ast
+import builtins
+import collections
+import functools
+import hashlib
+import keyword
+import marshal
+import os
 import re
+import string
+import sys
+import tempfile
+import threading
+import time
+import types
 import typing
 
 
 OUTPUT_VAR = "_output_"
+APPEND_VAR = "_append_"
+ESCAPE_FUNC = "_escape_"
+ATTR_FUNC = "_attr_"
+STREAM_VAR = "_stream_"
+GLOBALS_VAR = "_globals_"
+RENDER_FUNC = "_render_"
 INDENT = 1
 UNINDENT = -1
 INDENT_SPACES = 2
 INDEX_VAR = "index"
+LOOP_VAR = "loop"
+# Bump when generated code changes, so that code cached on disk by older versions is not used.
+CODE_VERSION = 7
+BUFFER_SIZE = 8192
+
+
+class Markup(str):
+    """
+    Text which is safe to output as html, so it is never escaped again.
+    Str methods return Markup, with str arguments escaped, so that filters keep text safe.
+    """
+    __slots__ = ()
+
+    def __html__(self):
+        return self
+
+    def __add__(self, other):
+        return Markup(str.__add__(self, escape_html(other)))
+
+    def __radd__(self, other):
+        return Markup(str.__add__(escape_html(other), self))
+
+    def __repr__(self):
+        return f"Markup({str.__repr__(self)})"
+
+    def __mod__(self, args):
+        if isinstance(args, tuple):
+            args = tuple(map(_EscapedArgument, args))
+        elif isinstance(args, dict):
+            args = {key: _EscapedArgument(value) for key, value in args.items()}
+        else:
+            args = _EscapedArgument(args)
+        return Markup(str.__mod__(self, args))
+
+    def join(self, iterable):
+        return Markup(str.join(self, map(escape_html, iterable)))
+
+    def format(self, *args, **kwargs):
+        return Markup(_MARKUP_FORMATTER.vformat(self, args, kwargs))
+
+    def format_map(self, mapping):
+        return Markup(_MARKUP_FORMATTER.vformat(self, (), mapping))
+
+
+def _markup_method(method: typing.Callable, returns_sequence: bool) -> typing.Callable:
+    """Wrap str method to escape str arguments and return Markup."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        args = [escape_html(arg) if isinstance(arg, str) else arg for arg in args]
+        kwargs = {key: escape_html(arg) if isinstance(arg, str) else arg for key, arg in kwargs.items()}
+        result = method(self, *args, **kwargs)
+        if returns_sequence:
+            return result.__class__(map(Markup, result))
+        return Markup(result)
+    return wrapper
+
+
+for _name in ('__getitem__', '__mul__', '__rmul__', 'capitalize', 'casefold', 'center', 'expandtabs',
+              'ljust', 'lower', 'lstrip', 'removeprefix', 'removesuffix', 'replace', 'rjust', 'rstrip',
+              'strip', 'swapcase', 'title', 'translate', 'upper', 'zfill'):
+    setattr(Markup, _name, _markup_method(getattr(str, _name), False))
+for _name in ('partition', 'rpartition', 'rsplit', 'split', 'splitlines'):
+    setattr(Markup, _name, _markup_method(getattr(str, _name), True))
+
+
+class _EscapedArgument:
+    """Argument of Markup % formatting, which is escaped when converted to str."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return escape_html(self.value)
+
+    def __repr__(self):
+        return escape_html(repr(self.value))
+
+    def __int__(self):
+        return int(self.value)
+
+    def __float__(self):
+        return float(self.value)
+
+    def __index__(self):
+        return self.value.__index__()
+
+
+class _MarkupFormatter(string.Formatter):
+    """Format fields of Markup.format(), fields are escaped after formatting unless they are Markup."""
+    def format_field(self, value, format_spec):
+        html = getattr(value, '__html__', None)
+        if html is not None:
+            return format(str(html()), format_spec)
+        return escape_html(format(value, format_spec))
+
+
+_MARKUP_FORMATTER = _MarkupFormatter()
+
+
+def escape_html(value) -> str:
+    """
+    Convert value to str with html special characters escaped, unless it is Markup (has __html__).
+    Most values have nothing to escape, which is checked by fast scans before any replacement.
+    """
+    if value.__class__ is not str:
+        if value.__class__ is int:
+            return str(value)
+        html = getattr(value, '__html__', None)
+        if html is not None:
+            return html()
+        value = str(value)
+    if '&' in value or '<' in value or '>' in value or '"' in value or "'" in value:
+        return (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                .replace('"', '&#34;').replace("'", '&#39;'))
+    return value
+
+
+DICT_ATTRIBUTES = frozenset(dir(dict))
+
+
+def getattr_or_item(obj, name: str, _getattr=getattr, _dict=dict, _dict_attributes=DICT_ATTRIBUTES):
+    """
+    Resolve obj.name in template, which is attribute of obj, or item of obj if it has no such attribute,
+    so that dicts and objects are used the same way. Builtins are bound as defaults to be local lookups.
+    """
+    if obj.__class__ is not _dict:
+        try:
+            return _getattr(obj, name)
+        except AttributeError:
+            pass
+        try:
+            return obj[name]
+        except (TypeError, LookupError):
+            pass
+    elif name in _dict_attributes:
+        return _getattr(obj, name)
+    else:
+        try:
+            return obj[name]
+        except KeyError:
+            pass
+    raise AttributeError(f"'{type(obj).__name__}' object has no attribute or item '{name}'")
+
+
+def escape(value) -> Markup:
+    return Markup(escape_html(value))
+
+
+def select_autoescape(extensions: typing.Iterable[str] = ('html', 'htm', 'xml'),
+                      default: bool = False) -> typing.Callable[[typing.Optional[str]], bool]:
+    """Autoescape templates whose name has one of extensions, default is for templates created from text."""
+    suffixes = tuple(f'.{x.lstrip(".").lower()}' for x in extensions)
+    return lambda name: name.lower().endswith(suffixes) if name else default
 
 
 class LoopVar:
@@ -17,26 +191,94 @@ class LoopVar:
 
 
 class CodeBuilder:
-    """Manage code generating context."""
-    def __init__(self):
+    """
+    Manage code generating context.
+    Consecutive text and expressions are written to output by a single f-string,
+    which formats expressions without calling str() and needs one append per run.
+    """
+    def __init__(self, autoescape: bool = False):
         self.codes = []
         self._block_stack = []
+        self._parts = []
+        self._quote = None
+        self._temp_count = 0
+        self._local_names = {}
+        self._autoescape = autoescape
 
     def add_code(self, line: str):
+        self.flush_output()
         self.codes.append(line)
 
     def add_expr(self, expr: str):
-        code = f"{OUTPUT_VAR}.append(str({expr}))"
-        self.codes.append(code)
+        self.reference(expr)
+        if self._autoescape:
+            expr = f"{ESCAPE_FUNC}({expr})"
+        if any(x in expr for x in "\\#\n") or ("'" in expr and '"' in expr):
+            # Not allowed inside an f-string replacement field, so evaluate it before
+            self.flush_output()
+            temp = f"_t{self._temp_count}_"
+            self._temp_count += 1
+            self.codes.append(f"{temp} = {expr}")
+            expr = temp
+        elif "'" in expr or '"' in expr:
+            # f-string is quoted by the quote which expressions in it do not use
+            quote = '"' if "'" in expr else "'"
+            if self._quote != quote:
+                if self._quote:
+                    self.flush_output()
+                self._quote = quote
+        self._parts.append((True, expr))
 
     def add_text(self, text: str):
-        code = f"{OUTPUT_VAR}.append({repr(text)})"
-        self.codes.append(code)
+        self._parts.append((False, text))
+
+    def flush_output(self):
+        """Write text and expressions added since last code line to output."""
+        if self._parts:
+            quote = self._quote or "'"
+            parts = []
+            for is_expr, value in self._parts:
+                if is_expr:
+                    parts.append("{(" + value + ")}")
+                else:
+                    value = value.encode('unicode_escape').decode('ascii').replace(quote, '\\' + quote)
+                    parts.append(value.replace('{', '{{').replace('}', '}}'))
+            self.codes.append(f"{APPEND_VAR}(f{quote}{''.join(parts)}{quote})")
+            self._parts.clear()
+            self._quote = None
+
+    def reference(self, expr: str):
+        """Note names used by expr, index and loop variable are only created by loops which refer to them."""
+        if re.search(rf'\b({LOOP_VAR}|{INDEX_VAR})\b', expr):
+            for block in reversed(self._block_stack):
+                if isinstance(block, For):
+                    block.loop_used = True
+                    break
+
+    def declare_local(self, name: str):
+        """Name is assigned by generated code, so python treats it as local in the whole render function."""
+        self._local_names[name] = None
+
+    def bind_locals(self, index: int):
+        """
+        Insert code at index to initialize locals from context, so that a context variable
+        shadowed by a loop variable can still be used before or inside the loop.
+        """
+        if self._local_names:
+            lines = [f"{GLOBALS_VAR} = globals()"]
+            lines.extend(f"if '{x}' in {GLOBALS_VAR}: {x} = {GLOBALS_VAR}['{x}']" for x in self._local_names)
+            self.codes[index:index] = lines
+
+    def replace_code(self, index: int, line: typing.Optional[str]):
+        """Replace code line generated before, or remove it if line is None."""
+        self.codes[index] = line
 
     def indent(self):
+        self.flush_output()
         self.codes.append(INDENT)
 
     def unindent(self):
+        self.flush_output()
         self.codes.append(UNINDENT)
 
     def code_lines(self):
@@ -50,6 +292,7 @@ class CodeBuilder:
                 indent += code
 
     def source(self) -> str:
+        self.flush_output()
         return "\n".join(self.code_lines())
 
     def check_code(self):
@@ -57,6 +300,11 @@ class CodeBuilder:
             last_control = self._block_stack.pop(-1)
             raise SyntaxError(f"{last_control.name} has no end tag")
 
+    @property
+    def open_block(self) -> typing.Optional['Token']:
+        """Innermost block not ended yet."""
+        return self._block_stack[-1] if self._block_stack else None
+
     def push_control(self, ctrl):
         self._block_stack.append(ctrl)
 
@@ -71,8 +319,31 @@ class CodeBuilder:
         return top_block
 
 
+def line_column(text: str, position: int) -> (int, int):
+    """Return line and column (both 1-based) of position in text."""
+    return text.count('\n', 0, position) + 1, position - text.rfind('\n', 0, position)
+
+
+class TemplateSyntaxError(SyntaxError):
+    """Syntax error in template text, line and column are where the token in error starts."""
+    def __init__(self, message: str, text: str = None, position: int = None, name: str = None):
+        self.line = self.column = None
+        self.name = name
+        if text is not None and position is not None:
+            self.line, self.column = line_column(text, position)
+            where = f"{name}, " if name else ""
+            message = f"{message} ({where}line {self.line}, column {self.column})"
+        super().__init__(message)
+
+
 class Token:
-    """Token in template code"""
+    """
+    Token in template code, position is index in template text where it starts.
+    Tokens of a template included or extended by another have source, its (name, text).
+    """
+    position = None
+    source = None
+
     def parse(self, content: str):
         raise NotImplementedError()
 
@@ -98,18 +369,15 @@ class Text(Token):
 
 
 class Expr(Token):
-    def __init__(self, varname: str = None):
+    def __init__(self, varname: str = None, filters: typing.List[str] = None):
         self._varname = varname
-        self._filters = []
+        self._filters = filters or []
 
     def parse(self, content: str):
         self._varname, self._filters = parse_expr(content)
 
     def generate_code(self, builder: CodeBuilder):
-        result = self._varname
-        for filter_name in self._filters[::-1]:
-            result = f"{filter_name}({result})"
-        builder.add_expr(result)
+        builder.add_expr(compile_pipeline(self._varname, self._filters))
 
     def __repr__(self):
         if self._filters:
@@ -137,21 +405,42 @@ class For(Token):
     def __init__(self, var_name: str = None, target: str = None):
         self._varname = var_name
         self._target = target
+        self.loop_used = False
+        self._code_index = None
+        self._compiled_target = None
 
     def parse(self, content: str):
-        m = re.match(r'for\s+(\w+)\s+in\s+(\w+)', content)
+        m = re.match(r'for\s+(\w+(?:\s*,\s*\w+)*)\s+in\s+(\S.*)', content, re.DOTALL)
         if not m:
             raise SyntaxError(f"Invalid for block: {content}")
-        self._varname, self._target = m.group(1), m.group(2)
+        names = re.split(r'\s*,\s*', m.group(1))
+        for name in names:
+            check_name(name)
+        self._varname, self._target = ', '.join(names), m.group(2).strip()
 
     def __repr__(self):
         return f"For({self._varname} in {self._target})"
 
     def generate_code(self, builder: CodeBuilder):
-        builder.add_code(f"for {INDEX_VAR}, {self._varname} in enumerate({self._target}):")
+        self._compiled_target = compile_pipeline(*parse_expr(self._target))
+        builder.reference(self._compiled_target)
+        for name in self._varname.split(', '):
+            builder.declare_local(name)
+        names = f"({self._varname})" if ',' in self._varname else self._varname
+        builder.add_code(f"for {INDEX_VAR}, {names} in enumerate({self._compiled_target}):")
+        self._code_index = len(builder.codes) - 1
         builder.indent()
         builder.push_control(self)
-        builder.add_code(f"loop = LoopVar({INDEX_VAR})")
+        builder.add_code(f"{LOOP_VAR} = LoopVar({INDEX_VAR})")
+
+    def end_code(self, builder: CodeBuilder):
+        """Loop body is generated, drop index and loop variable if body does not refer to them."""
+        if self.loop_used:
+            builder.declare_local(INDEX_VAR)
+            builder.declare_local(LOOP_VAR)
+        else:
+            builder.replace_code(self._code_index, f"for {self._varname} in {self._compiled_target}:")
+            builder.replace_code(self._code_index + 2, None)
 
 
 class If(Token):
@@ -161,16 +450,18 @@ class If(Token):
         self._repr = repr_
 
     def parse(self, content: str):
-        m = re.match(r'if\s+(\w+)', content)
+        m = re.match(r'if\s+(\S.*)', content, re.DOTALL)
         if not m:
             raise SyntaxError(f"Invalid if block: {content}")
-        self._repr = m.group(1)
+        self._repr = m.group(1).strip()
 
     def __repr__(self):
         return f"If({self._repr})"
 
     def generate_code(self, builder: CodeBuilder):
-        builder.add_code(f"if {self._repr}:")
+        condition = compile_pipeline(*parse_expr(self._repr))
+        builder.reference(condition)
+        builder.add_code(f"if {condition}:")
         builder.indent()
         builder.push_control(self)
 
@@ -180,17 +471,19 @@ class ElseIf(Token):
         self._repr = repr_
 
     def parse(self, content: str):
-        m = re.match(r'elif\s+(\w+)', content)
+        m = re.match(r'elif\s+(\S.*)', content, re.DOTALL)
         if not m:
             raise SyntaxError(f"Invalid elif block: {content}")
-        self._repr = m.group(1)
+        self._repr = m.group(1).strip()
 
     def __repr__(self):
         return f"ElseIf({self._repr})"
 
     def generate_code(self, builder: CodeBuilder):
+        condition = compile_pipeline(*parse_expr(self._repr))
+        builder.reference(condition)
         builder.unindent()
-        builder.add_code(f"elif {self._repr}:")
+        builder.add_code(f"elif {condition}:")
         builder.indent()
 
 
@@ -215,7 +508,9 @@ class EndFor(Token):
         return 'EndFor'
 
     def generate_code(self, builder: CodeBuilder):
-        builder.end_block(For)
+        # Give streaming render a chance to send output of each iteration
+        builder.add_code(f"if {STREAM_VAR}: yield")
+        builder.end_block(For).end_code(builder)
 
 
 class EndIf(Token):
@@ -229,121 +524,727 @@ class EndIf(Token):
         builder.end_block(If)
 
 
-def extract_last_filter(text: str) -> (str, str):
-    """
-    Extract last filter from expression like 'var | filter'.
-    return (var, None) when no more filters found.
-    """
-    m = re.search(r'(\|\s*[A-Za-z0-9_]+\s*)$', text)
-    if m:
-        suffix = m.group(1)
-        filter_ = suffix[1:].strip()
-        var_name = text[:-len(suffix)].strip()
-        return var_name, filter_
-    return text, None
+def parse_template_name(keyword: str, content: str) -> str:
+    m = re.match(rf'{keyword}\s+(\'[^\']+\'|"[^"]+")$', content)
+    if not m:
+        raise SyntaxError(f"Invalid {keyword} tag: {content}")
+    return m.group(1)[1:-1]
+
+
+class Extends(Token):
+    """Template is a child of template_name: its blocks replace blocks of parent, other content is ignored."""
+    def __init__(self, template_name: str = None):
+        self.template_name = template_name
+
+    def parse(self, content: str):
+        self.template_name = parse_template_name('extends', content)
+
+    def __repr__(self):
+        return f"Extends({self.template_name})"
+
+
+class Include(Token):
+    """Replaced by tokens of template_name at compile time, rendered with the same context."""
+    def __init__(self, template_name: str = None):
+        self.template_name = template_name
+
+    def parse(self, content: str):
+        self.template_name = parse_template_name('include', content)
+
+    def __repr__(self):
+        return f"Include({self.template_name})"
+
+
+class Block(Token):
+    name = 'block'
+
+    def __init__(self, block_name: str = None):
+        self.block_name = block_name
+
+    def parse(self, content: str):
+        m = re.match(r'block\s+(\w+)$', content)
+        if not m:
+            raise SyntaxError(f"Invalid block tag: {content}")
+        self.block_name = m.group(1)
+
+    def __repr__(self):
+        return f"Block({self.block_name})"
+
+
+class EndBlock(Token):
+    def __init__(self, block_name: str = None):
+        self.block_name = block_name
+
+    def parse(self, content: str):
+        m = re.match(r'endblock(?:\s+(\w+))?$', content)
+        if not m:
+            raise SyntaxError(f"Invalid endblock tag: {content}")
+        self.block_name = m.group(1)
+
+    def __repr__(self):
+        return f"EndBlock({self.block_name})" if self.block_name else "EndBlock"
+
+
+def _skip_string(text: str, pos: int) -> int:
+    """Return index after string literal starting with quote at pos, or -1 if it is not terminated."""
+    quote = text[pos]
+    pos += 1
+    while True:
+        end = text.find(quote, pos)
+        if end < 0:
+            return -1
+        backslashes = 0
+        while text[end - 1 - backslashes] == '\\':
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end + 1
+        pos = end + 1
+
+
+def _split_filters(text: str) -> typing.List[str]:
+    """Split text at '|' which are not inside string literals or brackets."""
+    parts, start, depth, pos = [], 0, 0, 0
+    length = len(text)
+    while pos < length:
+        char = text[pos]
+        if char in '\'"':
+            pos = _skip_string(text, pos)
+            if pos < 0:
+                raise SyntaxError(f'Unterminated string in expression: {text}')
+            continue
+        if char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            parts.append(text[start:pos])
+            start = pos + 1
+        pos += 1
+    if depth:
+        raise SyntaxError(f'Unbalanced brackets in expression: {text}')
+    parts.append(text[start:])
+    return parts
 
 
 def parse_expr(text: str) -> (str, typing.List[str]):
     """
-    Parse expression to variable name and filters.
+    Parse expression to variable name and filters, in one pass.
     for example, "name | upper | strip" will be converted to 'name', [ 'upper', 'strip']
+    Filter may have arguments, "name | truncate(10)" is converted to 'name', ['truncate(10)'],
+    '|' in string literals or brackets does not separate filters.
     """
-    var_name, filters = text, []
-    while True:
-        var_name, filter_ = extract_last_filter(var_name)
-        if filter_:
-            filters.insert(0, filter_)
-        else:
-            break
+    if '|' not in text:
+        return text.strip(), []
+    if any(x in text for x in '\'"([{'):
+        var_name, *filters = _split_filters(text)
+    else:
+        var_name, *filters = text.split('|')
+    var_name = var_name.strip()
+    if not var_name:
+        raise SyntaxError(f'Missing expression before filter: {text}')
+    for i, filter_ in enumerate(filters):
+        name, paren, args = filter_.partition('(')
+        name = name.strip()
+        args = args.rstrip()
+        if not name.isidentifier() or (paren and not args.endswith(')')):
+            raise SyntaxError(f'Invalid filter: {filter_.strip()}')
+        filters[i] = f'{name}({args[:-1].strip()})' if paren else name
     return var_name, filters
 
 
+class ExprCompiler(ast.NodeTransformer):
+    """
+    Check that expression only uses syntax allowed in templates, and rewrite it to python:
+    obj.name is resolved by getattr_or_item(), value | name(args) calls filter name(value, args).
+    """
+    ALLOWED_NODES = (ast.Expression, ast.Name, ast.Constant, ast.Attribute, ast.Subscript, ast.Slice,
+                     ast.List, ast.Tuple, ast.Dict, ast.Set, ast.Compare, ast.BoolOp, ast.UnaryOp, ast.BinOp,
+                     ast.IfExp, ast.Call, ast.keyword, ast.Starred,
+                     ast.expr_context, ast.operator, ast.cmpop, ast.boolop, ast.unaryop)
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        if not isinstance(node, self.ALLOWED_NODES):
+            raise SyntaxError(f'{type(node).__name__} is not allowed in expression')
+        return super().generic_visit(node)
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        check_name(node.id)
+        return node
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        check_name(node.attr)
+        return ast.Call(ast.Name(ATTR_FUNC, ast.Load()), [self.visit(node.value), ast.Constant(node.attr)], [])
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        if not isinstance(node.op, ast.BitOr):
+            return self.generic_visit(node)
+        filter_ = node.right
+        if isinstance(filter_, ast.Name):
+            return ast.Call(self.visit(filter_), [self.visit(node.left)], [])
+        if isinstance(filter_, ast.Call) and isinstance(filter_.func, ast.Name):
+            filter_ = self.visit(filter_)
+            filter_.args.insert(0, self.visit(node.left))
+            return filter_
+        raise SyntaxError(f'Invalid filter: {ast.unparse(filter_)}')
+
+
+def check_name(name: str):
+    """Names like _output_ are used by generated code, templates can not refer to them."""
+    if name.startswith('_') and name.endswith('_'):
+        raise SyntaxError(f'Name is reserved: {name}')
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_expr(text: str) -> str:
+    """
+    Compile template expression to python expression.
+    Plain and dotted names are most common, which are compiled without parsing,
+    others are parsed once as the same expressions are repeated in templates.
+    """
+    text = text.strip()
+    if text.isidentifier() and not keyword.iskeyword(text) or text in ('True', 'False', 'None'):
+        check_name(text)
+        return text
+    names = text.split('.')
+    if all(x.isidentifier() and not keyword.iskeyword(x) for x in names):
+        result = names[0]
+        for name in names:
+            check_name(name)
+        for name in names[1:]:
+            result = f"{ATTR_FUNC}({result}, '{name}')"
+        return result
+    try:
+        tree = ast.parse(text, mode='eval')
+    except SyntaxError:
+        raise SyntaxError(f'Invalid expression: {text}') from None
+    return ast.unparse(ExprCompiler().visit(tree))
+
+
+def compile_pipeline(expr: str, filters: typing.List[str]) -> str:
+    """Compile expression and filters parsed by parse_expr(), filters are applied left to right
+       as the pipe reads: 'a | f | g' is g(f(a)). Before CODE_VERSION 7, it was f(g(a))."""
+    result = compile_expr(expr)
+    for filter_ in filters:
+        name, paren, _ = filter_.partition('(')
+        if paren:
+            # compiled as "name(args)", insert value as first argument
+            call = compile_expr(filter_)
+            result = f"{name}({result}, {call[len(name) + 1:]}"
+        else:
+            check_name(name)
+            result = f"{name}({result})"
+    return result
+
+
+TAG_ENDS = {'{': '}}', '%': '%}', '#': '#}'}
+CONTROL_KEYWORD = re.compile(r'\w+')
+CONTROL_TOKENS = {
+    'for': For,
+    'endfor': EndFor,
+    'if': If,
+    'elif': ElseIf,
+    'else': Else,
+    'endif': EndIf,
+    'extends': Extends,
+    'include': Include,
+    'block': Block,
+    'endblock': EndBlock,
+}
+
+
 def create_control_token(text: str) -> Token:
     """Create control token() from source code fragment."""
     text = text.strip()
-    m = re.match(r'^(\w+)', text)
-    if not m:
+    m = CONTROL_KEYWORD.match(text)
+    token_type = CONTROL_TOKENS.get(m.group()) if m else None
+    if token_type is None:
         raise SyntaxError(f'Unknown control token: {text}')
-    keywords = m.group(1)
-    token_types = {
-        'for': For,
-        'endfor': EndFor,
-        'if': If,
-        'elif': ElseIf,
-        'else': Else,
-        'endif': EndIf,
-    }
-    if keywords not in token_types:
-        raise SyntaxError(f'Unknown control token: {text}')
-    return token_types[keywords]()
-
-
-def create_token(text: str) -> Token:
-    """Create token from source code fragment."""
-    if text.startswith("{{") and text.endswith("}}"):
-        token, content = Expr(), text[2:-2].strip()
-    elif text.startswith("{%") and text.endswith("%}"):
-        content = text[2:-2].strip()
-        token = create_control_token(content)
-    elif text.startswith("{#") and text.endswith("#}"):
-        token, content = Comment(), text[2:-2].strip()
-    else:
-        token, content = Text(), text
-    token.parse(content)
-    return token
+    return token_type()
 
 
-def tokenize(text: str) -> typing.List[Token]:
-    """Parse template text to tokens."""
-    segments = re.split(r'({{.*?}}|{#.*?#}|{%.*?%})', text)
-    segments = [x for x in segments if x]
-    return [create_token(x) for x in segments]
+def _find_tag_end(text: str, pos: int, end_mark: str) -> int:
+    """Return index of end_mark closing tag from pos, skipping string literals, or -1 if not found."""
+    while True:
+        end = text.find(end_mark, pos)
+        if end < 0:
+            return -1
+        single, double = text.find("'", pos, end), text.find('"', pos, end)
+        if single < 0 and double < 0:
+            return end
+        pos = _skip_string(text, double if single < 0 or 0 <= double < single else single)
+        if pos < 0:
+            return -1
+
+
+def tokenize(text: str, name: str = None) -> typing.List[Token]:
+    """Parse template text to tokens in a single pass, each token has its position in text."""
+    tokens = []
+    append = tokens.append
+    find = text.find
+    pos, length = 0, len(text)
+    start = 0
+    try:
+        while pos < length:
+            start = find('{', pos)
+            while start >= 0 and text[start + 1:start + 2] not in TAG_ENDS:
+                start = find('{', start + 1)
+            if start < 0:
+                start = length
+            if start > pos:
+                token = Text(text[pos:start])
+                token.position = pos
+                append(token)
+                if start == length:
+                    break
+            kind = text[start + 1]
+            end_mark = TAG_ENDS[kind]
+            end = find(end_mark, start + 2)
+            if end >= 0 and kind != '#' and (find("'", start + 2, end) >= 0 or find('"', start + 2, end) >= 0):
+                end = _find_tag_end(text, start + 2, end_mark)
+            if end < 0:
+                raise SyntaxError(f'Unclosed tag, expected {end_mark}')
+            content = text[start + 2:end].strip()
+            if kind == '{':
+                token = Expr()
+            elif kind == '%':
+                token = create_control_token(content)
+            else:
+                token = Comment()
+            token.position = start
+            token.parse(content)
+            append(token)
+            pos = end + 2
+    except SyntaxError as e:
+        raise TemplateSyntaxError(e.msg, text, start, name) from None
+    return tokens
+
+
+def _syntax_error(message: str, token: Token, text: str, name: str) -> TemplateSyntaxError:
+    """Error at token, which is in text of template name unless it comes from another template."""
+    if token.source:
+        name, text = token.source
+    return TemplateSyntaxError(message, text, token.position, name)
+
+
+class Resolver:
+    """
+    Resolve extends, block and include tags of a template at compile time,
+    so that it is compiled to a single function with content of all its templates inlined.
+    load(name) returns text of a template, it is only called for templates which are referred to.
+    """
+    def __init__(self, text: str, name: str = None, load: typing.Callable[[str], str] = None):
+        self._text = text
+        self._name = name
+        self._load = load
+
+    def resolve(self) -> typing.List[Token]:
+        tokens = tokenize(self._text, self._name)
+        if not any(isinstance(x, (Extends, Include, Block, EndBlock)) for x in tokens):
+            return tokens
+        return self._resolve(tokens, {}, (self._name,))
+
+    def _error(self, message: str, token: Token) -> TemplateSyntaxError:
+        return _syntax_error(message, token, self._text, self._name)
+
+    def _load_tokens(self, token: Token, loading: tuple) -> typing.List[Token]:
+        name = token.template_name
+        if self._load is None:
+            raise self._error(f"Can not load {name}, no template loader", token)
+        if name in loading:
+            raise self._error(f"Recursive extends or include of {name}", token)
+        text = self._load(name)
+        tokens = tokenize(text, name)
+        for x in tokens:
+            x.source = (name, text)
+        return tokens
+
+    def _resolve(self, tokens: typing.List[Token], overrides: dict, loading: tuple) -> typing.List[Token]:
+        extends = [x for x in tokens if isinstance(x, Extends)]
+        if len(extends) > 1:
+            raise self._error("Template can only extend one template", extends[1])
+        if extends:
+            # Blocks of child override blocks of the same name in all its ancestors
+            blocks = self._collect_blocks(tokens)
+            blocks.update(overrides)
+            parent = extends[0]
+            return self._resolve(self._load_tokens(parent, loading), blocks, loading + (parent.template_name,))
+        output = []
+        self._flatten(tokens, overrides, loading, output, ())
+        return output
+
+    def _match_blocks(self, tokens: typing.List[Token]) -> dict:
+        """Return index of endblock of each block, by index of block."""
+        ends, stack, names = {}, [], set()
+        for i, token in enumerate(tokens):
+            if isinstance(token, Block):
+                if token.block_name in names:
+                    raise self._error(f"Block {token.block_name} is defined twice", token)
+                names.add(token.block_name)
+                stack.append(i)
+            elif isinstance(token, EndBlock):
+                if not stack:
+                    raise self._error("End of block block does not found matching start tag", token)
+                start = stack.pop()
+                if token.block_name and token.block_name != tokens[start].block_name:
+                    raise self._error(f"Expected end of block {tokens[start].block_name}", token)
+                ends[start] = i
+        if stack:
+            raise self._error("block has no end tag", tokens[stack[-1]])
+        return ends
+
+    def _collect_blocks(self, tokens: typing.List[Token]) -> dict:
+        """Return content tokens of each block, nested blocks included."""
+        return {tokens[start].block_name: tokens[start + 1:end] for start, end in self._match_blocks(tokens).items()}
+
+    def _flatten(self, tokens: typing.List[Token], overrides: dict, loading: tuple,
+                 output: typing.List[Token], expanding: tuple):
+        ends = self._match_blocks(tokens)
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if isinstance(token, Block):
+                if token.block_name in expanding:
+                    raise self._error(f"Block {token.block_name} contains itself", token)
+                content = overrides.get(token.block_name, tokens[i + 1:ends[i]])
+                self._flatten(content, overrides, loading, output, expanding + (token.block_name,))
+                i = ends[i]
+            elif isinstance(token, Include):
+                included = self._load_tokens(token, loading)
+                output.extend(self._resolve(included, {}, loading + (token.template_name,)))
+            else:
+                output.append(token)
+            i += 1
+
+
+def parse(text: str, name: str = None, load: typing.Callable[[str], str] = None) -> typing.List[Token]:
+    """Parse template text to tokens, with extends, block and include resolved by templates load() returns."""
+    return Resolver(text, name, load).resolve()
+
+
+def build_source(tokens: typing.List[Token], text: str, name: str = None, builder: CodeBuilder = None) -> str:
+    """Generate python source of render function from tokens of template text."""
+    builder = builder or CodeBuilder()
+    builder.add_code(f"def {RENDER_FUNC}({OUTPUT_VAR}, {STREAM_VAR}):")
+    builder.indent()
+    builder.add_code(f"{APPEND_VAR} = {OUTPUT_VAR}.append")
+    locals_index = len(builder.codes)
+    for token in tokens:
+        try:
+            token.generate_code(builder)
+        except SyntaxError as e:
+            raise _syntax_error(e.msg, token, text, name) from None
+    block = builder.open_block
+    try:
+        builder.check_code()
+    except SyntaxError as e:
+        raise _syntax_error(e.msg, block, text, name) from None
+    builder.bind_locals(locals_index)
+    builder.add_code("yield")
+    builder.unindent()
+    return builder.source()
+
+
+def generate_source(text: str, builder: CodeBuilder = None, name: str = None,
+                    load: typing.Callable[[str], str] = None) -> str:
+    """Generate python source of render function of template text."""
+    return build_source(parse(text, name, load), text, name, builder)
 
 
 class Template:
     """Render template in flask-like syntax."""
-    def __init__(self, text: str, filters: dict = None):
+    def __init__(self, text: str, filters: dict = None, code=None, autoescape: bool = False):
         self._text = text
-        self._code = None
+        self._code = code
+        self._autoescape = autoescape
+        self._function_code = None
         self._global_vars = {}
         if filters:
             self._global_vars.update(filters)
 
+    @property
+    def code(self):
+        """Compiled code of template, generated on first access."""
+        self._generate_code()
+        return self._code
+
     def _generate_code(self):
-        """Generate to compiled code if not done yet."""
+        """
+        Generate to compiled code if not done yet.
+        Template is compiled to a generator function appending to output,
+        which yields at end of each loop iteration if streaming.
+        """
         if not self._code:
-            tokens = tokenize(self._text)
-            builder = CodeBuilder()
-            for token in tokens:
-                token.generate_code(builder)
-            builder.check_code()
-            self._code = compile(builder.source(), '', 'exec')
+            self._code = compile(generate_source(self._text, CodeBuilder(self._autoescape)), '', 'exec')
+        if not self._function_code:
+            namespace = {}
+            exec(self._code, namespace)
+            self._function_code = namespace[RENDER_FUNC].__code__
+
+    def _bind(self, ctx: dict) -> types.FunctionType:
+        """Create render function with context variables as its globals."""
+        self._generate_code()
+        global_vars = self._global_vars.copy()
+        if ctx:
+            global_vars.update(ctx)
+        global_vars.update({
+            'LoopVar': LoopVar,
+            ESCAPE_FUNC: escape_html,
+            ATTR_FUNC: getattr_or_item,
+            '__builtins__': builtins,
+        })
+        return types.FunctionType(self._function_code, global_vars)
 
     def render(self, ctx: dict) -> str:
         """bind context and generate result text"""
-        self._generate_code()
         output = []
-        exec_ctx = (ctx or {}).copy()
-        exec_ctx.update({
-            OUTPUT_VAR: output,
-            'LoopVar': LoopVar,
-        })
-        exec(self._code, self._global_vars, exec_ctx)
+        for _ in self._bind(ctx)(output, False):
+            pass
         return "".join(output)
 
+    def generate(self, ctx: dict) -> typing.Iterator[str]:
+        """Yield result text while it is rendered, a piece at end of each loop iteration and one at end."""
+        output = []
+        for _ in self._bind(ctx)(output, True):
+            if output:
+                piece = "".join(output)
+                output.clear()
+                yield piece
+
+    def stream(self, ctx: dict, buffer_size: int = BUFFER_SIZE) -> typing.Iterator[str]:
+        """Yield result text by chunks of about buffer_size characters, for chunked response."""
+        buffer, size = [], 0
+        for piece in self.generate(ctx):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= buffer_size:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+        if buffer:
+            yield "".join(buffer)
+
+
+class BytecodeCache:
+    """
+    Store compiled code of templates in directory, shared by processes.
+    File name is made of source digest and python cache tag, because marshal format
+    and bytecode differ between python versions.
+    """
+    SUFFIX = '.tplc'
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def digest(*texts: str, autoescape: bool = False) -> str:
+        """Digest of sources of a template and the templates it extends or includes."""
+        data = '\0'.join([str(CODE_VERSION), str(autoescape), *texts]).encode('utf-8', errors='surrogatepass')
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self._directory, f'{digest}.{sys.implementation.cache_tag}{self.SUFFIX}')
+
+    def load(self, digest: str):
+        """Return code stored for digest, or None if not stored or not readable."""
+        try:
+            with open(self._path(digest), 'rb') as f:
+                code = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return code if isinstance(code, types.CodeType) else None
+
+    def dump(self, digest: str, code):
+        """Write to a temporary file then rename, so that other processes never read a partial file."""
+        fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(temp_path, self._path(digest))
+        except OSError:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self._directory):
+            if name.endswith(self.SUFFIX):
+                os.unlink(os.path.join(self._directory, name))
+
+
+class TemplateNotFound(LookupError):
+    pass
+
+
+class FileSystemLoader:
+    """
+    Find template files by name in search paths, the first path containing the file wins.
+    Names are relative paths separated by '/', and can not go outside of search paths.
+    """
+    def __init__(self, search_path: typing.Union[str, typing.List[str]], encoding: str = 'utf-8'):
+        if isinstance(search_path, str):
+            search_path = [search_path]
+        self._search_path = [os.path.abspath(x) for x in search_path]
+        self._encoding = encoding
+
+    def load(self, name: str) -> (str, str, int):
+        """Return (text, path, mtime) of template, raise TemplateNotFound if no file found."""
+        parts = name.split('/')
+        if not name or name.startswith('/') or any(x in ('', '.', '..') for x in parts):
+            raise TemplateNotFound(name)
+        for directory in self._search_path:
+            path = os.path.join(directory, *parts)
+            try:
+                with open(path, 'rb') as f:
+                    mtime = os.fstat(f.fileno()).st_mtime_ns
+                    text = f.read().decode(self._encoding)
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                continue
+            return text, path, mtime
+        raise TemplateNotFound(name)
+
+    @staticmethod
+    def mtime(path: str) -> typing.Optional[int]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+
+class LoadedTemplate:
+    """Template loaded by name, with modification time of each file it was compiled from."""
+    def __init__(self, template: Template, sources: dict):
+        self.template = template
+        self.sources = sources
+        self.checked = time.monotonic()
+
+    def is_modified(self, loader: FileSystemLoader) -> bool:
+        return any(loader.mtime(path) != mtime for path, mtime in self.sources.items())
+
 
 class TemplateEngine:
-    """Factory class to create Template object."""
-    def __init__(self):
+    """
+    Factory class to create Template object.
+    Templates are cached by source text, so that each source is compiled once,
+    in a LRU of max_templates as texts may be built dynamically.
+    If cache_dir is given, compiled code is also stored on disk,
+    so that other processes load it instead of compiling again.
+
+    Templates loaded by name from search_path are kept in a LRU of max_templates.
+    With auto_reload, files are checked for modification at most once per reload_interval seconds,
+    without it a cached template is returned with no file system access at all.
+
+    With autoescape, expressions are html escaped unless they are Markup,
+    it can be a function of template name (None for templates created from text), see select_autoescape().
+    """
+    def __init__(self, cache_dir: str = None, search_path: typing.Union[str, typing.List[str]] = None,
+                 auto_reload: bool = False, reload_interval: float = 1, max_templates: int = 256,
+                 autoescape: typing.Union[bool, typing.Callable[[typing.Optional[str]], bool]] = False):
+        self._autoescape = autoescape
         self._filters = {}
+        self._templates = collections.OrderedDict()
+        self._bytecode_cache = BytecodeCache(cache_dir) if cache_dir else None
+        self._loader = FileSystemLoader(search_path) if search_path else None
+        self._auto_reload = auto_reload
+        self._reload_interval = reload_interval
+        self._max_templates = max_templates
+        self._loaded = collections.OrderedDict()
+        self._lock = threading.Lock()
         self._register_default_filters()
 
     def register_filter(self, name: str, filter_):
         self._filters[name] = filter_
+        # Cached templates hold a copy of filters taken when they were created
+        self.clear_cache()
 
     def _register_default_filters(self):
         self.register_filter('upper', lambda x: x.upper())
         self.register_filter('strip', lambda x: x.strip())
+        self.register_filter('escape', escape)
+        self.register_filter('safe', Markup)
 
     def create(self, text: str) -> Template:
-        return Template(text, filters=self._filters)
+        """Create template from text, it can extend or include templates in search path.
+           Cached template is not updated when a template it extends or includes changes."""
+        with self._lock:
+            template = self._templates.get(text)
+            if template is not None:
+                self._templates.move_to_end(text)
+                return template
+        template = self._compile(text, load=self._load_source if self._loader else None)
+        with self._lock:
+            self._templates[text] = template
+            while len(self._templates) > self._max_templates:
+                self._templates.popitem(last=False)
+        return template
+
+    def _load_source(self, name: str) -> str:
+        return self._loader.load(name)[0]
+
+    def _compile(self, text: str, name: str = None, load: typing.Callable[[str], str] = None) -> Template:
+        """
+        Without load, template is compiled on first render, unless its code is cached on disk.
+        With load, it is compiled now so that templates it extends or includes are loaded,
+        and code cached on disk is keyed by all of their sources.
+        """
+        autoescape = self._autoescape(name) if callable(self._autoescape) else self._autoescape
+        texts, tokens = [text], None
+        if load is not None:
+            def load_source(template_name: str) -> str:
+                source = load(template_name)
+                texts.append(source)
+                return source
+            tokens = parse(text, name, load_source)
+        digest = code = None
+        if self._bytecode_cache is not None:
+            digest = BytecodeCache.digest(*texts, autoescape=autoescape)
+            code = self._bytecode_cache.load(digest)
+            if code is not None:
+                return Template(text, filters=self._filters, code=code, autoescape=autoescape)
+        if tokens is not None:
+            code = compile(build_source(tokens, text, name, CodeBuilder(autoescape)), name or '', 'exec')
+        template = Template(text, filters=self._filters, code=code, autoescape=autoescape)
+        if digest is not None:
+            self._bytecode_cache.dump(digest, template.code)
+        return template
+
+    def get_template(self, name: str) -> Template:
+        """Return template loaded from file name in search path, raise TemplateNotFound if not found."""
+        if self._loader is None:
+            raise TemplateNotFound(f'{name}, no search path configured')
+        with self._lock:
+            loaded = self._loaded.get(name)
+            if loaded is not None:
+                self._loaded.move_to_end(name)
+        if loaded is not None:
+            if not self._auto_reload:
+                return loaded.template
+            now = time.monotonic()
+            if now - loaded.checked < self._reload_interval:
+                return loaded.template
+            loaded.checked = now
+            if not loaded.is_modified(self._loader):
+                return loaded.template
+        sources = {}
+
+        def load(template_name: str) -> str:
+            text, path, mtime = self._loader.load(template_name)
+            sources[path] = mtime
+            return text
+
+        # Template is recompiled when any file it extends or includes is modified
+        template = self._compile(load(name), name, load)
+        loaded = LoadedTemplate(template, sources)
+        with self._lock:
+            self._loaded[name] = loaded
+            self._loaded.move_to_end(name)
+            while len(self._loaded) > self._max_templates:
+                self._loaded.popitem(last=False)
+        return loaded.template
+
+    def clear_cache(self):
+        """Drop templates cached in memory, code stored on disk is kept."""
+        with self._lock:
+            self._templates.clear()
+            self._loaded.clear()
@@ -1,9 +1,33 @@
+import itertools
+import os
+import tempfile
 import unittest
+from unittest import mock
 
-from .template import Template, TemplateEngine, tokenize, parse_expr, \
+from . import template as template_module
+from .template import Template, TemplateEngine, BytecodeCache, TemplateNotFound, TemplateSyntaxError, \
+    tokenize, parse_expr, generate_source, line_column, Markup, escape, escape_html, select_autoescape, \
+    compile_expr, getattr_or_item, \
     Text, Expr, Comment, For, EndFor, If, ElseIf, Else, EndIf
 
 
+class TemplateDirTestCase(unittest.TestCase):
+    """Write templates to a temporary directory, which is the search path of the tests."""
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.root = self._dir.name
+
+    def write(self, name: str, text: str, mtime: int = None) -> str:
+        path = os.path.join(self.root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
 class TokenizeTest(unittest.TestCase):
     def test_single_variable(self):
         tokens = tokenize("Hello, {{name}}!")
@@ -35,7 +59,12 @@ class TokenizeTest(unittest.TestCase):
             ("name", "name", []),
             ("name | upper", "name", ["upper"]),
             ("name | upper | strip", "name", ["upper", "strip"]),
-            ("'a string with | inside' | upper | strip", "'a string with | inside'", ["upper", "strip"])
+            ("'a string with | inside' | upper | strip", "'a string with | inside'", ["upper", "strip"]),
+            ("name|upper", "name", ["upper"]),
+            ("name | truncate( 10 ) | join(', ')", "name", ["truncate(10)", "join(', ')"]),
+            ("name | replace('|', \"\\\"|\")", "name", ["replace('|', \"\\\"|\")"]),
+            ("(a | b) | upper", "(a | b)", ["upper"]),
+            ("d['x|y']", "d['x|y']", []),
         ]
         for expr, varname, filters in cases:
             parsed_varname, parsed_filters = parse_expr(expr)
@@ -55,6 +84,38 @@ class TokenizeTest(unittest.TestCase):
         with self.assertRaises(SyntaxError):
             tokenize("{% nokeyword %}")
 
+    def test_invalid_filter(self):
+        for expr in ["name |", "name | | upper", "name | up per", "name | f(1", "| upper", "'name | upper"]:
+            with self.assertRaises(SyntaxError, msg=expr):
+                parse_expr(expr)
+
+    def test_token_position(self):
+        text = "Hello,\n  {{ name }}\n{% if flag %}{# c\n #}\n{% endif %}"
+        self.assertEqual([(1, 1), (2, 3), (2, 13), (3, 1), (3, 14), (4, 4), (5, 1)],
+                         [line_column(text, x.position) for x in tokenize(text)])
+
+    def test_string_in_tag(self):
+        tokens = tokenize("{{ '}}' }}{{ \"a\\\"}}\" }}!")
+        self.assertEqual(tokens, [Expr("'}}'"), Expr('"a\\"}}"'), Text("!")])
+
+    def test_single_brace_is_text(self):
+        self.assertEqual(tokenize("a { b } {c}"), [Text("a { b } {c}")])
+
+    def test_error_position(self):
+        cases = [
+            ("line 1\n  {{ name", "Unclosed tag", 2, 3),
+            ("\n\n{% nokeyword %}", "Unknown control token", 3, 1),
+            ("{{ a }}{% for x %}", "Invalid for block", 1, 8),
+            ("{{ a |  }}", "Invalid filter", 1, 1),
+            ("x\n{% for x in y %}{% endif %}", "Expected end of if block", 2, 17),
+            ("x\n {% if y %}", "if has no end tag", 2, 2),
+        ]
+        for text, message, line, column in cases:
+            with self.assertRaises(TemplateSyntaxError) as cm:
+                generate_source(text)
+            self.assertIn(message, str(cm.exception))
+            self.assertEqual((line, column), (cm.exception.line, cm.exception.column), text)
+
     def test_tokenize_if(self):
         tokens = tokenize("{% if flag %}OK{% endif %}")
         self.assertEqual(tokens, [
@@ -135,6 +196,19 @@ class TemplateTest(unittest.TestCase):
                     "Hello, A!",
                     filters={"first": first})
 
+    def test_filters_applied_left_to_right(self):
+        # first(strip(name)), it was strip(first(name)) == "" when filters were applied right to left
+        self.render("{{ name | strip | first }}",
+                    {"name": "  Alice"},
+                    "A",
+                    filters={"first": lambda x: x[0]})
+
+    def test_filter_with_arguments(self):
+        self.render("{{ name | pad(8, '|') }}!",
+                    {"name": "Alice"},
+                    "Alice|||!",
+                    filters={"pad": lambda x, width, char: x.ljust(width, char)})
+
     def test_filter_not_defined(self):
         with self.assertRaises(NameError):
             self.render("Hello, {{ name | upper | first }}!",
@@ -173,6 +247,14 @@ class TemplateTest(unittest.TestCase):
                         {"messages": ["a", "b", "c"]},
                         "")
 
+    def test_loop_variable_shadows_context(self):
+        self.render("{{ name }}{% for name in names %}[{{ name }}]{% endfor %}",
+                    {"name": "x", "names": ["a", "b"]}, "x[a][b]")
+        self.render("{% for item in item %}{{ item }}{% endfor %}", {"item": [1, 2]}, "12")
+        self.render("{{ loop }}{% for x in xs %}{{ loop.index }}{% endfor %}", {"loop": "-", "xs": "ab"}, "-01")
+        self.assertRaises(NameError, TemplateEngine().create("{{ x }}{% for x in xs %}{% endfor %}").render,
+                          {"xs": []})
+
     def test_render_if_simple(self):
         source = "{%if flag%}OK{%endif%}"
         self.render(source, {"flag": True}, "OK")
@@ -185,6 +267,408 @@ class TemplateTest(unittest.TestCase):
         self.render(source, {"flag1": False, "flag2": False}, "none")
 
 
+class CodeGenerationTest(unittest.TestCase):
+    def test_text_and_expr_appended_at_once(self):
+        source = generate_source("<p>{{ a }}, {{ b | upper }}!</p>{% if c %}c{% endif %}")
+        self.assertEqual(2, source.count("_append_("), source)
+        self.assertNotIn("str(", source)
+
+    def test_special_characters(self):
+        text = "{x} {{ a }} '\"\\n\té{}"
+        self.assertEqual("{x} A '\"\\n\té{}", TemplateEngine().create(text).render({"a": "A"}))
+
+    def test_expr_with_quotes(self):
+        template = TemplateEngine().create("<{{ d['k'] }}|{{ d[\"k\"] }}|{{ '#' }}|{{ d['k'] | upper }}>")
+        self.assertEqual("<v|v|#|V>", template.render({"d": {"k": "v"}}))
+
+    def test_expr_with_colon(self):
+        self.assertEqual("bc", TemplateEngine().create("{{ s[1:] }}").render({"s": "abc"}))
+
+    def test_loop_var_only_when_referred(self):
+        self.assertNotIn("LoopVar", generate_source("{% for x in xs %}{{x}}{% endfor %}"))
+        self.assertIn("LoopVar", generate_source("{% for x in xs %}{{loop.index}}{% endfor %}"))
+        self.assertIn("LoopVar", generate_source("{% for x in xs %}{% if loop %}{{x}}{% endif %}{% endfor %}"))
+
+    def test_index_variable(self):
+        self.assertEqual("01", TemplateEngine().create("{% for x in xs %}{{ index }}{% endfor %}").render({"xs": "ab"}))
+        self.assertEqual("a", TemplateEngine().create("{% for x in xs %}{% if index %}{{ x }}{% endif %}{% endfor %}")
+                         .render({"xs": "ba"}))
+
+    def test_loop_var_of_nested_loop(self):
+        text = "{% for row in rows %}{% for x in row %}{{loop.index1}}{% endfor %};{% endfor %}"
+        self.assertEqual(1, generate_source(text).count("LoopVar"))
+        self.assertEqual("12;1;", TemplateEngine().create(text).render({"rows": [[1, 2], [3]]}))
+
+
+class ExpressionTest(unittest.TestCase):
+    def render(self, text: str, ctx: dict) -> str:
+        engine = TemplateEngine()
+        engine.register_filter('truncate', lambda s, n, end='...': s[:n] + end if len(s) > n else s)
+        engine.register_filter('length', len)
+        return engine.create(text).render(ctx)
+
+    def test_compile_expr(self):
+        self.assertEqual("name", compile_expr(" name "))
+        self.assertEqual("_attr_(_attr_(user, 'address'), 'city')", compile_expr("user.address.city"))
+        self.assertEqual("items[0] + 1", compile_expr("items[0]+1"))
+        self.assertEqual("length(_attr_(user, 'tags')) > 2", compile_expr("user.tags | length > 2"))
+        self.assertEqual("truncate(name, 10, end='~')", compile_expr("name | truncate(10, end='~')"))
+
+    def test_invalid_expression(self):
+        for text in ["a +", "lambda: 1", "[x for x in xs]", "(yield)", "x | 1", "_output_", "a.__class__",
+                     "(a := 1)"]:
+            with self.subTest(text), self.assertRaises(SyntaxError):
+                compile_expr(text)
+
+    def test_getattr_or_item(self):
+        class User:
+            name = "tom"
+        self.assertEqual("tom", getattr_or_item(User(), "name"))
+        self.assertEqual("jerry", getattr_or_item({"name": "jerry"}, "name"))
+        self.assertEqual([("items", 1)], list(getattr_or_item({"items": 1}, "items")()))
+        self.assertRaises(AttributeError, getattr_or_item, {}, "name")
+        self.assertRaises(AttributeError, getattr_or_item, User(), "email")
+
+    def test_attribute_and_item(self):
+        ctx = {"user": {"name": "tom", "tags": ["a", "b"]}, "i": 1}
+        self.assertEqual("tom b b", self.render("{{ user.name }} {{ user.tags[1] }} {{ user['tags'][i] }}", ctx))
+
+    def test_literals_and_operators(self):
+        self.assertEqual("7 c 2 v", self.render("{{ 1 + 2 * 3 }} {{ 'a' if x else 'c' }} {{ [1, 2][-1] }} "
+                                                "{{ {'k': 'v'}['k'] }}", {"x": False}))
+
+    def test_conditions(self):
+        text = ("{% for user in users %}{% if user.age >= 18 and not user.banned %}{{ user.name }}"
+                "{% elif user.name in vips or user.age is none %}vip{% else %}-{% endif %};{% endfor %}")
+        users = [{"name": "a", "age": 20, "banned": False}, {"name": "b", "age": 20, "banned": True},
+                 {"name": "c", "age": 10, "banned": False}]
+        self.assertEqual("a;-;vip;", self.render(text, {"users": users, "vips": ["c"], "none": None}))
+
+    def test_filters_in_conditions(self):
+        text = "{% if (name | length) > 3 %}long{% elif name | length %}short{% endif %}"
+        self.assertEqual("long", self.render(text, {"name": "abcd"}))
+        self.assertEqual("short", self.render(text, {"name": "ab"}))
+
+    def test_for_loop_expressions(self):
+        text = "{% for k, v in d.items() %}{{ k }}={{ v }};{% endfor %}{% for x in user.tags | sort %}{{ x }}{% endfor %}"
+        ctx = {"d": {"a": 1, "b": 2}, "user": {"tags": ["y", "x"]}, "sort": sorted}
+        self.assertEqual("a=1;b=2;xy", self.render(text, ctx))
+        text = "{% for k, v in d.items() %}{{ loop.index1 }}{{ k }}{% endfor %}"
+        self.assertEqual("1a2b", self.render(text, ctx))
+
+    def test_filter_arguments_are_expressions(self):
+        text = "{{ user.name | truncate(user.limit, end=suffix) }}"
+        self.assertEqual("ab~", self.render(text, {"user": {"name": "abc", "limit": 2}, "suffix": "~"}))
+
+    def test_attribute_access_stays_in_f_string(self):
+        source = generate_source("<p>{{ user.name }} {{ user.email }} {{ d[\"k\"] }}</p>")
+        self.assertEqual(1, source.count("_append_("), source)
+        self.assertNotIn("_t0_", source)
+
+
+class InheritanceTest(TemplateDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine = TemplateEngine(search_path=self.root)
+        self.write("base.html", "<title>{% block title %}Site{% endblock %}</title>"
+                                "<body>{% block body %}<p>empty</p>{% endblock body %}</body>")
+
+    def render(self, name: str, ctx: dict, expected: str, engine: TemplateEngine = None):
+        self.assertEqual(expected, (engine or self.engine).get_template(name).render(ctx))
+
+    def test_block_without_extends(self):
+        self.render("base.html", {}, "<title>Site</title><body><p>empty</p></body>")
+
+    def test_extends(self):
+        self.write("page.html", "{% extends 'base.html' %}ignored{% block body %}Hello, {{name}}!{% endblock %}")
+        self.render("page.html", {"name": "Alice"}, "<title>Site</title><body>Hello, Alice!</body>")
+
+    def test_extends_chain(self):
+        self.write("layout.html", "{% extends \"base.html\" %}"
+                                  "{% block title %}Layout{% endblock %}"
+                                  "{% block body %}<nav/>{% block main %}{% endblock %}{% endblock %}")
+        self.write("page.html", "{% extends 'layout.html' %}{% block main %}Main{% endblock %}")
+        self.render("page.html", {}, "<title>Layout</title><body><nav/>Main</body>")
+        self.write("page2.html", "{% extends 'layout.html' %}{% block title %}Page{% endblock %}")
+        self.render("page2.html", {}, "<title>Page</title><body><nav/></body>")
+
+    def test_include(self):
+        self.write("item.html", "<li>{{ item | upper }}</li>")
+        self.write("list.html", "<ul>{% for item in items %}{% include 'item.html' %}{% endfor %}</ul>")
+        self.render("list.html", {"items": ["a", "b"]}, "<ul><li>A</li><li>B</li></ul>")
+        self.assertEqual("<ul><li>C</li></ul>", self.engine.create("<ul>{% include 'item.html' %}</ul>").render({"item": "c"}))
+
+    def test_compiled_to_one_function(self):
+        sources = {
+            "base.html": "{% block a %}A{% endblock %}{% include 'inc.html' %}",
+            "inc.html": "{% for x in xs %}{{x}}{% endfor %}",
+        }
+        source = generate_source("{% extends 'base.html' %}{% block a %}{{a}}{% endblock %}", load=sources.get)
+        self.assertEqual(1, source.count("def "), source)
+        self.assertEqual(2, len([x for x in source.splitlines() if "_append_(" in x]), source)
+
+    def test_reload_when_ancestor_changes(self):
+        self.write("inc.html", "v1", mtime=1000)
+        self.write("layout.html", "{% extends 'base.html' %}{% block title %}{% include 'inc.html' %}{% endblock %}")
+        self.write("page.html", "{% extends 'layout.html' %}")
+        engine = TemplateEngine(search_path=self.root, auto_reload=True, reload_interval=0)
+        self.render("page.html", {}, "<title>v1</title><body><p>empty</p></body>", engine)
+        self.write("inc.html", "v2", mtime=2000)
+        self.render("page.html", {}, "<title>v2</title><body><p>empty</p></body>", engine)
+
+    def test_disk_cache_keyed_by_ancestors(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.write("page.html", "{% extends 'base.html' %}")
+            self.render("page.html", {}, "<title>Site</title><body><p>empty</p></body>",
+                        TemplateEngine(cache_dir=cache_dir, search_path=self.root))
+            self.write("base.html", "{% block body %}{% endblock %}!")
+            self.render("page.html", {}, "!", TemplateEngine(cache_dir=cache_dir, search_path=self.root))
+
+    def test_errors(self):
+        cases = [
+            ("{% extends 'missing.html' %}", TemplateNotFound, None),
+            ("{% extends 'a.html' %}{% extends 'b.html' %}", TemplateSyntaxError, "only extend one"),
+            ("{% include 'self.html' %}", TemplateSyntaxError, "Recursive"),
+            ("{% block a %}{% block a %}{% endblock %}{% endblock %}", TemplateSyntaxError, "defined twice"),
+            ("{% block a %}{% endblock b %}", TemplateSyntaxError, "Expected end of block a"),
+            ("{% block a %}", TemplateSyntaxError, "block has no end tag"),
+            ("{% endblock %}", TemplateSyntaxError, "does not found matching start tag"),
+            ("{% include missing %}", TemplateSyntaxError, "Invalid include tag"),
+        ]
+        for text, error, message in cases:
+            self.write("self.html", text)
+            with self.assertRaises(error, msg=text) as cm:
+                TemplateEngine(search_path=self.root).get_template("self.html")
+            if message:
+                self.assertIn(message, str(cm.exception))
+
+    def test_error_in_included_template(self):
+        self.write("inc.html", "\n{% for x in xs %}")
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            self.engine.create("{% include 'inc.html' %}")
+        self.assertEqual(("inc.html", 2, 1), (cm.exception.name, cm.exception.line, cm.exception.column))
+
+    def test_extends_without_loader(self):
+        with self.assertRaises(TemplateSyntaxError):
+            TemplateEngine().create("{% extends 'base.html' %}").render({})
+
+
+class EscapeTest(unittest.TestCase):
+    def test_escape_html(self):
+        class Html:
+            def __html__(self):
+                return "<i>html</i>"
+
+        self.assertEqual("&lt;a href=&#34;x&#34; title=&#39;&amp;&#39;&gt;", escape_html("<a href=\"x\" title='&'>"))
+        self.assertEqual("plain", escape_html("plain"))
+        self.assertEqual("42", escape_html(42))
+        self.assertEqual("<b>", escape_html(Markup("<b>")))
+        self.assertEqual("<i>html</i>", escape_html(Html()))
+        self.assertIsInstance(escape("<"), Markup)
+        self.assertEqual("&amp;lt;", escape_html(escape_html("<")))
+        self.assertEqual("&lt;", escape(escape("<")))
+
+    def test_markup_concat_escapes_other(self):
+        self.assertEqual(Markup("<b>&lt;i&gt;</b>"), Markup("<b>") + "<i>" + Markup("</b>"))
+        self.assertEqual("&lt;i&gt;<b>", "<i>" + Markup("<b>"))
+        self.assertIsInstance("<i>" + Markup("<b>"), Markup)
+
+    def test_markup_methods_keep_safety(self):
+        for value, expected in [(Markup("<b>").upper(), "<B>"),
+                                (Markup(" <b> ").strip(), "<b>"),
+                                (Markup("<a><b>")[3:], "<b>"),
+                                (Markup("<b>").replace("b", "<i>"), "<&lt;i&gt;>"),
+                                (Markup(", ").join(["<a>", Markup("<b>")]), "&lt;a&gt;, <b>"),
+                                (Markup("<p>%s %d</p>") % ("<x>", 5), "<p>&lt;x&gt; 5</p>"),
+                                (Markup("%(x)s") % {"x": "<"}, "&lt;"),
+                                (Markup("{}:{:03d}:{x}").format("<", 5, x=Markup("<i>")), "&lt;:005:<i>")]:
+            with self.subTest(expected=expected):
+                self.assertIsInstance(value, Markup)
+                self.assertEqual(expected, value)
+        self.assertEqual([Markup("<a>"), Markup("<b>")], Markup("<a> <b>").split())
+        self.assertIsInstance(Markup("<a> <b>").split()[0], Markup)
+
+    def test_filters_chained_on_markup(self):
+        engine = TemplateEngine(autoescape=True)
+        self.assertEqual("&LT;B&GT;", engine.create("{{ x | escape | upper }}").render({"x": "<b>"}))
+        self.assertEqual("<b>", engine.create("{{ x | safe | strip }}").render({"x": " <b> "}))
+        self.assertEqual("<B>", engine.create("{{ x | safe | upper | strip }}").render({"x": "<b> "}))
+
+    def test_autoescape(self):
+        engine = TemplateEngine(autoescape=True)
+        template = engine.create("<p title='{{ title }}'>{{ body | safe }}{{ text | escape }}{{ n }}</p>")
+        self.assertEqual("<p title='&#39;&lt;x&gt;&#39;'><br>a &amp; b1</p>",
+                         template.render({"title": "'<x>'", "body": "<br>", "text": "a & b", "n": 1}))
+        self.assertEqual("<b>", TemplateEngine().create("{{ x }}").render({"x": "<b>"}))
+
+    def test_select_autoescape(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name in ("page.html", "page.txt"):
+                with open(os.path.join(root, name), "w") as f:
+                    f.write("{{ x }}")
+            engine = TemplateEngine(search_path=root, autoescape=select_autoescape(default=True))
+            self.assertEqual("&lt;", engine.get_template("page.html").render({"x": "<"}))
+            self.assertEqual("<", engine.get_template("page.txt").render({"x": "<"}))
+            self.assertEqual("&lt;", engine.create("{{ x }}").render({"x": "<"}))
+        self.assertFalse(select_autoescape(["HTML"])(None))
+        self.assertTrue(select_autoescape(["HTML"])("a/b.Html"))
+
+    def test_disk_cache_keyed_by_autoescape(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual("<", TemplateEngine(cache_dir=cache_dir).create("{{ x }}").render({"x": "<"}))
+            template = TemplateEngine(cache_dir=cache_dir, autoescape=True).create("{{ x }}")
+            self.assertEqual("&lt;", template.render({"x": "<"}))
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = TemplateEngine()
+
+    def test_generate_piece_per_iteration(self):
+        template = self.engine.create("<ul>{% for x in items %}<li>{{x}}</li>{% endfor %}</ul>")
+        self.assertEqual(["<ul><li>1</li>", "<li>2</li>", "</ul>"],
+                         list(template.generate({"items": [1, 2]})))
+
+    def test_generate_without_loop(self):
+        template = self.engine.create("Hello, {{name}}!")
+        self.assertEqual(["Hello, Alice!"], list(template.generate({"name": "Alice"})))
+
+    def test_stream_same_as_render(self):
+        template = self.engine.create("{% for row in rows %}{% for x in row %}{{x}},{% endfor %}\n{% endfor %}")
+        ctx = {"rows": [list(range(i)) for i in range(50)]}
+        chunks = list(template.stream(ctx, buffer_size=100))
+        self.assertEqual(template.render(ctx), "".join(chunks))
+        self.assertTrue(all(100 <= len(x) < 200 for x in chunks[:-1]))
+
+    def test_stream_renders_lazily(self):
+        template = self.engine.create("{% for x in items %}{{x}}{% endfor %}")
+        chunks = template.stream({"items": itertools.count()}, buffer_size=1000)
+        self.assertEqual("0123456789", next(chunks)[:10])
+        chunks.close()
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.cache_dir = self._dir.name
+
+    def test_same_source_compiled_once(self):
+        engine = TemplateEngine()
+        template = engine.create("Hello, {{name}}!")
+        self.assertIs(template, engine.create("Hello, {{name}}!"))
+        self.assertIsNot(template, engine.create("Bye, {{name}}!"))
+
+    def test_created_templates_bounded(self):
+        engine = TemplateEngine(max_templates=2)
+        first = engine.create("1")
+        second = engine.create("2")
+        self.assertIs(first, engine.create("1"))
+        engine.create("3")
+        self.assertIs(first, engine.create("1"))
+        self.assertIsNot(second, engine.create("2"))
+
+    def test_register_filter_drops_cached_templates(self):
+        engine = TemplateEngine()
+        text = "{{ name | first }}"
+        template = engine.create(text)
+        engine.register_filter('first', lambda x: x[0])
+        self.assertIsNot(template, engine.create(text))
+        self.assertEqual("A", engine.create(text).render({"name": "Alice"}))
+
+    def test_code_loaded_from_disk(self):
+        text = "{% for msg in messages %}{{loop.index1}}.{{msg | upper}}{% endfor %}"
+        TemplateEngine(cache_dir=self.cache_dir).create(text).render({"messages": []})
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        with mock.patch.object(template_module, 'tokenize', side_effect=AssertionError('compiled again')):
+            template = TemplateEngine(cache_dir=self.cache_dir).create(text)
+            self.assertEqual("1.A2.B", template.render({"messages": ["a", "b"]}))
+
+    def test_corrupted_cache_file_is_ignored(self):
+        text = "Hello, {{name}}!"
+        cache = BytecodeCache(self.cache_dir)
+        digest = BytecodeCache.digest(text)
+        with open(cache._path(digest), 'wb') as f:
+            f.write(b'\xff\x00garbage')
+        template = TemplateEngine(cache_dir=self.cache_dir).create(text)
+        self.assertEqual("Hello, Alice!", template.render({"name": "Alice"}))
+        self.assertIsNotNone(cache.load(digest))
+
+    def test_digest_depends_on_code_version(self):
+        digest = BytecodeCache.digest("text")
+        with mock.patch.object(template_module, 'CODE_VERSION', template_module.CODE_VERSION + 1):
+            self.assertNotEqual(digest, BytecodeCache.digest("text"))
+
+
+class LoaderTest(TemplateDirTestCase):
+    def test_get_template(self):
+        self.write("pages/hello.html", "Hello, {{name}}!")
+        engine = TemplateEngine(search_path=self.root)
+        template = engine.get_template("pages/hello.html")
+        self.assertEqual("Hello, Alice!", template.render({"name": "Alice"}))
+        self.assertIs(template, engine.get_template("pages/hello.html"))
+
+    def test_first_search_path_wins(self):
+        self.write("a/page.html", "A")
+        self.write("b/page.html", "B")
+        self.write("b/other.html", "other")
+        engine = TemplateEngine(search_path=[os.path.join(self.root, "a"), os.path.join(self.root, "b")])
+        self.assertEqual("A", engine.get_template("page.html").render({}))
+        self.assertEqual("other", engine.get_template("other.html").render({}))
+
+    def test_template_not_found(self):
+        self.write("page.html", "page")
+        engine = TemplateEngine(search_path=os.path.join(self.root, "sub"))
+        self.write("sub/dir/index.html", "index")
+        for name in ["missing.html", "../page.html", "/page.html", "dir", "dir//index.html", ""]:
+            with self.assertRaises(TemplateNotFound):
+                engine.get_template(name)
+        with self.assertRaises(TemplateNotFound):
+            TemplateEngine().get_template("page.html")
+
+    def test_no_file_access_without_auto_reload(self):
+        self.write("page.html", "page")
+        engine = TemplateEngine(search_path=self.root)
+        template = engine.get_template("page.html")
+        with mock.patch('os.stat', side_effect=AssertionError('stat called')), \
+                mock.patch('builtins.open', side_effect=AssertionError('open called')):
+            self.assertIs(template, engine.get_template("page.html"))
+
+    def test_auto_reload(self):
+        self.write("page.html", "v1", mtime=1000)
+        engine = TemplateEngine(search_path=self.root, auto_reload=True, reload_interval=0)
+        template = engine.get_template("page.html")
+        self.assertIs(template, engine.get_template("page.html"))
+        self.write("page.html", "v2", mtime=2000)
+        self.assertEqual("v2", engine.get_template("page.html").render({}))
+
+    def test_reload_checked_once_per_interval(self):
+        self.write("page.html", "v1", mtime=1000)
+        engine = TemplateEngine(search_path=self.root, auto_reload=True, reload_interval=60)
+        engine.get_template("page.html")
+        self.write("page.html", "v2", mtime=2000)
+        with mock.patch('os.stat', side_effect=AssertionError('stat called')):
+            self.assertEqual("v1", engine.get_template("page.html").render({}))
+
+    def test_removed_template(self):
+        path = self.write("page.html", "page")
+        engine = TemplateEngine(search_path=self.root, auto_reload=True, reload_interval=0)
+        engine.get_template("page.html")
+        os.unlink(path)
+        with self.assertRaises(TemplateNotFound):
+            engine.get_template("page.html")
+
+    def test_least_recently_used_evicted(self):
+        for name in "abc":
+            self.write(name, name)
+        engine = TemplateEngine(search_path=self.root, max_templates=2)
+        a, b = engine.get_template("a"), engine.get_template("b")
+        self.assertIs(a, engine.get_template("a"))
+        engine.get_template("c")
+        self.assertIs(a, engine.get_template("a"))
+        self.assertIsNot(b, engine.get_template("b"))
+
+
 def main():
     unittest.main(__name__)
 
@@ -0,0 +1,331 @@
+"""
+Benchmark suite of the template engine.
+Each case is a realistic template, measured for compile time, render time, allocations and peak memory.
+Results are written as JSON, so that runs of different commits can be compared to catch regressions:
+
+    python -m template_engine.step06_perf_test.benchmark --output before.json
+    python -m template_engine.step06_perf_test.benchmark --compare before.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from ..step05_if_block import template as template_module
+from ..step05_if_block.template import TemplateEngine
+
+
+# Metrics compared between runs, lower is better for all of them.
+METRICS = ('compile_ms', 'render_ms', 'render_allocations', 'render_peak_kb', 'compile_peak_kb')
+
+
+class User:
+    def __init__(self, i: int):
+        self.id = i
+        self.name = f" User {i} "
+        self.email = f"user{i}@example.com"
+        self.city = ["berlin", "paris", "tokyo"][i % 3]
+        self.score = i * 7 % 100
+        self.active = i % 2 == 0
+        self.tags = ["admin", "staff", "guest"][:i % 4]
+
+
+def users(count: int) -> list:
+    return [User(i) for i in range(count)]
+
+
+def report_template() -> str:
+    """Large loop: a table row per user, with attribute access, filters and an inner loop."""
+    return """<html><head><title>{{ title | strip }}</title></head>
+<body>
+<h1>{{ title | upper }}</h1>
+<table class="report">
+  <tr><th>#</th><th>Name</th><th>Email</th><th>City</th><th>Score</th><th>Tags</th></tr>
+{% for user in users %}  <tr class="{% if loop.index % 2 %}odd{% else %}even{% endif %}">
+    <td>{{ loop.index1 }}</td><td>{{ user.name | strip }}</td><td>{{ user.email }}</td>
+    <td>{{ user.city | upper }}</td><td>{{ user.score }}</td>
+    <td>{% for tag in user.tags %}<span>{{ tag }}</span>{% endfor %}</td>
+  </tr>
+{% endfor %}</table>
+</body></html>
+"""
+
+
+def report_context() -> dict:
+    return {"title": " Users & <Friends> ", "users": users(1000)}
+
+
+def conditions_template() -> str:
+    """Nested conditions with comparisons and boolean operators, on dicts rather than objects."""
+    return """<ul>
+{% for order in orders %}  <li>{{ order.id }}:
+  {% if order.paid %}
+    {% if order.total > 1000 and not order.flagged %}<b>large</b>
+    {% elif order.total > 100 %}medium
+    {% elif order.lines %}small
+    {% else %}empty{% endif %}
+    {% if order.customer.vip or order.customer.orders >= 10 %}<i>priority</i>{% endif %}
+  {% else %}
+    {% if order.flagged %}<em>review</em>{% else %}unpaid{% endif %}
+  {% endif %}</li>
+{% endfor %}</ul>
+"""
+
+
+def conditions_context() -> dict:
+    orders = [{"id": i, "paid": i % 3 != 0, "total": i * 37 % 2000, "flagged": i % 7 == 0,
+               "lines": [1] * (i % 4), "customer": {"vip": i % 11 == 0, "orders": i % 13}}
+              for i in range(1000)]
+    return {"orders": orders}
+
+
+def filters_template() -> str:
+    """Many filters per expression, some with arguments."""
+    return """{% for user in users %}<p title="{{ user.email | lower | truncate(12) }}">
+  {{ user.name | strip | title | center(20) }} {{ user.city | upper | truncate(3, '') }}
+  {{ user.tags | join(', ') | default('-') | upper }} {{ user.score | format('%05d') }}
+</p>
+{% endfor %}"""
+
+
+def filters_context() -> dict:
+    return {"users": users(1000)}
+
+
+def static_template() -> str:
+    """Big static page with a few expressions, the cost is mostly copying text."""
+    paragraph = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 20 + "</p>\n"
+    return ("<html><head><title>{{ title }}</title></head><body>\n" + paragraph * 200 +
+            "<footer>{{ footer | upper }}</footer></body></html>\n")
+
+
+def static_context() -> dict:
+    return {"title": "Static", "footer": "the end"}
+
+
+INHERITANCE_TEMPLATES = {
+    "base.html": """<html><head><title>{% block title %}Site{% endblock %}</title></head>
+<body>{% include "nav.html" %}
+<main>{% block content %}{% endblock %}</main>
+<footer>{% block footer %}(c) {{ year }}{% endblock %}</footer></body></html>
+""",
+    "nav.html": """<nav>{% for link in links %}<a href="{{ link.url }}">{{ link.title | upper }}</a>{% endfor %}</nav>""",
+    "page.html": """{% extends "base.html" %}{% block title %}{{ title }}{% endblock %}
+{% block content %}{% for user in users %}<div>{{ user.name | strip }}
+{% if user.active %}active{% endif %}</div>
+{% endfor %}{% endblock %}""",
+}
+
+
+def inheritance_context() -> dict:
+    links = [{"url": f"/page/{i}", "title": f"page {i}"} for i in range(10)]
+    return {"title": "Users", "year": 2026, "links": links, "users": users(1000)}
+
+
+def default_filters() -> dict:
+    """Filters used by benchmark templates, besides engine defaults."""
+    return {
+        "lower": str.lower,
+        "title": str.title,
+        "center": str.center,
+        "truncate": lambda s, n, end='...': s[:n] + end if len(s) > n else s,
+        "join": lambda items, sep='': sep.join(items),
+        "default": lambda value, default='': value or default,
+        "format": lambda value, fmt: fmt % value,
+    }
+
+
+class Case:
+    """Template to benchmark, created by a new engine for each compile."""
+    def __init__(self, name: str, context: typing.Callable[[], dict], text: str = None,
+                 templates: dict = None, template_name: str = None, autoescape: bool = False):
+        self.name = name
+        self.context = context
+        self.text = text
+        self.templates = templates
+        self.template_name = template_name
+        self.autoescape = autoescape
+
+    def size(self) -> int:
+        return len(self.text) if self.text is not None else sum(len(x) for x in self.templates.values())
+
+    def compile(self, search_path: str = None) -> template_module.Template:
+        engine = TemplateEngine(search_path=search_path, autoescape=self.autoescape)
+        for name, fn in default_filters().items():
+            engine.register_filter(name, fn)
+        if self.text is not None:
+            template = engine.create(self.text)
+        else:
+            template = engine.get_template(self.template_name)
+        template.code
+        return template
+
+
+CASES = [
+    Case("report", report_context, text=report_template()),
+    Case("report_autoescape", report_context, text=report_template(), autoescape=True),
+    Case("nested_conditions", conditions_context, text=conditions_template()),
+    Case("filters", filters_context, text=filters_template()),
+    Case("static_text", static_context, text=static_template()),
+    Case("inheritance", inheritance_context, templates=INHERITANCE_TEMPLATES, template_name="page.html"),
+]
+
+
+def timings(fn: typing.Callable, repeat: int) -> typing.List[float]:
+    """Time repeated runs, with garbage collection disabled as timeit does, so that it does not add noise."""
+    result = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            result.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return result
+
+
+def compile_cold(case: Case, search_path: str) -> template_module.Template:
+    """Compile without expressions memoized by earlier runs."""
+    template_module.compile_expr.cache_clear()
+    return case.compile(search_path)
+
+
+def measure_memory(fn: typing.Callable) -> (int, int):
+    """Return (count of memory blocks allocated by fn and still alive after it, peak traced bytes)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        del result
+    finally:
+        tracemalloc.stop()
+    allocations = sum(max(x.count_diff, 0) for x in after.compare_to(before, 'lineno'))
+    return allocations, peak
+
+
+def render_pieces(template: template_module.Template, ctx: dict) -> list:
+    """Render without joining output, so that each piece appended by generated code stays alive to be counted."""
+    output = []
+    for _ in template._bind(ctx)(output, False):
+        pass
+    return output
+
+
+def run_case(case: Case, compile_repeat: int, render_repeat: int, search_path: str) -> dict:
+    template = compile_cold(case, search_path)
+    ctx = case.context()
+    output = template.render(ctx)
+    compile_times = timings(lambda: compile_cold(case, search_path), compile_repeat)
+    render_times = timings(lambda: template.render(ctx), render_repeat)
+    render_allocations, _ = measure_memory(lambda: render_pieces(template, ctx))
+    _, render_peak = measure_memory(lambda: template.render(ctx))
+    _, compile_peak = measure_memory(lambda: compile_cold(case, search_path))
+    return {
+        "template_kb": round(case.size() / 1024, 1),
+        "output_kb": round(len(output) / 1024, 1),
+        # minimum is least disturbed by other processes, median shows the typical run
+        "compile_ms": round(min(compile_times) * 1000, 3),
+        "render_ms": round(min(render_times) * 1000, 3),
+        "render_median_ms": round(statistics.median(render_times) * 1000, 3),
+        "render_allocations": render_allocations,
+        "render_peak_kb": round(render_peak / 1024, 1),
+        "compile_peak_kb": round(compile_peak / 1024, 1),
+    }
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(cases: typing.List[Case], compile_repeat: int = 10, render_repeat: int = 50) -> dict:
+    with tempfile.TemporaryDirectory() as search_path:
+        for name, text in INHERITANCE_TEMPLATES.items():
+            with open(os.path.join(search_path, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+        results = {}
+        for case in cases:
+            results[case.name] = run_case(case, compile_repeat, render_repeat, search_path)
+            print(f"{case.name}: " + ", ".join(f"{k}={v}" for k, v in results[case.name].items()),
+                  file=sys.stderr)
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "implementation": sys.implementation.name,
+        "platform": platform.platform(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "cases": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> typing.List[str]:
+    """Report change of each metric against baseline, return regressions beyond threshold (0.15 for 15%)."""
+    regressions = []
+    print(f"Compare {current.get('commit')} with baseline {baseline.get('commit')}", file=sys.stderr)
+    for case_name, result in current["cases"].items():
+        base = baseline["cases"].get(case_name)
+        if base is None:
+            print(f"  {case_name}: not in baseline", file=sys.stderr)
+            continue
+        for metric in METRICS:
+            if metric not in base or metric not in result:
+                continue
+            old, new = base[metric], result[metric]
+            change = (new - old) / old if old else 0
+            mark = ""
+            if change > threshold:
+                mark = "  REGRESSION"
+                regressions.append(f"{case_name}.{metric}")
+            print(f"  {case_name}.{metric}: {old} -> {new} ({change:+.1%}){mark}", file=sys.stderr)
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark compile and render of the template engine.')
+    parser.add_argument('--cases', default=','.join(x.name for x in CASES),
+                        help='comma separated names of cases to run')
+    parser.add_argument('--compile-repeat', type=int, default=10)
+    parser.add_argument('--render-repeat', type=int, default=50)
+    parser.add_argument('--output', help='write results as JSON to this file, default is stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run, to report changes against')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='relative increase of a metric reported as regression')
+    args = parser.parse_args(argv)
+    names = args.cases.split(',')
+    unknown = set(names) - {x.name for x in CASES}
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(sorted(unknown))}")
+    results = run([x for x in CASES if x.name in names], args.compile_repeat, args.render_repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,41 +1,206 @@
+import html
+import re
+import tempfile
 import time
 
+from ..step05_if_block.template import CodeBuilder, Comment, Expr, For, Template, TemplateEngine, Text, \
+    OUTPUT_VAR, create_control_token, generate_source, tokenize
 
-TIMES = 10000000
 
+def startup_templates(count: int = 500) -> list:
+    """Templates of a few KB each, distinct so that none is shared by the cache."""
+    row = ("<tr><td>{{ loop.index1 }}</td><td>{{ item | upper }}</td>"
+           "{% if flag %}<td>{{ title | strip }}</td>{% else %}<td>-</td>{% endif %}</tr>\n")
+    body = "{% for item in items %}" + row * 20 + "{% endfor %}"
+    return [f"<h1>Page {i}</h1>{{# page {i} #}}\n{body}" for i in range(count)]
 
-def unoptimized_code() -> str:
-    return """
-lines.append("Message 1")
-lines.append("Message 2")
-lines.append("Message 3")
-"""
 
+def bench_startup(count: int = 500):
+    """Time to create all templates of a process: compiled, loaded from disk cache, or cached in memory."""
+    templates = startup_templates(count)
+
+    def load_all(engine):
+        start = time.perf_counter()
+        for text in templates:
+            engine.create(text).code
+        return time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cases = [
+            ("compile", load_all(TemplateEngine())),
+            ("compile and store on disk", load_all(TemplateEngine(cache_dir=cache_dir))),
+            ("load from disk", load_all(TemplateEngine(cache_dir=cache_dir))),
+        ]
+        engine = TemplateEngine()
+        load_all(engine)
+        cases.append(("cached in memory", load_all(engine)))
+    for name, elapsed in cases:
+        print(f"Startup with {count} templates, {name}: {elapsed * 1000:.1f} ms")
+
+
+class LegacyCodeBuilder(CodeBuilder):
+    """Code generation before optimization: an append and a str() per fragment, LoopVar in every loop."""
+    def add_expr(self, expr: str):
+        self.codes.append(f"{OUTPUT_VAR}.append(str({expr}))")
+
+    def add_text(self, text: str):
+        self.codes.append(f"{OUTPUT_VAR}.append({repr(text)})")
 
-def optimized_code() -> str:
-    return """
-c_append = lines.append    
-c_append("Message 1")
-c_append("Message 2")
-c_append("Message 3")
+    def push_control(self, ctrl):
+        if isinstance(ctrl, For):
+            ctrl.loop_used = True
+        super().push_control(ctrl)
+
+
+def render_template() -> str:
+    return """<html><head><title>{{ title | strip }}</title></head>
+<body>
+<h1>{{ title | upper }}</h1>
+<table class="report">
+  <tr><th>#</th><th>Name</th><th>Email</th><th>City</th><th>Score</th><th>Status</th></tr>
+{% for user in users %}  <tr class="row">
+    <td>{{ user.id }}</td><td>{{ user.name | strip }}</td><td>{{ user.email }}</td>
+    <td>{{ user.city | upper }}</td><td>{{ user.score }}</td>
+    <td>{% if show_status %}{{ user.status }}{% else %}-{% endif %}</td>
+    <td>{% for tag in tags %}<span>{{ tag }}</span>{% endfor %}</td>
+  </tr>
+{% endfor %}</table>
+</body></html>
 """
 
 
-def test(fn):
-    start = time.perf_counter()
-    source = fn()
-    code = compile(source, '', 'exec')
-    for i in range(TIMES):
-        lines = []
-        exec(code, None, {"lines": lines})
-        result = '\t'.join(lines)
-    elapsed = time.perf_counter() - start
-    print(f"Execute {fn.__name__} used time: {elapsed}, result: {result}")
+class User:
+    def __init__(self, i: int):
+        self.id = i
+        self.name = f" User {i} "
+        self.email = f"user{i}@example.com"
+        self.city = ["berlin", "paris", "tokyo"][i % 3]
+        self.score = i * 7 % 100
+        self.status = "active" if i % 2 == 0 else "inactive"
+
+
+def bench_render(rows: int = 1000, times: int = 200):
+    """Render a report of rows with code generated before and after optimization."""
+    engine = TemplateEngine()
+    text = render_template()
+    ctx = {"title": " Users ", "users": [User(i) for i in range(rows)], "show_status": True,
+           "tags": ["admin", "staff"]}
+    legacy = Template(text, engine._filters, code=compile(generate_source(text, LegacyCodeBuilder()), '', 'exec'))
+    optimized = engine.create(text)
+    assert legacy.render(ctx) == optimized.render(ctx)
+    results = {}
+    for name, template in [("legacy", legacy), ("optimized", optimized)]:
+        start = time.perf_counter()
+        for _ in range(times):
+            template.render(ctx)
+        results[name] = (time.perf_counter() - start) / times
+        print(f"Render {rows} rows, {name} code: {results[name] * 1000:.2f} ms")
+    print(f"Speedup: {results['legacy'] / results['optimized']:.2f}x")
+
+
+HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&#34;', "'": '&#39;'})
+
+
+def bench_escape(rows: int = 1000, times: int = 200):
+    """Render the report unescaped, autoescaped, and escaped by a filter on every expression."""
+    text = render_template()
+    filtered = re.sub(r'{{(.*?)}}', r'{{\1| html }}', text)
+    translated = re.sub(r'{{(.*?)}}', r'{{\1| translate }}', text)
+    engine = TemplateEngine()
+    engine.register_filter('html', lambda x: html.escape(str(x)))
+    engine.register_filter('translate', lambda x: str(x).translate(HTML_ESCAPE_TABLE))
+    ctx = {"title": " Users & <Friends> ", "users": [User(i) for i in range(rows)], "show_status": True,
+           "tags": ["admin", "staff"]}
+    cases = [
+        ("unescaped", engine.create(text)),
+        ("autoescape", TemplateEngine(autoescape=True).create(text)),
+        ("html.escape filter", engine.create(filtered)),
+        ("translate table filter", engine.create(translated)),
+    ]
+    results = {}
+    for name, template in cases:
+        template.render(ctx)
+        start = time.perf_counter()
+        for _ in range(times):
+            template.render(ctx)
+        results[name] = (time.perf_counter() - start) / times
+        print(f"Render {rows} rows, {name}: {results[name] * 1000:.2f} ms")
+    for name in ("autoescape", "html.escape filter", "translate table filter"):
+        overhead = results[name] - results["unescaped"]
+        print(f"Escaping cost of {name}: {overhead * 1000:.2f} ms")
+
+
+def legacy_parse_expr(text: str) -> (str, list):
+    """Filters peeled one by one from the end with re.search, as before the single-pass parser."""
+    var_name, filters = text, []
+    while True:
+        m = re.search(r'(\|\s*[A-Za-z0-9_]+\s*)$', var_name)
+        if not m:
+            return var_name, filters
+        suffix = m.group(1)
+        filters.insert(0, suffix[1:].strip())
+        var_name = var_name[:-len(suffix)].strip()
+
+
+def legacy_tokenize(text: str) -> list:
+    """Split on tags with re.split then match each segment again, as before the single-pass tokenizer."""
+    tokens = []
+    for segment in re.split(r'({{.*?}}|{#.*?#}|{%.*?%})', text):
+        if not segment:
+            continue
+        if segment.startswith("{{") and segment.endswith("}}"):
+            tokens.append(Expr(*legacy_parse_expr(segment[2:-2].strip())))
+        elif segment.startswith("{%") and segment.endswith("%}"):
+            token = create_control_token(segment[2:-2].strip())
+            token.parse(segment[2:-2].strip())
+            tokens.append(token)
+        elif segment.startswith("{#") and segment.endswith("#}"):
+            tokens.append(Comment(segment[2:-2].strip()))
+        else:
+            tokens.append(Text(segment))
+    return tokens
+
+
+def large_template(size: int = 500 * 1024) -> str:
+    """Generated template of about size characters, with loops, conditions and filters."""
+    block = ("<div class=\"section\">\n  <h2>{{ title | strip | upper }}</h2>\n"
+             "  {# section header #}\n"
+             "  {% for item in items %}<p>{{ item | strip | upper | strip | upper }}</p>\n"
+             "  {% if flag %}<span>{{ note }}</span>{% else %}<span>-</span>{% endif %}{% endfor %}\n"
+             "  <p>" + "Static text of the section. " * 8 + "</p>\n</div>\n")
+    return block * (size // len(block) + 1)
+
+
+def filter_chain_template(size: int = 500 * 1024, filters: int = 20) -> str:
+    """Generated template of about size characters, each expression has a long filter chain."""
+    line = "<p>{{ item | " + " | ".join(["strip", "upper"] * (filters // 2)) + " }}</p>\n"
+    return line * (size // len(line) + 1)
+
+
+def bench_compile(times: int = 5):
+    """Best time to tokenize and compile large templates, with legacy and single-pass tokenizer."""
+    for template_name, text in [("mixed", large_template()), ("filter chains", filter_chain_template())]:
+        assert legacy_tokenize(text) == tokenize(text)
+        cases = [
+            ("legacy tokenize", lambda: legacy_tokenize(text)),
+            ("tokenize", lambda: tokenize(text)),
+            ("generate source", lambda: generate_source(text)),
+            ("compile", lambda: compile(generate_source(text), '', 'exec')),
+        ]
+        for name, fn in cases:
+            elapsed = float('inf')
+            for _ in range(times):
+                start = time.perf_counter()
+                fn()
+                elapsed = min(elapsed, time.perf_counter() - start)
+            print(f"Template of {len(text) // 1024} KB, {template_name}, {name}: {elapsed * 1000:.1f} ms")
 
 
 def main():
-    test(unoptimized_code)
-    test(optimized_code)
+    bench_startup()
+    bench_render()
+    bench_compile()
+    bench_escape()
 
 
 if __name__ == '__main__':
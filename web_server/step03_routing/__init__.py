@@ -1,62 +1,420 @@
+import email.message
+import gzip
+import html
+import http.client
+import http.cookies
+import collections.abc
+import functools
+import ipaddress
+import json
 import logging
+import math
 import os
 import re
+import secrets
+import select
+import stat
+import tempfile
+import threading
+import time
+import typing
 from datetime import datetime
-import mimetypes
-import urllib
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate, parsedate_to_datetime
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
 from io import BytesIO
 
+from .body import CHUNK_SIZE, SPOOL_SIZE, BodyReader, MultipartParser, UploadedFile
+from .errors import HttpError
+from .file_cache import COMPRESSIBLE_TYPES, DirListing, DirListingCache, FileCache, guess_type, stat_etag
+from .limits import ConcurrencyLimiter, RateLimiter
+from .metrics import Metrics
+from .response_cache import CachedResponse, ResponseStore
+from .servers import serve
+from .upstream import Upstream, UpstreamGroup
+
+
+_UNSET = object()
+
 
 class Request:
-    """Provider interface to visit HTTP request information"""
+    """
+    Provider interface to visit HTTP request information.
+    Query, cookies, form and json are parsed at first access, only once per request.
+    Body is read from connection by bounded chunks, large body is spooled to a temporary file.
+    Body can be consumed by one of stream(), body, form/files or json().
+    """
+    MAX_BODY_SIZE = 1024 * 1024 * 1024
+    MAX_FORM_SIZE = 1024 * 1024
+
     def __init__(self, handler: BaseHTTPRequestHandler):
+        self._body = None
+        self._files = None
+        self.reset(handler)
+
+    def reset(self, handler: BaseHTTPRequestHandler):
+        """Clear state of previous request, so that the object can be reused."""
+        if self._body is not None:
+            self._body.close()
+        for uploaded in (self._files or {}).values():
+            uploaded.file.close()
         self._handler = handler
+        self._path = None
+        self._query_text = None
+        self._query = None
+        self._cookies = None
+        self._reader = None
+        self._body = None
+        self._body_size = 0
+        self._form = None
+        self._files = None
+        self._json = _UNSET
+
+    @property
+    def method(self) -> str:
+        return self._handler.command
 
     @property
     def path(self) -> str:
-        path, _ = urllib.parse.splitquery(self._handler.path)
-        return path
+        if self._path is None:
+            self._path, _, self._query_text = self._handler.path.partition('?')
+        return self._path
+
+    @property
+    def target(self) -> str:
+        """Request target as sent by client, path with query."""
+        return self._handler.path
+
+    @property
+    def query(self) -> dict:
+        if self._query is None:
+            self.path
+            self._query = dict(urllib.parse.parse_qsl(self._query_text))
+        return self._query
 
     def query_string(self, key: str, default: str = None) -> str:
-        _, qs = urllib.parse.splitquery(self._handler.path)
-        args = dict(urllib.parse.parse_qsl(qs))
-        return args.get(key, default)
+        return self.query.get(key, default)
+
+    @property
+    def headers(self) -> email.message.Message:
+        return self._handler.headers
+
+    def header(self, key: str, default: str = None) -> str:
+        return self._handler.headers.get(key, default)
+
+    @property
+    def cookies(self) -> dict:
+        if self._cookies is None:
+            cookie = http.cookies.SimpleCookie()
+            try:
+                cookie.load(self.header('Cookie', ''))
+            except http.cookies.CookieError:
+                pass
+            self._cookies = {k: v.value for k, v in cookie.items()}
+        return self._cookies
+
+    @property
+    def client_address(self) -> str:
+        return self._handler.client_address[0]
+
+    @property
+    def received_at(self) -> float:
+        """Time by time.monotonic() when request arrived at server, or None if unknown."""
+        return getattr(self._handler, 'received_at', None)
+
+    def _take_reader(self) -> BodyReader:
+        """Body reader can be taken once, if body has been spooled, it is read again from the spool."""
+        if self._body is not None:
+            self._body.seek(0)
+            return BodyReader(self._body, {'Content-Length': self._body_size})
+        if self._reader is not None:
+            raise RuntimeError('Request body has already been read')
+        self._reader = BodyReader(self._handler.rfile, self._handler.headers, self.MAX_BODY_SIZE)
+        return self._reader
+
+    def stream(self) -> typing.Iterator[bytes]:
+        """Iterate over body chunks as they are received, without buffering the body."""
+        return iter(self._take_reader())
+
+    @property
+    def body(self) -> typing.BinaryIO:
+        """Whole body as a file, kept in memory if small, or spooled to a temporary file."""
+        if self._body is None:
+            spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            for data in self._take_reader():
+                spool.write(data)
+            self._body_size = spool.tell()
+            self._body = spool
+        self._body.seek(0)
+        return self._body
+
+    @property
+    def form(self) -> dict:
+        """Fields of urlencoded or multipart/form-data body, uploaded files are in files."""
+        if self._form is None:
+            self._form, self._files = {}, {}
+            content_type = self.headers.get_content_type()
+            if content_type == 'application/x-www-form-urlencoded':
+                data = self._take_reader().read_all(self.MAX_FORM_SIZE)
+                self._form = dict(urllib.parse.parse_qsl(data.decode('utf8', errors='replace')))
+            elif content_type == 'multipart/form-data':
+                boundary = self.headers.get_param('boundary')
+                if not boundary:
+                    raise HttpError(400, 'Missing multipart boundary')
+                self._form, self._files = MultipartParser(self._take_reader(), boundary).parse()
+        return self._form
+
+    @property
+    def files(self) -> typing.Dict[str, UploadedFile]:
+        if self._files is None:
+            self.form
+        return self._files
+
+    def json(self):
+        if self._json is _UNSET:
+            data = self._take_reader().read_all(self.MAX_FORM_SIZE)
+            try:
+                self._json = json.loads(data) if data else {}
+            except ValueError:
+                raise HttpError(400, 'Invalid JSON body')
+        return self._json
+
+    def drain(self, limit: int) -> bool:
+        """Discard unread body so that next request on the connection can be read.
+           Return False if body is larger than limit or malformed, then connection should be closed."""
+        try:
+            if self._reader is None:
+                self._reader = BodyReader(self._handler.rfile, self._handler.headers)
+            return self._reader.drain(limit)
+        except HttpError:
+            return False
 
 
 class Response:
     """Provide interface to write HTTP response"""
     def __init__(self, handler: BaseHTTPRequestHandler):
-        self._handler = handler
-        self._status = 200
         self._headers = {}
         self._data = BytesIO()
+        self._before_send = []
+        self._after_send = []
+        self.reset(handler)
+
+    def reset(self, handler: BaseHTTPRequestHandler):
+        """Clear state of previous response, containers are emptied rather than reallocated."""
+        self._handler = handler
+        self._status = 200
+        self._headers.clear()
+        self._data.seek(0)
+        self._data.truncate()
+        self._file = None
+        self._stream = None
+        self._before_send.clear()
+        self._after_send.clear()
+        self.sent_bytes = 0
 
     def header(self, key: str, value: str):
         self._headers[key] = value
         return self
 
+    def remove_header(self, key: str):
+        self._headers.pop(key, None)
+        return self
+
+    def get_header(self, key: str) -> str:
+        return self._headers.get(key)
+
+    def get_headers(self) -> dict:
+        return dict(self._headers)
+
     def status(self, code: int):
         self._status = code
         return self
 
+    def get_status(self) -> int:
+        return self._status
+
     def data(self, content: bytes):
         self._data.write(content)
         return self
 
+    def get_data(self) -> bytes:
+        """Return body written by data(), file body is not included."""
+        return self._data.getvalue()
+
+    def replace_data(self, content: bytes):
+        self._data = BytesIO(content)
+        return self
+
+    @property
+    def is_file(self) -> bool:
+        return self._file is not None
+
+    @property
+    def is_stream(self) -> bool:
+        return self._stream is not None
+
+    @property
+    def has_before_send(self) -> bool:
+        """True if before_send callbacks are registered, they may transform the body (such as Compression)."""
+        return bool(self._before_send)
+
+    def before_send(self, callback: typing.Callable, first: bool = False):
+        """Register callback(response) to modify response before it is sent.
+           Callbacks run in order of registration, unless first is set."""
+        if first:
+            self._before_send.insert(0, callback)
+        else:
+            self._before_send.append(callback)
+        return self
+
+    def after_send(self, callback: typing.Callable):
+        """Register callback(response) to run once response has been sent, or sending failed."""
+        self._after_send.append(callback)
+        return self
+
     def html(self, text: str):
         self.data(text.encode('utf8'))
         self._headers.setdefault('Content-Type', 'text/html; charset=utf-8')
         return self
 
+    def stream(self, chunks: typing.Iterable):
+        """Send chunks (bytes or str) as body while they are produced, without buffering the body.
+           Body is sent with chunked transfer encoding, unless Content-Length is set or client is HTTP/1.0."""
+        self._stream = chunks
+        return self
+
+    def events(self, events: typing.Iterable):
+        """Send a stream of server-sent events, each is data str, dict of format_event() arguments,
+           or None to send a comment which keeps idle connection alive."""
+        self._headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+        self._headers['Cache-Control'] = 'no-cache'
+        self._headers['X-Accel-Buffering'] = 'no'
+        return self.stream(format_event(**x) if isinstance(x, dict) else format_event(x) if x is not None
+                           else b':\n\n' for x in events)
+
+    def file(self, f: typing.BinaryIO, count: int, offset: int = 0):
+        """Send count bytes of opened file from offset as body, the file is never read into memory.
+           Response takes ownership of the file and closes it after sent."""
+        self._file = (f, [(offset, count)])
+        return self
+
+    def file_ranges(self, f: typing.BinaryIO, ranges: typing.List[tuple], size: int, content_type: str):
+        """Send ranges [(first, last), ...] of opened file as multipart/byteranges body."""
+        boundary = secrets.token_hex(16)
+        segments = []
+        for first, last in ranges:
+            part_header = (f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                           f'Content-Range: bytes {first}-{last}/{size}\r\n\r\n')
+            segments.append(part_header.encode('latin-1'))
+            segments.append((first, last - first + 1))
+            segments.append(b'\r\n')
+        segments.append(f'--{boundary}--\r\n'.encode('latin-1'))
+        self._headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        self._file = (f, segments)
+        return self
+
     def send(self):
-        self._handler.send_response(self._status)
+        """Send response with Content-Length or chunked framing, so the connection can be kept alive.
+           Response of HEAD request or status 1xx/204/304 has no body."""
+        try:
+            self._send()
+        finally:
+            # Handler which writes body after send() returns, calls finish() itself
+            if not getattr(self._handler, 'deferred_body', False):
+                self.finish()
+
+    def finish(self):
+        """Run after_send callbacks once, when response has been sent or sending failed."""
+        callbacks = list(self._after_send)
+        self._after_send.clear()
+        for callback in callbacks:
+            callback(self)
+
+    def _send(self):
+        for callback in self._before_send:
+            callback(self)
+        handler = self._handler
+        handler.send_response(self._status)
         resp_data = self._data.getvalue()
-        self._headers.setdefault('Content-Length', len(resp_data))
+        has_body = self._status >= 200 and self._status not in (204, 304)
+        chunked = False
+        if has_body and self._stream is not None:
+            if 'Content-Length' not in self._headers:
+                if handler.request_version == 'HTTP/1.1':
+                    chunked = True
+                    self._headers['Transfer-Encoding'] = 'chunked'
+                else:
+                    handler.close_connection = True
+        elif has_body:
+            if self._file:
+                length = sum(len(x) if isinstance(x, bytes) else x[1] for x in self._file[1])
+            else:
+                length = len(resp_data)
+            self._headers.setdefault('Content-Length', length)
+        self._headers.setdefault('Connection', 'close' if handler.close_connection else 'keep-alive')
         for k, v in self._headers.items():
-            self._handler.send_header(k, v)
-        self._handler.end_headers()
-        self._handler.wfile.write(resp_data)
+            handler.send_header(k, v)
+        handler.end_headers()
+        send_body = has_body and handler.command != 'HEAD'
+        if self._stream is not None:
+            if send_body:
+                handler.send_stream(self._stream_frames(chunked))
+            elif hasattr(self._stream, 'close'):
+                self._stream.close()
+        elif send_body:
+            self.sent_bytes = int(self._headers.get('Content-Length', 0))
+        if self._file:
+            f, segments = self._file
+            self._file = None
+            if send_body:
+                handler.send_file(f, segments)
+            else:
+                f.close()
+        elif send_body:
+            handler.wfile.write(resp_data)
+
+    def _stream_frames(self, chunked: bool) -> typing.Generator[bytes, None, None]:
+        """Frame chunks of stream body, the source is closed when done or aborted."""
+        chunks = self._stream
+        self._stream = None
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf8')
+                if not chunk:
+                    continue
+                self.sent_bytes += len(chunk)
+                yield b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk
+            if chunked:
+                yield b'0\r\n\r\n'
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+def format_event(data: str = '', event: str = None, id: str = None, retry: int = None) -> bytes:
+    """Format one server-sent event, multiline data is sent as multiple data fields."""
+    lines = []
+    if event is not None:
+        lines.append(f'event: {event}')
+    if id is not None:
+        lines.append(f'id: {id}')
+    if retry is not None:
+        lines.append(f'retry: {int(retry)}')
+    lines.extend(f'data: {line}' for line in str(data).split('\n'))
+    return ('\n'.join(lines) + '\n\n').encode('utf8')
+
+
+def copy_file(f: typing.BinaryIO, out: typing.BinaryIO, offset: int, count: int, buffer_size: int = 65536):
+    """Copy part of file to output stream through one reused buffer."""
+    buffer = memoryview(bytearray(buffer_size))
+    f.seek(offset)
+    while count > 0:
+        n = f.readinto(buffer[:min(buffer_size, count)])
+        if not n:
+            raise EOFError(f'File truncated, {count} bytes missing')
+        out.write(buffer[:n])
+        count -= n
 
 
 class HttpContext:
@@ -65,69 +423,240 @@ class HttpContext:
         self.request = Request(handler)
         self.response = Response(handler)
         self.error = None
+        self.route = None
+
+    def reset(self, handler: BaseHTTPRequestHandler):
+        self.request.reset(handler)
+        self.response.reset(handler)
+        self.error = None
+        self.route = None
 
 
 class Middleware:
-    """Base class to implement HTTP process middleware."""
+    """
+    Base class to implement HTTP process middleware.
+    Middleware which may block (disk or network I/O, waiting for other requests) sets blocking,
+    then asyncio server runs it in executor rather than in the event loop.
+    """
+    blocking = False
+
     def handle(self, ctx: HttpContext) -> bool:
         """If implemented, it should output response headers & data, and return True.
            The process pipeline will stop iteration when any middleware handled the task."""
         raise NotImplementedError()
 
 
+def parse_range(header: str, size: int, max_ranges: int = 16) -> typing.List[tuple]:
+    """
+    Parse Range header such as 'bytes=0-99,200-,-50' to [(first, last), ...] in file of size.
+    Return None if header is invalid and should be ignored,
+    or an empty list if none of the ranges is satisfiable.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        m = re.fullmatch(r'(\d*)-(\d*)', spec.strip())
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+        first, last = m.groups()
+        if not first:
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        first, last = int(first), int(last) if last else size - 1
+        if m.group(2) and first > last:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    if len(ranges) > max_ranges:
+        return None
+    return ranges
+
+
 class StaticFile(Middleware):
-    def __init__(self, root_path: str):
+    """
+    Serve files under root path.
+    Small files are served from cache, all files are served with ETag and Last-Modified,
+    so that client can validate its copy with a conditional GET.
+    Directory listings are cached and rendered by page.
+    """
+    blocking = True
+
+    PAGE_SIZE = 200
+    MAX_PAGE_SIZE = 5000
+
+    def __init__(self, root_path: str, cache: FileCache = None, listing_cache: DirListingCache = None):
         self._root_path = root_path
+        self._cache = cache or FileCache()
+        self._listing_cache = listing_cache or DirListingCache()
 
     def handle(self, ctx: HttpContext) -> bool:
         full_path = os.path.normpath(self._root_path + ctx.request.path)
-        if os.path.isfile(full_path):
-            self.send_file(ctx.response, full_path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return False
+        ctx.route = '<static>'
+        if stat.S_ISREG(st.st_mode):
+            self.send_file(ctx, full_path, st)
             return True
-        elif os.path.isdir(full_path):
-            if self.process_index(ctx.response, full_path):
+        elif stat.S_ISDIR(st.st_mode):
+            if self.process_index(ctx, full_path):
                 return True
             else:
-                html = self.build_dir_html(full_path)
-                ctx.response.html(html)
+                ctx.response.html(self.build_dir_html(full_path, st, ctx.request))
                 return True
         return False
 
-    def send_file(self, resp: Response, file_path: str):
-        content_type = mimetypes.guess_type(file_path)[0] or 'application/octec-stream'
-        with open(file_path, 'rb') as f:
-            resp.header('Content-Type', content_type).data(f.read())
+    def send_file(self, ctx: HttpContext, file_path: str, st: os.stat_result):
+        """Send file, or its precompressed variant if client accepts gzip.
+           A '.gz' sibling on disk is preferred to the variant compressed in cache."""
+        req, resp = ctx.request, ctx.response
+        resp.header('Accept-Ranges', 'bytes')
+        accept_gzip = req.header('Range') is None and accepts_encoding(req.header('Accept-Encoding'), 'gzip')
+        if accept_gzip:
+            sibling = self.find_gzip_sibling(file_path, st)
+            if sibling:
+                file_path, st = sibling
+                resp.header('Content-Encoding', 'gzip').header('Vary', 'Accept-Encoding')
+                accept_gzip = False
+        entry = self._cache.get(file_path, st)
+        if entry:
+            use_gzip = accept_gzip and entry.gzip_data is not None
+            for k, v in (entry.gzip_headers if use_gzip else entry.headers).items():
+                resp.header(k, v)
+        else:
+            use_gzip = False
+            resp.header('Content-Type', guess_type(file_path))
+            resp.header('ETag', stat_etag(st))
+            resp.header('Last-Modified', formatdate(st.st_mtime, usegmt=True))
+        if self.not_modified(req, resp, st):
+            return
+        ranges = self.requested_ranges(req, resp, st.st_size)
+        if ranges is not None:
+            self.send_ranges(resp, file_path, st.st_size, ranges)
+        elif entry:
+            resp.data(entry.gzip_data if use_gzip else entry.data)
+        else:
+            f = open(file_path, 'rb')
+            resp.file(f, os.fstat(f.fileno()).st_size)
+
+    def find_gzip_sibling(self, file_path: str, st: os.stat_result) -> (str, os.stat_result):
+        """Return (path, stat) of file_path + '.gz' if it exists and is not older than file_path."""
+        gzip_path = file_path + '.gz'
+        try:
+            gzip_st = os.stat(gzip_path)
+        except OSError:
+            return None
+        if stat.S_ISREG(gzip_st.st_mode) and gzip_st.st_mtime >= st.st_mtime:
+            return gzip_path, gzip_st
+        return None
+
+    def requested_ranges(self, req: Request, resp: Response, size: int) -> typing.List[tuple]:
+        """Return ranges requested by Range header, or None if whole file should be sent.
+           Range is ignored if If-Range does not match current ETag or Last-Modified."""
+        range_header = req.header('Range')
+        if range_header is None:
+            return None
+        if_range = req.header('If-Range')
+        if if_range is not None:
+            if if_range.startswith(('"', 'W/')):
+                if if_range != resp.get_header('ETag'):
+                    return None
+            elif if_range != resp.get_header('Last-Modified'):
+                return None
+        return parse_range(range_header, size)
+
+    def send_ranges(self, resp: Response, file_path: str, size: int, ranges: typing.List[tuple]):
+        """Send 206 Partial Content directly from file offsets, or 416 if no range satisfiable."""
+        if not ranges:
+            resp.status(416).header('Content-Range', f'bytes */{size}')
+            return
+        f = open(file_path, 'rb')
+        resp.status(206)
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            resp.header('Content-Range', f'bytes {first}-{last}/{size}').file(f, last - first + 1, first)
+        else:
+            resp.file_ranges(f, ranges, size, resp.get_header('Content-Type'))
+
+    def not_modified(self, req: Request, resp: Response, st: os.stat_result) -> bool:
+        """Set status 304 if client copy is still valid, according to If-None-Match or If-Modified-Since."""
+        if_none_match = req.header('If-None-Match')
+        if if_none_match is not None:
+            etag = resp.get_header('ETag')
+            tags = [x.strip() for x in if_none_match.split(',')]
+            matched = '*' in tags or etag in tags or f'W/{etag}' in tags
+        else:
+            matched = False
+            if_modified_since = req.header('If-Modified-Since')
+            if if_modified_since:
+                try:
+                    matched = int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+                except (TypeError, ValueError):
+                    pass
+        if matched:
+            resp.status(304)
+        return matched
 
-    def process_index(self, resp: Response, dir_path: str) -> bool:
+    def process_index(self, ctx: HttpContext, dir_path: str) -> bool:
         index_names = ['index.html', 'index.htm', 'default.html', 'default.htm']
         for name in index_names:
             index_path = os.path.join(dir_path, name)
-            if os.path.isfile(index_path):
-                self.send_file(resp, index_path)
+            try:
+                st = os.stat(index_path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                self.send_file(ctx, index_path, st)
                 return True
         return False
 
-    def build_dir_html(self, dir_path: str):
+    def build_dir_html(self, dir_path: str, st: os.stat_result, req: Request) -> str:
+        """Render one page of directory listing, as specified by ?offset=&limit=&sort=&order= in query."""
+        listing = self._listing_cache.get(dir_path, st)
+        offset = max(0, query_int(req, 'offset', 0))
+        limit = min(max(1, query_int(req, 'limit', self.PAGE_SIZE)), self.MAX_PAGE_SIZE)
+        sort = req.query_string('sort', 'name')
+        if sort not in DirListing.SORT_KEYS:
+            sort = 'name'
+        order = 'desc' if req.query_string('order') == 'desc' else 'asc'
+
         lines = []
-        lines.append(f"<h1>Direcdtory of {os.path.split(dir_path)[1]}:</h1>")
+        lines.append(f"<h1>Directory of {html.escape(os.path.split(dir_path)[1])}:</h1>")
         lines.append("<hr/>")
         lines.append("<table>")
         lines.append("<thead><tr><th>Name</th><th>Size</th><th>Time</th></tr></thead>")
         lines.append("<tbody>")
-        for file_name in os.listdir(dir_path):
-            full_path = os.path.join(dir_path, file_name)
+        for name, is_dir, size, mtime in listing.page(offset, limit, sort, order == 'desc'):
             lines.append("<tr>")
-            lines.append(f"<td>{file_name}</td>")
-            stat = os.stat(full_path)
-            size_str = str(stat.st_size) if os.path.isfile(full_path) else ""
-            lines.append(f"<td>{size_str}</td>")
-            lines.append(f"<td>{datetime.fromtimestamp(stat.st_mtime)}</td>")
+            lines.append(f"<td>{html.escape(name)}</td>")
+            lines.append(f"<td>{'' if is_dir else size}</td>")
+            lines.append(f"<td>{datetime.fromtimestamp(mtime)}</td>")
             lines.append("</tr>")
         lines.append("</tbody>")
         lines.append("</table>")
+        links = []
+        if offset > 0:
+            links.append((max(0, offset - limit), 'Previous'))
+        if offset + limit < len(listing):
+            links.append((offset + limit, 'Next'))
+        for link_offset, text in links:
+            query = urllib.parse.urlencode({'offset': link_offset, 'limit': limit, 'sort': sort, 'order': order})
+            lines.append(f'<a href="?{html.escape(query)}">{text}</a>')
         return '\n'.join(lines)
 
 
+def query_int(req: Request, key: str, default: int) -> int:
+    try:
+        return int(req.query_string(key, default))
+    except ValueError:
+        return default
+
+
 class Routing(Middleware):
     """
     Implement flask-like routing.
@@ -143,32 +672,105 @@ class Routing(Middleware):
     @routing.route('/user/<name>')
     def index(req, res, name):
         ...
+
+    A handler can also be a generator, the chunks it yields are streamed as response body.
+
+    Routes are matched by priority rather than order of registration: at each segment,
+    a literal segment is tried before segments with path variables (in registration order),
+    and the next one is tried if the rest of path does not match under it.
+    So '/user/new' is matched before '/user/<name>' even if registered after it.
+    A path registered again keeps its first handler.
     """
     def __init__(self):
-        self._routes = []
+        self._static_routes = {}
+        self._root = RouteNode()
 
     def handle(self, ctx: HttpContext) -> bool:
         """Find the matched handler function and execute"""
-        for pattern, handler in self._routes:
-            kwargs = self.match(ctx.request.path, pattern)
-            if kwargs is not None:
-                handler(ctx.request, ctx.response, **kwargs)
-                return True
+        route, handler, kwargs = self.lookup(ctx.request.path)
+        if handler:
+            ctx.route = route
+            result = handler(ctx.request, ctx.response, **kwargs)
+            if isinstance(result, collections.abc.Iterator):
+                ctx.response.stream(result)
+            return True
         return False
 
-    def match(self, url_path: str, pattern: str) -> dict:
-        re_pattern = '^' + re.sub(r'<(\w+)>', r'(?P<\1>\\w+)', pattern) + '$'
-        m = re.match(re_pattern, url_path)
-        return m.groupdict() if m else None
+    def lookup(self, url_path: str) -> (str, typing.Callable, dict):
+        """Return (route, handler, path variables) for url path, or (None, None, None) if not found.
+           Literal routes are resolved by a dict lookup, others by walking the route tree."""
+        handler = self._static_routes.get(url_path)
+        if handler:
+            return url_path, handler, {}
+        kwargs = {}
+        route = self._root.find(url_path.split('/'), 0, kwargs)
+        if route:
+            return route[0], route[1], kwargs
+        return None, None, None
+
+    def add_route(self, path: str, handler: typing.Callable):
+        """Compile route pattern once, so that lookup does not depend on count of routes."""
+        if '<' not in path:
+            self._static_routes.setdefault(path, handler)
+            return
+        node = self._root
+        for segment in path.split('/'):
+            node = node.child(segment)
+        if node.route is None:
+            node.route = (path, handler)
 
     def route(self, path: str):
         """Handler deecorator function."""
         def wrapper(f):
-            self._routes.append((path, f))
+            self.add_route(path, f)
             return f
         return wrapper
 
 
+class RouteNode:
+    """
+    Node of route tree, each level matches one segment of url path.
+    Literal segments are looked up by dict, segments contain path variables
+    (such as <name> or file-<id>) are matched by precompiled regex.
+    """
+    def __init__(self):
+        self.route = None
+        self._literals = {}
+        self._patterns = []
+
+    def child(self, segment: str) -> 'RouteNode':
+        if '<' not in segment:
+            return self._literals.setdefault(segment, RouteNode())
+        parts = re.split(r'<(\w+)>', segment)
+        re_pattern = '^' + ''.join(f'(?P<{x}>\\w+)' if i % 2 else re.escape(x)
+                                   for i, x in enumerate(parts)) + '$'
+        for pattern, node in self._patterns:
+            if pattern.pattern == re_pattern:
+                return node
+        node = RouteNode()
+        self._patterns.append((re.compile(re_pattern), node))
+        return node
+
+    def find(self, segments: typing.List[str], index: int, kwargs: dict) -> tuple:
+        """Return (route path, handler) matching segments, path variables are filled into kwargs."""
+        if index == len(segments):
+            return self.route
+        segment = segments[index]
+        node = self._literals.get(segment)
+        if node:
+            route = node.find(segments, index + 1, kwargs)
+            if route:
+                return route
+        for pattern, node in self._patterns:
+            m = pattern.match(segment)
+            if m:
+                route = node.find(segments, index + 1, kwargs)
+                if route:
+                    kwargs.update(m.groupdict())
+                    return route
+        return None
+
+
 routing = Routing()
 
 
@@ -182,6 +784,385 @@ def username(req, resp, name):
     resp.html(f"<h1>Hello {name}!</h1>")
 
 
+def accepts_encoding(header: str, coding: str) -> bool:
+    """Check if Accept-Encoding header such as 'gzip, deflate;q=0.5' accepts coding."""
+    accepted = None
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if name not in (coding, '*'):
+            continue
+        q = 1.0
+        param, _, value = params.strip().partition('=')
+        if param.strip().lower() == 'q':
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0
+        if name == coding:
+            return q > 0
+        accepted = q > 0
+    return bool(accepted)
+
+
+class Compression(Middleware):
+    """
+    Compress dynamic response with gzip, if client accepts it.
+    Only responses of compressible type and larger than min_size are compressed.
+    File bodies and responses already encoded (such as precompressed static files) are left as is.
+    Counters are kept to tune min_size and level, see stats().
+    """
+    def __init__(self, min_size: int = 1024, level: int = 6):
+        self._min_size = min_size
+        self._level = level
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(['compressed', 'skipped', 'bytes_in', 'bytes_out', 'cpu_time'], 0)
+
+    def handle(self, ctx: HttpContext) -> bool:
+        if accepts_encoding(ctx.request.header('Accept-Encoding'), 'gzip'):
+            ctx.response.before_send(self.compress)
+        return False
+
+    def compress(self, resp: Response):
+        status = resp.get_status()
+        content_type = resp.get_header('Content-Type') or ''
+        data = resp.get_data()
+        if resp.is_file or resp.is_stream or resp.get_header('Content-Encoding') or status < 200 or status in (204, 206, 304) \
+                or len(data) < self._min_size or not content_type.startswith(COMPRESSIBLE_TYPES):
+            self._count(skipped=1)
+            return
+        start = time.thread_time()
+        compressed = gzip.compress(data, self._level, mtime=0)
+        cpu_time = time.thread_time() - start
+        resp.header('Vary', 'Accept-Encoding')
+        if len(compressed) >= len(data):
+            self._count(skipped=1, cpu_time=cpu_time)
+            return
+        # Content-Length set by handler is of uncompressed body, it is computed again when sent
+        resp.replace_data(compressed).remove_header('Content-Length').header('Content-Encoding', 'gzip')
+        etag = resp.get_header('ETag')
+        if etag and etag.endswith('"'):
+            resp.header('ETag', etag[:-1] + '-gz"')
+        self._count(compressed=1, bytes_in=len(data), bytes_out=len(compressed), cpu_time=cpu_time)
+
+    def _count(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._counters[key] += value
+
+    def stats(self) -> dict:
+        with self._lock:
+            result = dict(self._counters)
+        result['bytes_saved'] = result['bytes_in'] - result['bytes_out']
+        return result
+
+
+class ResponseCache(Middleware):
+    """
+    Cache responses of GET/HEAD requests, keyed by path, selected query params and selected headers.
+    Works as a middleware placed before routing (limited to path prefixes if given),
+    or as a decorator of route handlers, see cached().
+    Entries are fresh for ttl seconds, then served stale for another `stale` seconds
+    while the first request after expiry computes a new one.
+    Only responses with status in statuses are cached, except file or stream bodies,
+    responses setting cookies, or marked with Cache-Control no-store/private.
+    """
+    blocking = True
+
+    def __init__(self, ttl: float = 60, stale: float = 0, query: typing.Iterable[str] = None,
+                 headers: typing.Iterable[str] = (), prefixes: typing.Iterable[str] = None,
+                 statuses: typing.Iterable[int] = (200,), store: ResponseStore = None):
+        self._ttl = ttl
+        self._stale = stale
+        self._query = tuple(query) if query is not None else None
+        self._headers = tuple(headers)
+        self._prefixes = tuple(prefixes) if prefixes is not None else None
+        self._statuses = frozenset(statuses)
+        self._store = store if store is not None else ResponseStore()
+
+    def key(self, req: Request) -> tuple:
+        """Without selected query params, the whole query is part of the key."""
+        if self._query is None:
+            query = tuple(sorted(req.query.items()))
+        else:
+            query = tuple(req.query_string(x) for x in self._query)
+        return req.path, query, tuple(req.header(x) for x in self._headers)
+
+    def handle(self, ctx: HttpContext) -> bool:
+        req = ctx.request
+        if req.method not in ('GET', 'HEAD'):
+            return False
+        if self._prefixes is not None and not req.path.startswith(self._prefixes):
+            return False
+        key = self.key(req)
+        entry, leader = self._store.begin(key)
+        if entry:
+            ctx.route = entry.route
+            self.serve(entry, ctx.response)
+            return True
+        ctx.response.before_send(functools.partial(self.capture, key, ctx, leader), first=True)
+        return False
+
+    def cached(self, handler: typing.Callable) -> typing.Callable:
+        """Decorator of route handler, the cache key is taken from request as the middleware does."""
+        @functools.wraps(handler)
+        def wrapper(req: Request, resp: Response, **kwargs):
+            if req.method not in ('GET', 'HEAD'):
+                return handler(req, resp, **kwargs)
+            key = self.key(req)
+            entry, leader = self._store.begin(key)
+            if entry:
+                self.serve(entry, resp)
+                return None
+            try:
+                result = handler(req, resp, **kwargs)
+                if result is None:
+                    self.store(key, resp, None)
+                return result
+            finally:
+                if leader:
+                    self._store.end(key)
+        return wrapper
+
+    def serve(self, entry: CachedResponse, resp: Response):
+        resp.status(entry.status)
+        for k, v in entry.headers.items():
+            resp.header(k, v)
+        resp.header('Age', str(int(time.monotonic() - entry.created)))
+        resp.data(entry.data)
+
+    def capture(self, key: tuple, ctx: HttpContext, leader: bool, resp: Response):
+        """Store response of a miss right before it is sent, ahead of callbacks such as compression."""
+        try:
+            self.store(key, resp, ctx.route)
+        finally:
+            if leader:
+                self._store.end(key)
+
+    def store(self, key: tuple, resp: Response, route: str):
+        if resp.get_status() not in self._statuses or resp.is_file or resp.is_stream:
+            return
+        if resp.get_header('Set-Cookie') or resp.get_header('Content-Encoding'):
+            return
+        cache_control = (resp.get_header('Cache-Control') or '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return
+        entry = CachedResponse(resp.get_status(), resp.get_headers(), resp.get_data(), route,
+                               self._ttl, self._stale)
+        self._store.put(key, entry)
+
+
+HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                                'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'])
+
+
+class Proxy(Middleware):
+    """
+    Forward requests under prefix to a group of upstreams, over their persistent connections.
+    Request and response bodies are streamed by chunks in both directions, never buffered.
+    A request is tried on another upstream if connecting fails, or if a reused connection
+    turns out closed by upstream before anything was received.
+    """
+    blocking = True
+
+    IDEMPOTENT = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+    def __init__(self, prefix: str, upstreams: UpstreamGroup, strip_prefix: bool = False):
+        self._prefix = prefix.rstrip('/')
+        self._upstreams = upstreams
+        self._strip_prefix = strip_prefix
+
+    def handle(self, ctx: HttpContext) -> bool:
+        req = ctx.request
+        if req.path != self._prefix and not req.path.startswith(self._prefix + '/'):
+            return False
+        ctx.route = self._prefix + '/*'
+        url = self.upstream_target(req)
+        headers = self.forward_headers(req)
+        # Body is forwarded in the framing client used, not all upstreams accept chunked request body
+        chunked = 'chunked' in (req.header('Transfer-Encoding') or '').lower()
+        has_body = chunked or req.header('Content-Length') not in (None, '0')
+        tried = []
+        while True:
+            upstream = self._upstreams.choose(tried)
+            if upstream is None:
+                raise HttpError(502 if tried else 503, 'No upstream available')
+            tried.append(upstream)
+            try:
+                conn, reused = upstream.acquire()
+            except TimeoutError:
+                raise HttpError(503, 'Upstream busy', {'Retry-After': '1'})
+            body_sent = False
+            try:
+                conn.putrequest(req.method, url, skip_host=True, skip_accept_encoding=True)
+                for k, v in headers:
+                    conn.putheader(k, v)
+                if chunked:
+                    conn.putheader('Transfer-Encoding', 'chunked')
+                conn.endheaders()
+                if has_body:
+                    body_sent = True
+                    for chunk in req.stream():
+                        conn.send(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                    if chunked:
+                        conn.send(b'0\r\n\r\n')
+                upstream_resp = conn.getresponse()
+            except HttpError:
+                upstream.release(conn, False)
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                upstream.release(conn, False)
+                if reused and not body_sent and isinstance(e, ConnectionError) and req.method in self.IDEMPOTENT:
+                    tried.pop()
+                    continue
+                if isinstance(e, ConnectionRefusedError):
+                    upstream.mark_failed()
+                    continue
+                raise HttpError(502, f'Upstream error: {e!r}')
+            break
+        self.forward_response(req, ctx.response, upstream, conn, upstream_resp)
+        return True
+
+    def upstream_target(self, req: Request) -> str:
+        url = req.target
+        if self._strip_prefix:
+            url = url[len(self._prefix):]
+            if not url.startswith('/'):
+                url = '/' + url
+        return url
+
+    def forward_headers(self, req: Request) -> typing.List[tuple]:
+        """Request headers without hop-by-hop headers, with client address appended to X-Forwarded-For.
+           Content-Length is kept unless body is chunked, which is forwarded chunked."""
+        connection_tokens = {x.strip().lower() for x in (req.header('Connection') or '').split(',')}
+        if 'chunked' in (req.header('Transfer-Encoding') or '').lower():
+            connection_tokens.add('content-length')
+        headers = []
+        forwarded_for = req.client_address
+        for k, v in req.headers.items():
+            name = k.lower()
+            if name in HOP_BY_HOP_HEADERS or name in connection_tokens:
+                continue
+            if name == 'x-forwarded-for':
+                forwarded_for = f'{v}, {forwarded_for}'
+                continue
+            headers.append((k, v))
+        headers.append(('X-Forwarded-For', forwarded_for))
+        return headers
+
+    def forward_response(self, req: Request, resp: Response, upstream: Upstream,
+                         conn: http.client.HTTPConnection, upstream_resp: http.client.HTTPResponse):
+        resp.status(upstream_resp.status)
+        connection_tokens = {x.strip().lower() for x in (upstream_resp.getheader('Connection') or '').split(',')}
+        for k, v in upstream_resp.getheaders():
+            name = k.lower()
+            if name not in HOP_BY_HOP_HEADERS and name not in connection_tokens and name not in ('server', 'date'):
+                resp.header(k, v)
+        if req.method == 'HEAD' or upstream_resp.status in (204, 304) or upstream_resp.status < 200:
+            upstream_resp.close()
+            upstream.release(conn, not upstream_resp.will_close)
+            return
+        resp.stream(self._relay(upstream, conn, upstream_resp))
+
+    def _relay(self, upstream: Upstream, conn: http.client.HTTPConnection,
+               upstream_resp: http.client.HTTPResponse) -> typing.Generator[bytes, None, None]:
+        """Yield body chunks as soon as they are received, connection is reused only if body is complete."""
+        complete = False
+        try:
+            while True:
+                data = upstream_resp.read1(CHUNK_SIZE)
+                if not data:
+                    complete = True
+                    break
+                yield data
+        finally:
+            upstream_resp.close()
+            upstream.release(conn, complete and not upstream_resp.will_close)
+
+
+class RateLimit(Middleware):
+    """
+    Limit request rate of each client by token bucket, client is identified by key(request),
+    by default its address. Requests over the limit are rejected with 429 and Retry-After.
+    """
+    def __init__(self, rate: float, burst: int, key: typing.Callable[[Request], str] = None,
+                 limiter: RateLimiter = None):
+        self._key = key or (lambda req: req.client_address)
+        self._limiter = limiter or RateLimiter(rate, burst)
+        self._lock = threading.Lock()
+        self._rejected = 0
+
+    def handle(self, ctx: HttpContext) -> bool:
+        wait = self._limiter.acquire(self._key(ctx.request))
+        if not wait:
+            return False
+        with self._lock:
+            self._rejected += 1
+        if metrics.enabled:
+            metrics.request_rejected('rate_limit')
+        ctx.response.status(429).header('Retry-After', str(math.ceil(wait))).html('<h1>Too Many Requests</h1>')
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'rejected': self._rejected}
+
+
+class LoadShedding(Middleware):
+    """
+    Limit requests processed concurrently by the middlewares after this one,
+    and shed requests with 503 and Retry-After when queueing delay grows, see ConcurrencyLimiter.
+    Slot of a request is released once its response has been sent, so the pipeline
+    should end with a middleware which always responds, such as NotFound.
+    Waiting for a slot blocks the thread, use aio.AsyncLoadShedding with the asyncio server.
+    """
+    limiter_class = ConcurrencyLimiter
+
+    def __init__(self, max_concurrent: int, target: float = 0.05, interval: float = 0.1,
+                 max_wait: float = 1, retry_after: int = 1):
+        self._limiter = self.limiter_class(max_concurrent, target, interval, max_wait)
+        self._retry_after = retry_after
+        self._lock = threading.Lock()
+        self._rejected = 0
+
+    def handle(self, ctx: HttpContext) -> bool:
+        if self._limiter.acquire(ctx.request.received_at):
+            ctx.response.after_send(lambda resp: self._limiter.release())
+            return False
+        return self.reject(ctx)
+
+    def reject(self, ctx: HttpContext) -> bool:
+        """Respond 503 to a shed request."""
+        with self._lock:
+            self._rejected += 1
+        if metrics.enabled:
+            metrics.request_rejected('overload')
+        ctx.response.status(503).header('Retry-After', str(self._retry_after))
+        ctx.response.html('<h1>Service Unavailable</h1>')
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'rejected': self._rejected, 'dropping': self._limiter.dropping}
+
+
+class MetricsEndpoint(Middleware):
+    """Expose collected metrics at an internal path, only for clients on loopback address."""
+    def __init__(self, metrics_: Metrics, path: str = '/_metrics'):
+        self._metrics = metrics_
+        self._path = path
+
+    def handle(self, ctx: HttpContext) -> bool:
+        if ctx.request.path != self._path or not self._metrics.enabled:
+            return False
+        if not ipaddress.ip_address(ctx.request.client_address).is_loopback:
+            return False
+        ctx.route = self._path
+        ctx.response.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        ctx.response.data(self._metrics.render().encode('utf8'))
+        return True
+
+
 class ServerHeader(Middleware):
     """Output a generic header for all response"""
     def handle(self, ctx: HttpContext) -> bool:
@@ -199,42 +1180,261 @@ class NotFound(Middleware):
 class GenericError(Middleware):
     """Response for generic pipeline error"""
     def handle(self, ctx: HttpContext) -> bool:
+        if isinstance(ctx.error, HttpError):
+            for k, v in ctx.error.headers.items():
+                ctx.response.header(k, v)
+            ctx.response.status(ctx.error.status).html(f'<h1>{html.escape(ctx.error.message)}</h1>')
+            return True
         if ctx.error:
             logging.getLogger('server').error(str(ctx.error))
         ctx.response.status(500).html('<h1>Internal Server Error</h1>')
         return True
 
 
+metrics = Metrics()
+
+
+def create_pipeline() -> (typing.List[Middleware], Middleware):
+    """Define middleware process pipeline, return (middlewares, catchall)"""
+    middlewares = [
+        MetricsEndpoint(metrics),
+        Compression(),
+        routing,
+        StaticFile(os.getcwd() + '/static'),
+        NotFound(),
+    ]
+    return middlewares, GenericError()
+
+
+class Application:
+    """
+    Middleware pipeline built once and shared by all connections.
+    Before hooks run ahead of middlewares, a hook returning True short-circuits the pipeline
+    like a middleware does. After hooks run once the response is decided, before it is sent.
+    HttpContext objects are pooled and reset between requests, to save allocations.
+    """
+    def __init__(self, middlewares: typing.List[Middleware], catchall: Middleware, pool_size: int = 64):
+        self.middlewares = list(middlewares)
+        self.catchall = catchall
+        self._before_hooks = []
+        self._after_hooks = []
+        self._pool = []
+        self._pool_size = pool_size
+
+    def before_request(self, hook: typing.Callable[[HttpContext], bool]):
+        """Register hook(ctx), it can be used as decorator."""
+        self._before_hooks.append(hook)
+        return hook
+
+    def after_request(self, hook: typing.Callable[[HttpContext], None]):
+        """Register hook(ctx), it can be used as decorator."""
+        self._after_hooks.append(hook)
+        return hook
+
+    def acquire(self, handler: BaseHTTPRequestHandler) -> HttpContext:
+        try:
+            ctx = self._pool.pop()
+        except IndexError:
+            return HttpContext(handler)
+        ctx.reset(handler)
+        return ctx
+
+    def release(self, ctx: HttpContext):
+        """Return context to pool, it must not be used by anyone afterwards."""
+        ctx.reset(None)
+        if len(self._pool) < self._pool_size:
+            self._pool.append(ctx)
+
+    def steps(self, ctx: HttpContext) -> typing.Generator[Middleware, bool, bool]:
+        """
+        Pipeline of a request, shared by servers which call middlewares synchronously or in asyncio:
+        each middleware yielded is run by the caller, which sends back whether it handled the request.
+        Return False if none handled it, otherwise after hooks have been run.
+        """
+        for hook in self._before_hooks:
+            if hook(ctx):
+                break
+        else:
+            for middleware in self.middlewares:
+                if (yield middleware):
+                    break
+            else:
+                return False
+        for hook in self._after_hooks:
+            hook(ctx)
+        return True
+
+    def run(self, ctx: HttpContext, middleware_times: list = None) -> bool:
+        """Run pipeline, if middleware_times is given, (name, seconds) of each middleware run is appended."""
+        steps = self.steps(ctx)
+        try:
+            middleware = next(steps)
+            while True:
+                if middleware_times is None:
+                    handled = middleware.handle(ctx)
+                else:
+                    start = time.perf_counter()
+                    handled = middleware.handle(ctx)
+                    middleware_times.append((type(middleware).__name__, time.perf_counter() - start))
+                middleware = steps.send(handled)
+        except StopIteration as e:
+            return e.value
+
+    def dispatch(self, ctx: HttpContext, middleware_times: list = None):
+        """call each middleware to process request.
+           if any error occuried, then use catchall to handle exception."""
+        try:
+            if not self.run(ctx, middleware_times):
+                return
+            ctx.response.send()
+        except Exception as e:
+            ctx.error = e
+            self.catchall.handle(ctx)
+            ctx.response.send()
+
+    def dispatch_with_metrics(self, ctx: HttpContext):
+        """Same as dispatch(), with time of each middleware measured."""
+        metrics.request_started()
+        start = time.perf_counter()
+        middleware_times = []
+        try:
+            self.dispatch(ctx, middleware_times)
+        finally:
+            metrics.request_finished(ctx.route, ctx.response.get_status(), ctx.response.sent_bytes,
+                                     time.perf_counter() - start, middleware_times)
+
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+
+def default_app() -> Application:
+    """Application of create_pipeline(), built at first use."""
+    global _default_app
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = Application(*create_pipeline())
+        return _default_app
+
+
 class RequestDispatcher(BaseHTTPRequestHandler):
+    """
+    Dispatch requests to middlewares of app, which is shared by all connections.
+    Connections are kept alive (HTTP/1.1) if server allows it, until idle for
+    `keep_alive_timeout` seconds, `max_requests` requests have been served, or other
+    connections are waiting for a worker of the server.
+    `timeout` applies to reading of a request once it has started.
+    Pipelined requests are read in order from the buffered input stream.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 15
+    keep_alive_timeout = 2
+    keep_alive_poll = 0.05
+    max_requests = 100
+    max_discard_size = 1024 * 1024
+    disable_nagle_algorithm = True
+
+    app = None
+
     def __init__(self, request, client_address, server):
-        """Define middleware process pipeline"""
-        self._middlewares = [
-            routing,
-            StaticFile(os.getcwd() + '/static'),
-            NotFound(),
-        ]
-        self._catchall = GenericError()
+        self._app = self.app or default_app()
+        self._request_count = 0
         super(RequestDispatcher, self).__init__(request, client_address, server)
 
+    @classmethod
+    def bind(cls, app: Application) -> type:
+        """Return dispatcher class serving requests by app."""
+        return type(cls.__name__, (cls,), {'app': app})
+
     def do_GET(self):
-        """call each middleware to process request.
-           if any error occuried, then use _catchall to handle exception."""
-        ctx = HttpContext(self)
+        """Dispatch request, then discard the part of request body not read by middlewares.
+           Connection is closed if too much body is left, rather than reading it all."""
+        self._request_count += 1
+        self.received_at = time.monotonic()
+        if self._request_count == 1 and hasattr(self.server, 'accepted_at'):
+            self.received_at = self.server.accepted_at() or self.received_at
+        if (self._request_count >= self.max_requests or not getattr(self.server, 'keep_alive', False)
+                or self._others_waiting()):
+            self.close_connection = True
+        ctx = self._app.acquire(self)
         try:
-            for middleware in self._middlewares:
-                if middleware.handle(ctx):
-                    ctx.response.send()
-                    break
+            if metrics.enabled:
+                self._app.dispatch_with_metrics(ctx)
+            else:
+                self._app.dispatch(ctx)
+            if not self.close_connection and not ctx.request.drain(self.max_discard_size):
+                self.close_connection = True
+        finally:
+            self._app.release(ctx)
+
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def handle_one_request(self):
+        if self._request_count and not self._wait_request():
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def _others_waiting(self) -> bool:
+        waiting = getattr(self.server, 'waiting', None)
+        return bool(waiting and waiting())
+
+    def _wait_request(self) -> bool:
+        """Wait until next request of kept alive connection arrives, return False if connection
+           should be closed instead: client closed it, it has been idle for keep_alive_timeout,
+           or other connections are waiting for the worker held by this one."""
+        deadline = time.monotonic() + self.keep_alive_timeout
+        # Non-blocking peek returns pipelined data already buffered, or b'' if nothing has arrived
+        self.connection.settimeout(0)
+        try:
+            while not self.rfile.peek(1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._others_waiting():
+                    return False
+                readable, _, _ = select.select([self.connection], [], [], min(remaining, self.keep_alive_poll))
+                if readable and not self.rfile.peek(1):
+                    return False
+            return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_stream(self, frames: typing.Generator[bytes, None, None]):
+        """Write each frame as soon as it is produced, output stream is not buffered.
+           Headers have been sent, so an error can only be reported by closing the connection."""
+        try:
+            for frame in frames:
+                self.wfile.write(frame)
         except Exception as e:
-            ctx.error = e
-            self._catchall.handle(ctx)
-            ctx.response.send()
+            self.close_connection = True
+            logging.getLogger('server').warning(f'Streaming response aborted: {e!r}')
+        finally:
+            frames.close()
+
+    def send_file(self, f: typing.BinaryIO, segments: list):
+        """Send segments, each is either bytes, or (offset, count) of file.
+           File parts are sent by zero-copy sendfile if supported by system, or copied by chunks."""
+        with f:
+            for segment in segments:
+                if isinstance(segment, bytes):
+                    self.wfile.write(segment)
+                elif hasattr(os, 'sendfile'):
+                    self.connection.sendfile(f, *segment)
+                else:
+                    copy_file(f, self.wfile, *segment)
 
 
-def main():
-    addr = ('', 8080)
-    server = HTTPServer(addr, RequestDispatcher)
-    server.serve_forever()
+def main(mode: str = 'thread', port: int = 8080, workers: int = 16, enable_metrics: bool = False):
+    """Start server, mode can be one of 'single', 'thread', 'prefork' or 'async'.
+       If enable_metrics, metrics are collected and exposed at /_metrics (per process in prefork mode)."""
+    addr = ('', port)
+    metrics.enabled = enable_metrics
+    if mode == 'async':
+        from .aio import serve_async
+        serve_async(addr, Application(*create_pipeline()))
+        return
+    serve(addr, RequestDispatcher.bind(Application(*create_pipeline())), mode=mode, workers=workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,347 @@
+import asyncio
+import http.client
+import logging
+import tempfile
+import time
+import typing
+from email.utils import formatdate
+from http import HTTPStatus
+from io import BytesIO
+
+from . import Application, HttpContext, LoadShedding, Middleware, metrics
+from .body import CHUNK_SIZE, SPOOL_SIZE
+from .errors import HttpError
+from .limits import AsyncConcurrencyLimiter
+
+
+class AsyncMiddleware(Middleware):
+    """Base class of middleware running in asyncio server."""
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+    async def handle(self, ctx: HttpContext) -> bool:
+        raise NotImplementedError()
+
+
+class SyncMiddlewareAdapter(AsyncMiddleware):
+    """
+    Run a synchronous middleware in asyncio server.
+    Middlewares which may block (such as disk I/O) can be run in executor,
+    as_async() does so for middlewares setting Middleware.blocking.
+    """
+    def __init__(self, middleware: Middleware, in_executor: bool = False):
+        self._middleware = middleware
+        self._in_executor = in_executor
+
+    @property
+    def name(self) -> str:
+        return type(self._middleware).__name__
+
+    async def handle(self, ctx: HttpContext) -> bool:
+        if self._in_executor:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._middleware.handle, ctx)
+        return self._middleware.handle(ctx)
+
+
+class AsyncLoadShedding(LoadShedding, AsyncMiddleware):
+    """LoadShedding for asyncio server, requests wait for a slot without blocking the event loop."""
+    limiter_class = AsyncConcurrencyLimiter
+
+    async def handle(self, ctx: HttpContext) -> bool:
+        if await self._limiter.acquire(ctx.request.received_at):
+            ctx.response.after_send(lambda resp: self._limiter.release())
+            return False
+        return self.reject(ctx)
+
+
+def as_async(middleware: Middleware) -> AsyncMiddleware:
+    if isinstance(middleware, AsyncMiddleware):
+        return middleware
+    if isinstance(middleware, LoadShedding):
+        raise TypeError('LoadShedding blocks the event loop while waiting, use AsyncLoadShedding')
+    return SyncMiddlewareAdapter(middleware, in_executor=getattr(middleware, 'blocking', False))
+
+
+class AsyncRequestHandler:
+    """
+    Provide the part of BaseHTTPRequestHandler interface used by Request/Response,
+    so that HttpContext works unchanged. Response data are buffered in wfile
+    and written to the stream after pipeline finished.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Body is written by server after Response.send(), which then calls Response.finish()
+    deferred_body = True
+    server_version = '500lines-async'
+
+    def __init__(self, command: str, path: str, request_version: str,
+                 headers: http.client.HTTPMessage, body: typing.BinaryIO, client_address: tuple):
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.headers = headers
+        self.rfile = body
+        self.wfile = BytesIO()
+        self.file_body = None
+        self.stream_body = None
+        self.client_address = client_address
+        self.received_at = time.monotonic()
+        self.close_connection = not self._keep_alive()
+
+    def _keep_alive(self) -> bool:
+        conn = self.headers.get('Connection', '').lower()
+        if self.request_version == 'HTTP/1.1':
+            return conn != 'close'
+        return conn == 'keep-alive'
+
+    def send_response(self, code: int, message: str = None):
+        if message is None:
+            try:
+                message = HTTPStatus(code).phrase
+            except ValueError:
+                message = ''
+        self.wfile.write(f'{self.protocol_version} {code} {message}\r\n'.encode('latin-1'))
+        self.send_header('Server', self.server_version)
+        self.send_header('Date', formatdate(usegmt=True))
+
+    def send_header(self, key: str, value):
+        if key.lower() == 'connection':
+            self.close_connection = str(value).lower() == 'close'
+        self.wfile.write(f'{key}: {value}\r\n'.encode('latin-1'))
+
+    def end_headers(self):
+        self.wfile.write(b'\r\n')
+
+    def send_file(self, f: typing.BinaryIO, segments: list):
+        """File body is sent by server after headers, with loop.sendfile()"""
+        self.file_body = (f, segments)
+
+    def send_stream(self, frames: typing.Generator[bytes, None, None]):
+        """Stream body is sent by server after headers, each frame is produced in executor."""
+        self.stream_body = frames
+
+
+class AsyncHttpServer:
+    """
+    HTTP/1.1 server based on asyncio streams.
+    Idle keep-alive connections cost no thread, only a suspended coroutine.
+    Requests are processed by the pipeline of app, the same as by the threaded servers,
+    synchronous middlewares are adapted by as_async(), blocking ones are run in executor.
+    """
+    def __init__(self, app: Application, idle_timeout: float = 75, max_requests: int = 1000,
+                 max_header_size: int = 65536, max_body_size: int = 1024 * 1024 * 1024):
+        self._app = app
+        self._adapters = {}
+        self._idle_timeout = idle_timeout
+        self._max_requests = max_requests
+        self._max_header_size = max_header_size
+        self._max_body_size = max_body_size
+
+    def _async(self, middleware: Middleware) -> AsyncMiddleware:
+        adapter = self._adapters.get(middleware)
+        if adapter is None:
+            adapter = self._adapters[middleware] = as_async(middleware)
+        return adapter
+
+    async def run(self, ctx: HttpContext, middleware_times: list = None) -> bool:
+        """Same as Application.run(), with middlewares awaited."""
+        steps = self._app.steps(ctx)
+        try:
+            middleware = next(steps)
+            while True:
+                middleware = self._async(middleware)
+                if middleware_times is None:
+                    handled = await middleware.handle(ctx)
+                else:
+                    start = time.perf_counter()
+                    handled = await middleware.handle(ctx)
+                    middleware_times.append((middleware.name, time.perf_counter() - start))
+                middleware = steps.send(handled)
+        except StopIteration as e:
+            return e.value
+
+    async def dispatch(self, ctx: HttpContext, middleware_times: list = None):
+        """call each middleware to process request.
+           if any error occuried, then use catchall of app to handle exception."""
+        try:
+            if await self.run(ctx, middleware_times):
+                await self.send(ctx)
+        except Exception as e:
+            ctx.error = e
+            await self._async(self._app.catchall).handle(ctx)
+            await self.send(ctx)
+
+    async def send(self, ctx: HttpContext):
+        """Response is sent in executor if before_send callbacks may transform body, such as compressing it."""
+        if ctx.response.has_before_send:
+            await asyncio.get_running_loop().run_in_executor(None, ctx.response.send)
+        else:
+            ctx.response.send()
+
+    async def respond(self, writer: asyncio.StreamWriter, handler: AsyncRequestHandler, ctx: HttpContext,
+                      middleware_times: list = None):
+        """Dispatch request and write response, after_send callbacks run once body has been written."""
+        try:
+            with handler.rfile:
+                await self.dispatch(ctx, middleware_times)
+            writer.write(handler.wfile.getvalue())
+            await writer.drain()
+            if handler.file_body:
+                await self.send_file(writer, *handler.file_body)
+            elif handler.stream_body:
+                await self.send_stream(writer, handler)
+        finally:
+            ctx.response.finish()
+
+    async def respond_with_metrics(self, writer: asyncio.StreamWriter, handler: AsyncRequestHandler,
+                                   ctx: HttpContext):
+        """Same as respond(), latency and bytes sent include writing of body."""
+        metrics.request_started()
+        start = time.perf_counter()
+        middleware_times = []
+        try:
+            await self.respond(writer, handler, ctx, middleware_times)
+        finally:
+            metrics.request_finished(ctx.route, ctx.response.get_status(), ctx.response.sent_bytes,
+                                     time.perf_counter() - start, middleware_times)
+
+    async def read_request(self, reader: asyncio.StreamReader, client_address: tuple) -> AsyncRequestHandler:
+        """Read one request from stream, raise IncompleteReadError if connection closed,
+           or HttpError if request is malformed."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self._idle_timeout)
+        except asyncio.LimitOverrunError:
+            raise HttpError(431)
+        request_line, _, header_data = head.partition(b'\r\n')
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HttpError(400, 'Invalid request line')
+        command, path, version = parts
+        try:
+            headers = http.client.parse_headers(BytesIO(header_data))
+        except http.client.HTTPException:
+            raise HttpError(400, 'Invalid headers')
+        body = await self.read_body(reader, headers)
+        return AsyncRequestHandler(command, path, version, headers, body, client_address)
+
+    async def read_body(self, reader: asyncio.StreamReader, headers: http.client.HTTPMessage) -> typing.BinaryIO:
+        """Read body by bounded chunks into a spool, which is moved to a temporary file when large.
+           Chunked body is decoded, so that the handler always sees a Content-Length body."""
+        body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await reader.readline()
+                try:
+                    size = int(line.split(b';')[0], 16)
+                except ValueError:
+                    raise HttpError(400, 'Invalid chunk size')
+                if not size:
+                    while await reader.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                await self._copy_body(reader, body, size)
+                await reader.readexactly(2)
+            del headers['Transfer-Encoding']
+            headers['Content-Length'] = str(body.tell())
+        else:
+            try:
+                length = int(headers.get('Content-Length') or 0)
+            except ValueError:
+                raise HttpError(400, 'Invalid Content-Length')
+            await self._copy_body(reader, body, length)
+        body.seek(0)
+        return body
+
+    async def _copy_body(self, reader: asyncio.StreamReader, body: typing.BinaryIO, count: int):
+        if body.tell() + count > self._max_body_size:
+            raise HttpError(413)
+        while count > 0:
+            data = await reader.read(min(count, CHUNK_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', count)
+            body.write(data)
+            count -= len(data)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_address = writer.get_extra_info('peername')
+        request_count = 0
+        try:
+            while True:
+                try:
+                    handler = await self.read_request(reader, client_address)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except HttpError as e:
+                    # Rest of input can not be framed, so connection is closed after the error
+                    await self.send_error(writer, e)
+                    break
+                request_count += 1
+                if request_count >= self._max_requests:
+                    handler.close_connection = True
+                # Context is released once body is sent, as stream body still refers to its response
+                ctx = self._app.acquire(handler)
+                try:
+                    if metrics.enabled:
+                        await self.respond_with_metrics(writer, handler, ctx)
+                    else:
+                        await self.respond(writer, handler, ctx)
+                finally:
+                    self._app.release(ctx)
+                if handler.close_connection:
+                    break
+        except (ConnectionError, ValueError) as e:
+            logging.getLogger('server').debug(str(e))
+        finally:
+            writer.close()
+
+    async def send_error(self, writer: asyncio.StreamWriter, error: HttpError):
+        """Respond to a request which could not be read, without running middlewares."""
+        body = error.message.encode('utf8')
+        writer.write(f'HTTP/1.1 {error.status} {HTTPStatus(error.status).phrase}\r\n'
+                     f'Server: {AsyncRequestHandler.server_version}\r\n'
+                     f'Content-Type: text/plain; charset=utf-8\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+
+    async def send_file(self, writer: asyncio.StreamWriter, f: typing.BinaryIO, segments: list):
+        loop = asyncio.get_running_loop()
+        with f:
+            for segment in segments:
+                if isinstance(segment, bytes):
+                    writer.write(segment)
+                    await writer.drain()
+                else:
+                    await loop.sendfile(writer.transport, f, *segment)
+
+    async def send_stream(self, writer: asyncio.StreamWriter, handler: AsyncRequestHandler):
+        """Generator may block between chunks (such as waiting for events), so it is run in executor."""
+        loop = asyncio.get_running_loop()
+        frames = handler.stream_body
+        try:
+            while True:
+                frame = await loop.run_in_executor(None, next, frames, None)
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        except Exception as e:
+            handler.close_connection = True
+            logging.getLogger('server').warning(f'Streaming response aborted: {e!r}')
+        finally:
+            frames.close()
+
+    async def start(self, addr: tuple, backlog: int = 1024) -> asyncio.AbstractServer:
+        """Start listening on addr, port 0 binds a free port."""
+        return await asyncio.start_server(self.handle_connection, addr[0] or None, addr[1],
+                                          backlog=backlog, limit=self._max_header_size)
+
+    async def serve(self, addr: tuple, backlog: int = 1024):
+        server = await self.start(addr, backlog)
+        async with server:
+            await server.serve_forever()
+
+
+def serve_async(addr: tuple, app: Application):
+    server = AsyncHttpServer(app)
+    asyncio.run(server.serve(addr))
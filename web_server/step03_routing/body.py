@@ -0,0 +1,169 @@
+import email.message
+import http.client
+import tempfile
+import typing
+from io import BytesIO
+
+from .errors import HttpError
+
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+MAX_FIELD_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class BodyReader:
+    """
+    Read request body from input stream by chunks of bounded size,
+    body is framed by Content-Length or chunked transfer encoding.
+    """
+    def __init__(self, rfile: typing.BinaryIO, headers: email.message.Message, max_size: int = None):
+        self._rfile = rfile
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self._max_size = max_size
+        self._read_size = 0
+        self._chunk_left = 0
+        self._remaining = 0
+        if not self._chunked:
+            try:
+                self._remaining = int(headers.get('Content-Length') or 0)
+            except ValueError:
+                raise HttpError(400, 'Invalid Content-Length')
+            if max_size is not None and self._remaining > max_size:
+                raise HttpError(413)
+        self.done = not self._chunked and self._remaining == 0
+
+    def read(self, size: int = CHUNK_SIZE) -> bytes:
+        """Read at most size bytes, return b'' at end of body."""
+        if self.done:
+            return b''
+        if self._chunked:
+            data = self._read_chunked(size)
+        else:
+            data = self._rfile.read(min(size, self._remaining))
+            if not data:
+                raise HttpError(400, 'Incomplete request body')
+            self._remaining -= len(data)
+            self.done = self._remaining == 0
+        self._read_size += len(data)
+        if self._max_size is not None and self._read_size > self._max_size:
+            raise HttpError(413)
+        return data
+
+    def _read_chunked(self, size: int) -> bytes:
+        if not self._chunk_left:
+            line = self._rfile.readline(1024)
+            try:
+                self._chunk_left = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise HttpError(400, 'Invalid chunk size')
+            if not self._chunk_left:
+                while self._rfile.readline(MAX_HEADER_SIZE) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.done = True
+                return b''
+        data = self._rfile.read(min(size, self._chunk_left))
+        if not data:
+            raise HttpError(400, 'Incomplete request body')
+        self._chunk_left -= len(data)
+        if not self._chunk_left:
+            self._rfile.readline(1024)
+        return data
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        while True:
+            data = self.read()
+            if not data:
+                break
+            yield data
+
+    def read_all(self, max_size: int) -> bytes:
+        """Read whole body into memory, for small bodies such as form or json."""
+        buffer = BytesIO()
+        for data in self:
+            buffer.write(data)
+            if buffer.tell() > max_size:
+                raise HttpError(413)
+        return buffer.getvalue()
+
+    def drain(self, limit: int) -> bool:
+        """Discard rest of body, return False if more than limit bytes left."""
+        discarded = 0
+        while not self.done and discarded <= limit:
+            discarded += len(self.read())
+        return self.done
+
+
+class UploadedFile:
+    """File part of multipart/form-data body, content is spooled to temporary file when large."""
+    def __init__(self, filename: str, content_type: str):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def read(self) -> bytes:
+        return self.file.read()
+
+
+class MultipartParser:
+    """Parse multipart/form-data body in one streaming pass, never holding a whole file in memory."""
+    def __init__(self, reader: BodyReader, boundary: str):
+        self._reader = reader
+        self._delimiter = b'\r\n--' + boundary.encode('latin-1')
+        self._buffer = bytearray(b'\r\n')
+
+    def _fill(self):
+        data = self._reader.read()
+        if not data:
+            raise HttpError(400, 'Malformed multipart body')
+        self._buffer += data
+
+    def _read_until(self, marker: bytes, write: typing.Callable, max_size: int = None):
+        """Pass data before marker to write(), and consume the marker."""
+        size = 0
+        while True:
+            index = self._buffer.find(marker)
+            if index >= 0:
+                size += index
+                if max_size is not None and size > max_size:
+                    raise HttpError(413)
+                write(bytes(self._buffer[:index]))
+                del self._buffer[:index + len(marker)]
+                return
+            keep = len(marker) - 1
+            if len(self._buffer) > keep:
+                count = len(self._buffer) - keep
+                size += count
+                if max_size is not None and size > max_size:
+                    raise HttpError(413)
+                write(bytes(self._buffer[:count]))
+                del self._buffer[:count]
+            self._fill()
+
+    def parse(self) -> (dict, dict):
+        """Return (fields, files), fields map name to str, files map name to UploadedFile."""
+        fields, files = {}, {}
+        self._read_until(self._delimiter, lambda data: None)
+        while True:
+            while len(self._buffer) < 2:
+                self._fill()
+            if self._buffer[:2] == b'--':
+                self._reader.drain(MAX_HEADER_SIZE)
+                return fields, files
+            header_data = BytesIO()
+            self._read_until(b'\r\n\r\n', header_data.write, MAX_HEADER_SIZE)
+            _, _, header_data = header_data.getvalue().partition(b'\r\n')
+            headers = http.client.parse_headers(BytesIO(header_data + b'\r\n\r\n'))
+            name = headers.get_param('name', header='content-disposition')
+            filename = headers.get_filename()
+            if filename is None:
+                value = BytesIO()
+                self._read_until(self._delimiter, value.write, MAX_FIELD_SIZE)
+                charset = headers.get_content_charset('utf-8')
+                fields[name] = value.getvalue().decode(charset, errors='replace')
+            else:
+                uploaded = UploadedFile(filename, headers.get_content_type())
+                self._read_until(self._delimiter, uploaded.file.write)
+                uploaded.file.seek(0)
+                files[name] = uploaded
@@ -0,0 +1,10 @@
+from http import HTTPStatus
+
+
+class HttpError(Exception):
+    """Error which should be responded with a specific HTTP status, rather than 500."""
+    def __init__(self, status: int, message: str = None, headers: dict = None):
+        self.status = status
+        self.message = message or HTTPStatus(status).phrase
+        self.headers = headers or {}
+        super().__init__(f'{status} {self.message}')
@@ -0,0 +1,161 @@
+import collections
+import gzip
+import hashlib
+import mimetypes
+import operator
+import os
+import threading
+import time
+from email.utils import formatdate
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+
+def guess_type(file_path: str) -> str:
+    return mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+
+
+def stat_etag(st: os.stat_result) -> str:
+    """ETag of file not cached, derived from inode, size and modify time."""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+class CachedFile:
+    """Content of a small static file, with precomputed headers and optional gzip variant."""
+    def __init__(self, file_path: str, st: os.stat_result, data: bytes, gzip_min_size: int):
+        self.key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.mtime = st.st_mtime
+        self.data = data
+        content_type = guess_type(file_path)
+        etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+        self.headers = {
+            'Content-Type': content_type,
+            'ETag': f'"{etag}"',
+            'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+        }
+        self.gzip_data = None
+        self.gzip_headers = None
+        if len(data) >= gzip_min_size and content_type.startswith(COMPRESSIBLE_TYPES):
+            gzip_data = gzip.compress(data, mtime=0)
+            if len(gzip_data) < len(data):
+                self.gzip_data = gzip_data
+                self.headers['Vary'] = 'Accept-Encoding'
+                self.gzip_headers = dict(self.headers, **{
+                    'ETag': f'"{etag}-gz"',
+                    'Content-Encoding': 'gzip',
+                })
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + len(self.gzip_data or b'')
+
+
+class FileCache:
+    """
+    LRU cache of small static files, bounded by entry count and total bytes.
+    An entry is valid as long as inode, size and modify time of the file are unchanged.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024,
+                 max_file_size: int = 1024 * 1024, gzip_min_size: int = 1024):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._max_file_size = max_file_size
+        self._gzip_min_size = gzip_min_size
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, file_path: str, st: os.stat_result) -> CachedFile:
+        """Return cached file, load it if not cached or changed. Return None for large files."""
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry and entry.key == key:
+                self._entries.move_to_end(file_path)
+                return entry
+        if st.st_size > self._max_file_size:
+            return None
+        with open(file_path, 'rb') as f:
+            entry = CachedFile(file_path, os.fstat(f.fileno()), f.read(), self._gzip_min_size)
+        self._put(file_path, entry)
+        return entry
+
+    def _put(self, file_path: str, entry: CachedFile):
+        with self._lock:
+            old = self._entries.pop(file_path, None)
+            if old:
+                self._bytes -= old.size
+            self._entries[file_path] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+
+class DirListing:
+    """
+    Entries of a directory as (name, is_dir, size, mtime) tuples, read by a single os.scandir() pass.
+    Entries are sorted by name, other orders are sorted lazily when first requested.
+    """
+    SORT_KEYS = {'name': 0, 'size': 2, 'mtime': 3}
+
+    def __init__(self, dir_path: str, st: os.stat_result):
+        self.key = (st.st_ino, st.st_mtime_ns)
+        self.loaded_at = time.monotonic()
+        entries = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    entry_st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.name, is_dir, 0 if is_dir else entry_st.st_size, entry_st.st_mtime))
+        entries.sort()
+        self._sorted = {'name': entries}
+
+    def __len__(self):
+        return len(self._sorted['name'])
+
+    def page(self, offset: int, limit: int, sort: str = 'name', reverse: bool = False) -> list:
+        """Return entries of one page, without copying the whole list."""
+        entries = self._sorted.get(sort)
+        if entries is None:
+            entries = sorted(self._sorted['name'], key=operator.itemgetter(self.SORT_KEYS[sort]))
+            self._sorted[sort] = entries
+        if not reverse:
+            return entries[offset:offset + limit]
+        end = max(0, len(entries) - offset)
+        return entries[max(0, end - limit):end][::-1]
+
+
+class DirListingCache:
+    """
+    LRU cache of directory listings, invalidated when modify time of directory changed.
+    Modify time of directory does not change when a file in it is rewritten,
+    so listings are also reloaded after max_age seconds to refresh sizes and times.
+    """
+    def __init__(self, max_entries: int = 64, max_age: float = 10):
+        self._max_entries = max_entries
+        self._max_age = max_age
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dir_path: str, st: os.stat_result) -> DirListing:
+        key = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            listing = self._entries.get(dir_path)
+            if listing and listing.key == key and time.monotonic() - listing.loaded_at < self._max_age:
+                self._entries.move_to_end(dir_path)
+                return listing
+        listing = DirListing(dir_path, st)
+        with self._lock:
+            self._entries[dir_path] = listing
+            self._entries.move_to_end(dir_path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return listing
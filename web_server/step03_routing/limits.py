@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket per client: tokens are refilled at rate per second, up to burst.
+    Buckets of clients not seen recently are evicted beyond max_clients,
+    an evicted client starts again with a full bucket.
+    """
+    def __init__(self, rate: float, burst: int, max_clients: int = 100000):
+        self._rate = rate
+        self._burst = burst
+        self._max_clients = max_clients
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key) -> float:
+        """Take a token of client key, return 0 if taken, or seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self._burst
+                if len(self._buckets) >= self._max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens, updated = bucket
+                tokens = min(self._burst, tokens + (now - updated) * self._rate)
+                self._buckets.move_to_end(key)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self._rate
+
+
+class ConcurrencyLimiter:
+    """
+    Allow at most max_concurrent requests at a time, others wait in queue.
+    Queueing delay is controlled as CoDel does: once delay has stayed above target
+    for a whole interval, the queue is considered standing, and requests are shed after
+    waiting target, until one gets through in less than target.
+    Otherwise requests wait at most max_wait.
+    """
+    def __init__(self, max_concurrent: int, target: float = 0.05, interval: float = 0.1, max_wait: float = 1):
+        self._max_concurrent = max_concurrent
+        self._target = target
+        self._interval = interval
+        self._max_wait = max_wait
+        self._active = 0
+        self._above_since = None
+        self._dropping = False
+        self._cond = threading.Condition()
+
+    @property
+    def dropping(self) -> bool:
+        return self._dropping
+
+    def acquire(self, arrived: float = None) -> bool:
+        """Return True if request can proceed, then release() must be called, or False if shed.
+           Delay is counted from arrived if given, to include time queued before."""
+        start = arrived or time.monotonic()
+        with self._cond:
+            deadline = start + (self._target if self._dropping else self._max_wait)
+            while self._active >= self._max_concurrent:
+                now = time.monotonic()
+                if now >= deadline:
+                    self._observe(now - start, now)
+                    return False
+                self._cond.wait(deadline - now)
+            self._active += 1
+            now = time.monotonic()
+            self._observe(now - start, now)
+            return True
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def _observe(self, delay: float, now: float):
+        if delay < self._target:
+            self._above_since = None
+            self._dropping = False
+        elif self._above_since is None:
+            self._above_since = now
+        elif now - self._above_since >= self._interval:
+            self._dropping = True
+
+
+class AsyncConcurrencyLimiter(ConcurrencyLimiter):
+    """
+    ConcurrencyLimiter for coroutines of one event loop, waiting for a slot does not block the loop.
+    It is not thread safe, release() must be called in the loop as well.
+    """
+    def __init__(self, max_concurrent: int, target: float = 0.05, interval: float = 0.1, max_wait: float = 1):
+        super().__init__(max_concurrent, target, interval, max_wait)
+        self._waiters = collections.deque()
+
+    async def acquire(self, arrived: float = None) -> bool:
+        start = arrived or time.monotonic()
+        deadline = start + (self._target if self._dropping else self._max_wait)
+        while self._active >= self._max_concurrent:
+            now = time.monotonic()
+            if now >= deadline:
+                self._observe(now - start, now)
+                return False
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, deadline - now)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._active += 1
+        now = time.monotonic()
+        self._observe(now - start, now)
+        return True
+
+    def release(self):
+        self._active -= 1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
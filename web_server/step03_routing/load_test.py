@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import http.client
+import io
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import sys
+import threading
+import time
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    """Many concurrent connections need more file descriptors than default soft limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_server(mode: str, port: int, workers: int):
+    """Server process entry, request logs are discarded."""
+    sys.stderr = open(os.devnull, 'w')
+    raise_fd_limit()
+    from . import main
+    main(mode=mode, port=port, workers=workers)
+
+
+def wait_for_port(port: int, timeout: float = 5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'Server not started on port {port}')
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def client(port: int, path: str, count: int, keep_alive: bool, latencies: list, errors: list):
+    conn = None
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            resp.read()
+            if not keep_alive or resp.will_close:
+                conn.close()
+                conn = None
+            latencies.append(time.perf_counter() - start)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(e)
+            if conn:
+                conn.close()
+            conn = None
+    if conn:
+        conn.close()
+
+
+def load(port: int, path: str, concurrency: int, requests: int, keep_alive: bool = False) -> dict:
+    """Issue requests from concurrent client threads, return statistics.
+       With keep_alive, each client reuses its connection as long as server allows."""
+    latencies, errors = [], []
+    per_client = requests // concurrency
+    threads = [threading.Thread(target=client, args=(port, path, per_client, keep_alive, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def summarize(latencies: list, errors: list, elapsed: float) -> dict:
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'mean': (statistics.mean(latencies) if latencies else 0) * 1000,
+    }
+
+
+async def open_connection(port: int, errors: list) -> tuple:
+    try:
+        return await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 30)
+    except (OSError, asyncio.TimeoutError) as e:
+        errors.append(e)
+        return None, None
+
+
+async def connection_client(port: int, path: str, count: int, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter, latencies: list, errors: list):
+    """Issue requests on one connection, reconnect if server does not keep it alive."""
+    request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode('latin-1')
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 30)
+            writer.write(request)
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 30)
+            headers = http.client.parse_headers(io.BytesIO(head.partition(b'\r\n')[2]))
+            await reader.readexactly(int(headers.get('Content-Length', 0)))
+            latencies.append(time.perf_counter() - start)
+            if head.startswith(b'HTTP/1.0') or headers.get('Connection', '').lower() == 'close':
+                writer.close()
+                writer = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            errors.append(e)
+            if writer:
+                writer.close()
+            writer = None
+    if writer:
+        writer.close()
+
+
+async def load_connections(port: int, path: str, connections: int, per_connection: int) -> dict:
+    """Open all connections first, then issue requests on each of them concurrently."""
+    latencies, errors = [], []
+    streams = await asyncio.gather(*[open_connection(port, errors) for _ in range(connections)])
+    start = time.perf_counter()
+    await asyncio.gather(*[connection_client(port, path, per_connection, reader, writer, latencies, errors)
+                           for reader, writer in streams])
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def report(mode: str, stats: dict):
+    print(f"{mode:10} requests={stats['requests']} errors={stats['errors']} "
+          f"rps={stats['rps']:.1f} p50={stats['p50']:.2f}ms p99={stats['p99']:.2f}ms")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Load test web server in each concurrency mode.')
+    parser.add_argument('--modes', default='single,thread,prefork')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--path', default='/user/alice')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='reuse connection for requests of each client')
+    parser.add_argument('--connections', default='',
+                        help='comma separated counts of concurrent connections, e.g. 1000,5000,10000')
+    parser.add_argument('--per-connection', type=int, default=5)
+    args = parser.parse_args(argv)
+    raise_fd_limit()
+
+    for mode in args.modes.split(','):
+        port = free_port()
+        server = multiprocessing.Process(target=run_server, args=(mode, port, args.workers), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            if args.connections:
+                for count in args.connections.split(','):
+                    stats = asyncio.run(load_connections(port, args.path, int(count), args.per_connection))
+                    report(f'{mode}/{count}', stats)
+            else:
+                stats = load(port, args.path, args.concurrency, args.requests, args.keep_alive)
+                report(mode, stats)
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import bisect
+import collections
+import threading
+
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """Count of observed values in fixed buckets, the last bucket is +Inf."""
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate quantile by linear interpolation inside the bucket containing it."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+def format_labels(**labels) -> str:
+    items = []
+    for k, v in labels.items():
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append(f'{k}="{v}"')
+    return '{' + ','.join(items) + '}'
+
+
+class Metrics:
+    """
+    Collect per-request statistics: latency of each middleware and route, status,
+    bytes sent and requests in flight. Rendered in Prometheus plain text format.
+    Nothing is collected unless enabled, dispatcher checks the flag once per request.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._middleware_seconds = collections.defaultdict(Histogram)
+        self._route_seconds = collections.defaultdict(Histogram)
+        self._requests = collections.Counter()
+        self._bytes_sent = collections.Counter()
+        self._rejected = collections.Counter()
+        self._in_flight = 0
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self, route: str, status: int, bytes_sent: int, elapsed: float,
+                         middleware_times: list):
+        """Record a finished request, middleware_times is a list of (middleware name, seconds)."""
+        route = route or '<unrouted>'
+        with self._lock:
+            self._in_flight -= 1
+            self._route_seconds[route].observe(elapsed)
+            self._requests[(route, status)] += 1
+            self._bytes_sent[route] += bytes_sent
+            for name, seconds in middleware_times:
+                self._middleware_seconds[name].observe(seconds)
+
+    def request_rejected(self, reason: str):
+        """Record a request rejected by rate limit or load shedding."""
+        with self._lock:
+            self._rejected[reason] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines.append('# TYPE http_requests_in_flight gauge')
+            lines.append(f'http_requests_in_flight {self._in_flight}')
+            lines.append('# TYPE http_requests_total counter')
+            for (route, status), count in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{format_labels(route=route, status=status)} {count}')
+            lines.append('# TYPE http_requests_rejected_total counter')
+            for reason, count in sorted(self._rejected.items()):
+                lines.append(f'http_requests_rejected_total{format_labels(reason=reason)} {count}')
+            lines.append('# TYPE http_response_bytes_total counter')
+            for route, count in sorted(self._bytes_sent.items()):
+                lines.append(f'http_response_bytes_total{format_labels(route=route)} {count}')
+            lines.append('# TYPE http_request_duration_seconds summary')
+            for route, hist in sorted(self._route_seconds.items()):
+                for q in QUANTILES:
+                    labels = format_labels(route=route, quantile=q)
+                    lines.append(f'http_request_duration_seconds{labels} {hist.quantile(q):.6f}')
+                lines.append(f'http_request_duration_seconds_sum{format_labels(route=route)} {hist.sum:.6f}')
+                lines.append(f'http_request_duration_seconds_count{format_labels(route=route)} {hist.count}')
+            lines.append('# TYPE http_middleware_duration_seconds histogram')
+            for name, hist in sorted(self._middleware_seconds.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                    cumulative += count
+                    labels = format_labels(middleware=name, le=bound)
+                    lines.append(f'http_middleware_duration_seconds_bucket{labels} {cumulative}')
+                lines.append(f'http_middleware_duration_seconds_sum{format_labels(middleware=name)} {hist.sum:.6f}')
+                lines.append(f'http_middleware_duration_seconds_count{format_labels(middleware=name)} {hist.count}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,138 @@
+import email.message
+import io
+import re
+import time
+import tracemalloc
+
+from . import Application, HttpContext, Routing, create_pipeline
+
+
+ROUTE_COUNT = 1000
+LOOKUP_TIMES = 100000
+
+
+def build_routing() -> Routing:
+    """Register half literal and half parameterized routes."""
+    routing = Routing()
+    for i in range(ROUTE_COUNT // 2):
+        routing.add_route(f'/static/page{i}', lambda req, resp: None)
+        routing.add_route(f'/api/v{i}/user/<name>', lambda req, resp, name: None)
+    return routing
+
+
+def linear_match(patterns: list, url_path: str) -> dict:
+    """Route matching before precompiled route table, kept for comparison."""
+    for pattern in patterns:
+        re_pattern = '^' + re.sub(r'<(\w+)>', r'(?P<\1>\\w+)', pattern) + '$'
+        m = re.match(re_pattern, url_path)
+        if m:
+            return m.groupdict()
+    return None
+
+
+def bench_routing():
+    routing = build_routing()
+    paths = [f'/static/page{ROUTE_COUNT // 2 - 1}',
+             f'/api/v{ROUTE_COUNT // 2 - 1}/user/alice',
+             '/not/found']
+    for path in paths:
+        start = time.perf_counter()
+        for i in range(LOOKUP_TIMES):
+            routing.lookup(path)
+        elapsed = time.perf_counter() - start
+        print(f"Lookup {path} in {ROUTE_COUNT} routes: {elapsed / LOOKUP_TIMES * 1e6:.3f} us/request")
+
+    patterns = []
+    for i in range(ROUTE_COUNT // 2):
+        patterns.append(f'/static/page{i}')
+        patterns.append(f'/api/v{i}/user/<name>')
+    times = LOOKUP_TIMES // 1000
+    for path in paths:
+        start = time.perf_counter()
+        for i in range(times):
+            linear_match(patterns, path)
+        elapsed = time.perf_counter() - start
+        print(f"Linear match {path} in {ROUTE_COUNT} routes: {elapsed / times * 1e6:.3f} us/request")
+
+
+class FakeHandler:
+    """Part of BaseHTTPRequestHandler used by Request/Response, to dispatch without network.
+       When response headers are complete, allocations made since clear_traces() are counted."""
+    command = 'GET'
+    request_version = 'HTTP/1.1'
+    client_address = ('127.0.0.1', 0)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.headers = email.message.Message()
+        self.rfile = io.BytesIO()
+        self.wfile = io.BytesIO()
+        self.close_connection = False
+        self.live_blocks = 0
+
+    def send_response(self, code: int):
+        pass
+
+    def send_header(self, key: str, value):
+        pass
+
+    def end_headers(self):
+        if tracemalloc.is_tracing():
+            self.live_blocks = sum(x.count for x in tracemalloc.take_snapshot().statistics('filename'))
+
+
+def legacy_dispatch(handler: FakeHandler, middlewares: list = None):
+    """Dispatch before Application: pipeline was built for each connection, context for each request."""
+    if middlewares is None:
+        middlewares, _ = create_pipeline()
+    ctx = HttpContext(handler)
+    for middleware in middlewares:
+        if middleware.handle(ctx):
+            ctx.response.send()
+            break
+
+
+def measure_allocations(dispatch, times: int = 200) -> (float, float):
+    """Return average (blocks allocated and alive when response is sent, peak bytes) per request."""
+    blocks = peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(times):
+            handler = FakeHandler(f'/user/u{i}?x=1')
+            tracemalloc.clear_traces()
+            tracemalloc.reset_peak()
+            dispatch(handler)
+            peak += tracemalloc.get_traced_memory()[1]
+            blocks += handler.live_blocks
+    finally:
+        tracemalloc.stop()
+    return blocks / times, peak / times
+
+
+def bench_allocations():
+    app = Application(*create_pipeline())
+
+    def pooled_dispatch(handler):
+        ctx = app.acquire(handler)
+        app.dispatch(ctx)
+        app.release(ctx)
+
+    middlewares, _ = create_pipeline()
+    cases = [
+        ('pipeline per connection', legacy_dispatch),
+        ('context per request', lambda handler: legacy_dispatch(handler, middlewares)),
+        ('application with pool', pooled_dispatch),
+    ]
+    for name, dispatch in cases:
+        dispatch(FakeHandler('/'))
+        blocks, peak = measure_allocations(dispatch)
+        print(f"Allocations of {name}: {blocks:.1f} live blocks, {peak / 1024:.1f} KB peak per request")
+
+
+def main():
+    bench_routing()
+    bench_allocations()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import collections
+import threading
+import time
+
+
+class CachedResponse:
+    """Status, headers and body of a response, fresh until expires and usable as stale until stale_until."""
+    def __init__(self, status: int, headers: dict, data: bytes, route: str, ttl: float, stale: float):
+        self.status = status
+        self.headers = headers
+        self.data = data
+        self.route = route
+        self.created = time.monotonic()
+        self.expires = self.created + ttl
+        self.stale_until = self.expires + stale
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + sum(len(k) + len(str(v)) for k, v in self.headers.items())
+
+
+class ResponseStore:
+    """
+    LRU store of cached responses, bounded by entry count and total bytes.
+    Misses of the same key are single-flight: the first request (the leader) computes
+    the response while others wait for it, or are served the stale entry if there is one.
+    A leader which does not finish in wait_timeout seconds is replaced.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 32 * 1024 * 1024,
+                 max_entry_size: int = 1024 * 1024, wait_timeout: float = 5):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._max_entry_size = max_entry_size
+        self._wait_timeout = wait_timeout
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self, key) -> (CachedResponse, bool):
+        """
+        Return (entry, False) if entry can be served,
+        or (None, True) if caller is the leader which should compute the response and then call end(),
+        or (None, False) if caller should compute the response without being waited for.
+        """
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and now < entry.expires:
+                    self._entries.move_to_end(key)
+                    return entry, False
+                leader = self._inflight.get(key)
+                if leader is None or now - leader[1] > self._wait_timeout:
+                    self._inflight[key] = (threading.Event(), now)
+                    return None, True
+                if entry and now < entry.stale_until:
+                    return entry, False
+                event, started = leader
+            if not event.wait(self._wait_timeout - (now - started)):
+                return None, False
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            if time.monotonic() < entry.stale_until:
+                return entry, False
+
+    def end(self, key):
+        """Leader finished, whether the response was stored or not, wake up requests waiting for it."""
+        with self._lock:
+            leader = self._inflight.pop(key, None)
+        if leader:
+            leader[0].set()
+
+    def put(self, key, entry: CachedResponse):
+        if entry.size > self._max_entry_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
@@ -0,0 +1,122 @@
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from http.server import HTTPServer
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    Process requests by a fixed number of worker threads.
+    Accepted connections wait in a bounded queue, when the queue is full
+    the connection is closed immediately rather than piling up.
+    Listen backlog is at least queue_size, so that bursts of connections are queued rather than dropped by kernel.
+    """
+    def __init__(self, server_address, handler_class, workers: int = 16, queue_size: int = 128,
+                 backlog: int = 1024):
+        self.request_queue_size = max(backlog, queue_size)
+        super().__init__(server_address, handler_class)
+        self._queue = queue.Queue(queue_size)
+        self._local = threading.local()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._process_queue, name=f'http-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            self.shutdown_request(request)
+
+    def _process_queue(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            request, client_address, self._local.accepted_at = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def waiting(self) -> int:
+        """Number of accepted connections waiting for a worker, workers close kept alive connections when any."""
+        return self._queue.qsize()
+
+    def accepted_at(self) -> float:
+        """Time when the connection processed by current worker was accepted, it includes time in queue."""
+        return getattr(self._local, 'accepted_at', None)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+def serve_prefork(server: HTTPServer, processes: int):
+    """Fork worker processes which accept connections from the same listening socket."""
+    pids = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        server.server_close()
+
+
+def serve(addr: tuple, handler_class, mode: str = 'thread', workers: int = 16, queue_size: int = 128,
+          backlog: int = 1024):
+    """
+    Run server in specified concurrency mode:
+    - single: handle one connection at a time
+    - thread: handle connections by a bounded thread pool
+    - prefork: handle connections by forked processes, shares the listening socket
+    Only thread mode keeps connections alive, because a worker of other modes
+    can not serve other clients while waiting on an idle connection.
+    Listen backlog is the same in all modes (and the asyncio server), so that they are compared fairly.
+    """
+    if mode in ('single', 'prefork'):
+        server = HTTPServer(addr, handler_class, bind_and_activate=False)
+        server.request_queue_size = backlog
+        try:
+            server.server_bind()
+            server.server_activate()
+        except OSError:
+            server.server_close()
+            raise
+    elif mode == 'thread':
+        server = ThreadPoolHTTPServer(addr, handler_class, workers=workers, queue_size=queue_size,
+                                      backlog=backlog)
+    else:
+        raise ValueError(f'Unknown server mode: {mode}')
+    server.keep_alive = mode == 'thread'
+    if mode == 'prefork':
+        serve_prefork(server, workers)
+        return
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,1256 @@
+import asyncio
+import collections
+import email
+import email.policy
+import gzip
+import http.client
+import mimetypes
+import io
+import json
+import os
+import re
+import resource
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from . import Application, RequestDispatcher, Routing, StaticFile, NotFound, GenericError, Compression, MetricsEndpoint, \
+    LoadShedding, Middleware, Proxy, RateLimit, ResponseCache, accepts_encoding, copy_file, parse_range
+from .aio import AsyncHttpServer, AsyncLoadShedding, as_async
+from .file_cache import FileCache
+from .limits import AsyncConcurrencyLimiter, ConcurrencyLimiter, RateLimiter
+from .metrics import Histogram, Metrics
+from .response_cache import CachedResponse, ResponseStore
+from .servers import ThreadPoolHTTPServer
+from .upstream import Upstream, UpstreamGroup
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class CountingWriter(io.RawIOBase):
+    def __init__(self):
+        self.count = 0
+
+    def write(self, b):
+        self.count += len(b)
+        return len(b)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Run server on a temporary static directory, in a background thread."""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.app = Application(self.middlewares(), GenericError())
+        self.server = self.start_server(self.app)
+
+    def start_server(self, app: Application, workers: int = 8) -> ThreadPoolHTTPServer:
+        server = ThreadPoolHTTPServer(('127.0.0.1', 0), RequestDispatcher.bind(app), workers=workers)
+        server.keep_alive = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def middlewares(self) -> list:
+        return [StaticFile(self.root), NotFound()]
+
+    def write_file(self, name: str, data: bytes = b'', size: int = None) -> str:
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+            if size is not None:
+                f.truncate(size)
+        return path
+
+    def request(self, path: str, method: str = 'GET', headers: dict = None, body=None,
+                conn: http.client.HTTPConnection = None) -> http.client.HTTPResponse:
+        if conn is None:
+            conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+            self.addCleanup(conn.close)
+        conn.request(method, path, body=body, headers=headers or {}, encode_chunked=bool(headers and
+                     headers.get('Transfer-Encoding') == 'chunked'))
+        return conn.getresponse()
+
+
+class RoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.routing = Routing()
+
+    def add(self, path: str):
+        self.routing.add_route(path, lambda req, resp, **kwargs: path)
+
+    def lookup(self, url_path: str) -> (str, dict):
+        route, _, kwargs = self.routing.lookup(url_path)
+        return route, kwargs
+
+    def test_literal_before_pattern(self):
+        self.add('/user/<name>')
+        self.add('/user/new')
+        self.assertEqual(('/user/new', {}), self.lookup('/user/new'))
+        self.assertEqual(('/user/<name>', {'name': 'alice'}), self.lookup('/user/alice'))
+
+    def test_fallback_to_pattern_when_literal_fails_deeper(self):
+        self.add('/user/new/form')
+        self.add('/user/<name>/profile')
+        self.assertEqual(('/user/new/form', {}), self.lookup('/user/new/form'))
+        self.assertEqual(('/user/<name>/profile', {'name': 'new'}), self.lookup('/user/new/profile'))
+        self.assertEqual((None, None), self.lookup('/user/new/other'))
+
+    def test_mixed_segment(self):
+        self.add('/files/file-<id>.<ext>')
+        self.add('/files/<name>')
+        self.assertEqual(('/files/file-<id>.<ext>', {'id': '12', 'ext': 'txt'}), self.lookup('/files/file-12.txt'))
+        self.assertEqual(('/files/<name>', {'name': 'readme'}), self.lookup('/files/readme'))
+        self.assertEqual((None, None), self.lookup('/files/file-12'))
+
+    def test_duplicate_registration_keeps_first(self):
+        self.routing.add_route('/a', lambda req, resp: 1)
+        self.routing.add_route('/a', lambda req, resp: 2)
+        self.routing.add_route('/b/<x>', lambda req, resp, x: 1)
+        self.routing.add_route('/b/<x>', lambda req, resp, x: 2)
+        self.assertEqual(1, self.routing.lookup('/a')[1](None, None))
+        self.assertEqual(1, self.routing.lookup('/b/y')[1](None, None, x='y'))
+
+    def test_not_found(self):
+        self.add('/user/<name>')
+        self.assertEqual((None, None), self.lookup('/user'))
+        self.assertEqual((None, None), self.lookup('/user/a/b'))
+
+
+class StaticFileTest(ServerTestCase):
+    def test_small_file(self):
+        self.write_file('hello.txt', b'Hello')
+        resp = self.request('/hello.txt')
+        self.assertEqual(200, resp.status)
+        self.assertEqual('5', resp.getheader('Content-Length'))
+        self.assertEqual(b'Hello', resp.read())
+
+    def test_head(self):
+        self.write_file('hello.txt', b'Hello')
+        resp = self.request('/hello.txt', method='HEAD')
+        self.assertEqual('5', resp.getheader('Content-Length'))
+        self.assertEqual(b'', resp.read())
+
+    def test_large_sparse_file_bounded_memory(self):
+        size = 3 * 1024 * 1024 * 1024
+        self.write_file('large.bin', size=size)
+        rss_before = peak_rss_mb()
+        resp = self.request('/large.bin')
+        self.assertEqual(str(size), resp.getheader('Content-Length'))
+        received, buffer = 0, bytearray(1024 * 1024)
+        while True:
+            n = resp.readinto(buffer)
+            if not n:
+                break
+            received += n
+        self.assertEqual(size, received)
+        self.assertLess(peak_rss_mb() - rss_before, 64)
+
+    def test_copy_file_fallback_bounded_memory(self):
+        size = 1024 * 1024 * 1024
+        path = self.write_file('large.bin', size=size)
+        rss_before = peak_rss_mb()
+        out = CountingWriter()
+        with open(path, 'rb') as f:
+            copy_file(f, out, 100, size - 100)
+        self.assertEqual(size - 100, out.count)
+        self.assertLess(peak_rss_mb() - rss_before, 64)
+
+
+class ConditionalGetTest(ServerTestCase):
+    def test_etag(self):
+        self.write_file('hello.txt', b'Hello')
+        resp = self.request('/hello.txt')
+        resp.read()
+        etag = resp.getheader('ETag')
+        self.assertTrue(etag)
+        self.assertTrue(resp.getheader('Last-Modified'))
+        resp = self.request('/hello.txt', headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status)
+        self.assertEqual(b'', resp.read())
+        resp = self.request('/hello.txt', headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, resp.status)
+
+    def test_if_modified_since(self):
+        self.write_file('hello.txt', b'Hello')
+        resp = self.request('/hello.txt')
+        resp.read()
+        last_modified = resp.getheader('Last-Modified')
+        resp = self.request('/hello.txt', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, resp.status)
+        resp = self.request('/hello.txt', headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(200, resp.status)
+
+    def test_uncached_large_file_etag(self):
+        self.write_file('large.bin', size=2 * 1024 * 1024)
+        resp = self.request('/large.bin')
+        resp.read()
+        resp = self.request('/large.bin', headers={'If-None-Match': resp.getheader('ETag')})
+        self.assertEqual(304, resp.status)
+
+    def test_cache_invalidated_when_changed(self):
+        self.write_file('hello.txt', b'Hello')
+        self.assertEqual(b'Hello', self.request('/hello.txt').read())
+        self.write_file('hello.txt', b'Hello again')
+        self.assertEqual(b'Hello again', self.request('/hello.txt').read())
+
+    def test_gzip_variant(self):
+        data = b'body { color: red; }\n' * 100
+        self.write_file('site.css', data)
+        resp = self.request('/site.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', resp.getheader('Content-Encoding'))
+        self.assertEqual(data, gzip.decompress(resp.read()))
+        resp = self.request('/site.css')
+        self.assertIsNone(resp.getheader('Content-Encoding'))
+        self.assertEqual(data, resp.read())
+
+
+class RangeTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = bytes(range(256)) * 4
+        self.write_file('data.bin', self.data)
+        self.write_file('large.bin', self.data * 2048)
+
+    def test_single_range(self):
+        for name, data in [('data.bin', self.data), ('large.bin', self.data * 2048)]:
+            resp = self.request(f'/{name}', headers={'Range': 'bytes=10-19'})
+            self.assertEqual(206, resp.status)
+            self.assertEqual(f'bytes 10-19/{len(data)}', resp.getheader('Content-Range'))
+            self.assertEqual(data[10:20], resp.read())
+
+    def test_suffix_range(self):
+        resp = self.request('/data.bin', headers={'Range': 'bytes=-5'})
+        self.assertEqual(206, resp.status)
+        self.assertEqual(self.data[-5:], resp.read())
+
+    def test_multiple_ranges(self):
+        resp = self.request('/data.bin', headers={'Range': 'bytes=0-1,100-'})
+        self.assertEqual(206, resp.status)
+        content_type = resp.getheader('Content-Type')
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        message = email.message_from_bytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + resp.read(),
+            policy=email.policy.HTTP)
+        parts = [(x['Content-Range'], x.get_payload(decode=True)) for x in message.iter_parts()]
+        self.assertEqual([
+            ('bytes 0-1/1024', self.data[0:2]),
+            ('bytes 100-1023/1024', self.data[100:]),
+        ], parts)
+
+    def test_unsatisfiable(self):
+        resp = self.request('/data.bin', headers={'Range': 'bytes=2000-'})
+        self.assertEqual(416, resp.status)
+        self.assertEqual('bytes */1024', resp.getheader('Content-Range'))
+
+    def test_if_range(self):
+        resp = self.request('/data.bin')
+        resp.read()
+        etag = resp.getheader('ETag')
+        resp = self.request('/data.bin', headers={'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual(206, resp.status)
+        resp.read()
+        resp = self.request('/data.bin', headers={'Range': 'bytes=0-9', 'If-Range': '"changed"'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(self.data, resp.read())
+
+    def test_parse_range(self):
+        cases = [
+            ('bytes=0-9', [(0, 9)]),
+            ('bytes=90-', [(90, 99)]),
+            ('bytes=-10', [(90, 99)]),
+            ('bytes=50-200', [(50, 99)]),
+            ('bytes=0-0, 10-19', [(0, 0), (10, 19)]),
+            ('bytes=100-', []),
+            ('bytes=9-0', None),
+            ('bytes=abc', None),
+            ('items=0-9', None),
+        ]
+        for header, expected in cases:
+            self.assertEqual(expected, parse_range(header, 100), header)
+
+
+class CompressionTest(ServerTestCase):
+    def middlewares(self) -> list:
+        self.compression = Compression(min_size=100)
+        routing = Routing()
+        routing.add_route('/text/<count>', lambda req, resp, count: resp.html('Hello ' * int(count)))
+        routing.add_route('/sized/<count>', lambda req, resp, count: resp.html('Hello ' * int(count))
+                          .header('Content-Length', len('Hello ' * int(count))))
+        return [self.compression, routing, StaticFile(self.root), NotFound()]
+
+    def test_compress_dynamic(self):
+        resp = self.request('/text/100', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual('gzip', resp.getheader('Content-Encoding'))
+        self.assertEqual(b'Hello ' * 100, gzip.decompress(resp.read()))
+        stats = self.compression.stats()
+        self.assertEqual(1, stats['compressed'])
+        self.assertEqual(600 - stats['bytes_out'], stats['bytes_saved'])
+
+    def test_content_length_of_compressed_body(self):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        for _ in range(2):
+            resp = self.request('/sized/100', headers={'Accept-Encoding': 'gzip'}, conn=conn)
+            data = resp.read()
+            self.assertEqual(len(data), int(resp.getheader('Content-Length')))
+            self.assertEqual(b'Hello ' * 100, gzip.decompress(data))
+
+    def test_skip_small_or_not_accepted(self):
+        resp = self.request('/text/2', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(resp.getheader('Content-Encoding'))
+        self.assertEqual(b'Hello Hello ', resp.read())
+        resp = self.request('/text/100', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertIsNone(resp.getheader('Content-Encoding'))
+        self.assertEqual(b'Hello ' * 100, resp.read())
+
+    def test_precompressed_sibling(self):
+        self.write_file('app.js', b'original')
+        self.write_file('app.js.gz', gzip.compress(b'precompressed'))
+        resp = self.request('/app.js', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', resp.getheader('Content-Encoding'))
+        self.assertEqual(mimetypes.guess_type('app.js')[0], resp.getheader('Content-Type'))
+        self.assertEqual(b'precompressed', gzip.decompress(resp.read()))
+        self.assertEqual(b'original', self.request('/app.js').read())
+
+    def test_accepts_encoding(self):
+        self.assertTrue(accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertTrue(accepts_encoding('*', 'gzip'))
+        self.assertFalse(accepts_encoding('gzip;q=0', 'gzip'))
+        self.assertFalse(accepts_encoding('*, gzip;q=0', 'gzip'))
+        self.assertFalse(accepts_encoding('br', 'gzip'))
+        self.assertFalse(accepts_encoding(None, 'gzip'))
+
+
+class DirListingTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        os.mkdir(os.path.join(self.root, 'files'))
+        for i in range(25):
+            self.write_file(f'files/f{i:02}.txt', b'x' * (25 - i))
+
+    def listed_names(self, query: str) -> list:
+        text = self.request(f'/files/{query}').read().decode()
+        return re.findall(r'<td>(f\d+\.txt)</td>', text)
+
+    def test_pagination(self):
+        self.assertEqual([f'f{i:02}.txt' for i in range(10)], self.listed_names('?limit=10'))
+        self.assertEqual([f'f{i:02}.txt' for i in range(20, 25)], self.listed_names('?offset=20&limit=10'))
+        self.assertEqual([], self.listed_names('?offset=100'))
+
+    def test_sorting(self):
+        self.assertEqual(['f24.txt', 'f23.txt'], self.listed_names('?sort=size&limit=2'))
+        self.assertEqual(['f00.txt', 'f01.txt'], self.listed_names('?sort=size&order=desc&limit=2'))
+        self.assertEqual(['f24.txt', 'f23.txt'], self.listed_names('?order=desc&limit=2'))
+
+    def test_listing_refreshed_when_directory_changed(self):
+        self.assertEqual(25, len(self.listed_names('')))
+        os.remove(os.path.join(self.root, 'files', 'f00.txt'))
+        self.assertEqual(24, len(self.listed_names('')))
+
+
+class MetricsTest(ServerTestCase):
+    def middlewares(self) -> list:
+        self.metrics = Metrics(enabled=True)
+        patcher = mock.patch(f'{RequestDispatcher.__module__}.metrics', self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        routing = Routing()
+        routing.add_route('/user/<name>', lambda req, resp, name: resp.html(f'Hello {name}'))
+        return [MetricsEndpoint(self.metrics), routing, NotFound()]
+
+    def test_metrics(self):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        for name in ['alice', 'bob']:
+            self.request(f'/user/{name}', conn=conn).read()
+        self.request('/missing', conn=conn).read()
+        text = self.request('/_metrics', conn=conn).read().decode()
+        self.assertIn('http_requests_total{route="/user/<name>",status="200"} 2', text)
+        self.assertIn('http_requests_total{route="<unrouted>",status="404"} 1', text)
+        self.assertIn('http_response_bytes_total{route="/user/<name>"} 20', text)
+        self.assertIn('http_request_duration_seconds{route="/user/<name>",quantile="0.99"}', text)
+        self.assertIn('http_middleware_duration_seconds_count{middleware="Routing"} 3', text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+    def test_disabled(self):
+        self.metrics.enabled = False
+        self.request('/user/alice').read()
+        self.assertEqual(404, self.request('/_metrics').status)
+        self.assertNotIn('alice', self.metrics.render())
+
+    def test_histogram_quantile(self):
+        hist = Histogram(buckets=(1, 2, 3))
+        for value in [0.5] * 50 + [1.5] * 40 + [2.5] * 10:
+            hist.observe(value)
+        self.assertAlmostEqual(1.0, hist.quantile(0.5))
+        self.assertAlmostEqual(2.0, hist.quantile(0.9))
+        self.assertAlmostEqual(2.9, hist.quantile(0.99))
+
+
+class RequestBodyTest(ServerTestCase):
+    def middlewares(self) -> list:
+        routing = Routing()
+
+        @routing.route('/echo')
+        def echo(req, resp):
+            resp.data(json.dumps({
+                'method': req.method, 'query': req.query, 'cookies': req.cookies,
+                'form': req.form, 'files': {k: [v.filename, v.read().decode()] for k, v in req.files.items()},
+            }).encode())
+
+        @routing.route('/json')
+        def echo_json(req, resp):
+            resp.data(json.dumps(req.json()).encode())
+
+        @routing.route('/upload')
+        def upload(req, resp):
+            body = req.body
+            body.seek(0, os.SEEK_END)
+            resp.data(str(body.tell()).encode())
+
+        @routing.route('/stream')
+        def stream(req, resp):
+            resp.data(str(sum(len(x) for x in req.stream())).encode())
+
+        routing.add_route('/ignore', lambda req, resp: resp.data(b'ignored'))
+        return [routing, NotFound()]
+
+    def echo(self, *args, **kwargs) -> dict:
+        resp = self.request(*args, **kwargs)
+        self.assertEqual(200, resp.status)
+        return json.loads(resp.read())
+
+    def test_query_and_cookies(self):
+        result = self.echo('/echo?a=1&b=x%20y', headers={'Cookie': 'sid=abc; theme="dark"'})
+        self.assertEqual({'a': '1', 'b': 'x y'}, result['query'])
+        self.assertEqual({'sid': 'abc', 'theme': 'dark'}, result['cookies'])
+
+    def test_urlencoded_form(self):
+        result = self.echo('/echo', 'POST', {'Content-Type': 'application/x-www-form-urlencoded'},
+                           'name=alice&note=a%26b')
+        self.assertEqual('POST', result['method'])
+        self.assertEqual({'name': 'alice', 'note': 'a&b'}, result['form'])
+
+    def test_multipart_form(self):
+        boundary = 'XyZ123'
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="title"\r\n\r\nhello\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="doc"; filename="a.txt"\r\n'
+                f'Content-Type: text/plain\r\n\r\n' + 'line\r\n' * 30000 + f'\r\n--{boundary}--\r\n')
+        result = self.echo('/echo', 'PUT', {'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                           body.encode())
+        self.assertEqual({'title': 'hello'}, result['form'])
+        self.assertEqual(['a.txt', 'line\r\n' * 30000], result['files']['doc'])
+
+    def test_json(self):
+        result = self.echo('/json', 'POST', {'Content-Type': 'application/json'}, '{"a": [1, 2]}')
+        self.assertEqual({'a': [1, 2]}, result)
+        resp = self.request('/json', 'POST', {'Content-Type': 'application/json'}, '{"a":')
+        self.assertEqual(400, resp.status)
+
+    def test_chunked_body(self):
+        chunks = (b'x' * 1000 for _ in range(100))
+        resp = self.request('/stream', 'POST', {'Transfer-Encoding': 'chunked'}, chunks)
+        self.assertEqual(b'100000', resp.read())
+
+    def test_large_upload_bounded_memory(self):
+        size = 256 * 1024 * 1024
+        path = self.write_file('upload.bin', size=size)
+        rss_before = peak_rss_mb()
+        with open(path, 'rb') as f:
+            resp = self.request('/upload', 'PUT', {'Content-Length': str(size)}, f)
+            self.assertEqual(str(size).encode(), resp.read())
+        self.assertLess(peak_rss_mb() - rss_before, 64)
+
+    def test_unread_body_keeps_connection(self):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        self.assertEqual(b'ignored', self.request('/ignore', 'POST', body=b'x' * 10000, conn=conn).read())
+        self.assertEqual(b'ignored', self.request('/ignore', 'POST', body=b'y' * 10, conn=conn).read())
+
+
+class StreamingTest(ServerTestCase):
+    def middlewares(self) -> list:
+        self.resume = threading.Event()
+        self.started = threading.Event()
+        self.closed = threading.Event()
+        routing = Routing()
+
+        @routing.route('/report')
+        def report(req, resp):
+            self.started.set()
+            try:
+                yield 'first\n'
+                self.resume.wait(10)
+                for i in range(1000):
+                    yield f'row {i}\n'
+            finally:
+                self.closed.set()
+
+        @routing.route('/events')
+        def events(req, resp):
+            resp.events(['hello', None, {'data': 'a\nb', 'event': 'update', 'id': 7}])
+
+        @routing.route('/broken')
+        def broken(req, resp):
+            yield b'partial'
+            raise RuntimeError('failed')
+
+        return [Compression(min_size=0), routing, NotFound()]
+
+    def test_first_chunk_sent_before_generator_finished(self):
+        resp = self.request('/report', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('chunked', resp.getheader('Transfer-Encoding'))
+        self.assertIsNone(resp.getheader('Content-Encoding'))
+        self.assertEqual(b'first\n', resp.read(6))
+        self.resume.set()
+        self.assertEqual(''.join(f'row {i}\n' for i in range(1000)).encode(), resp.read())
+        self.assertTrue(self.closed.wait(5))
+
+    def test_keep_alive_after_stream(self):
+        self.resume.set()
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        for _ in range(2):
+            resp = self.request('/report', conn=conn)
+            self.assertEqual('keep-alive', resp.getheader('Connection'))
+            self.assertTrue(resp.read().endswith(b'row 999\n'))
+
+    def test_head_does_not_run_generator(self):
+        resp = self.request('/report', 'HEAD')
+        self.assertEqual(b'', resp.read())
+        self.assertFalse(self.started.is_set())
+
+    def test_http10_without_chunked(self):
+        self.resume.set()
+        with socket.create_connection(self.server.server_address, timeout=30) as sock:
+            sock.sendall(b'GET /report HTTP/1.0\r\n\r\n')
+            data = b''.join(iter(lambda: sock.recv(65536), b''))
+        head, _, body = data.partition(b'\r\n\r\n')
+        self.assertNotIn(b'chunked', head)
+        self.assertIn(b'Connection: close', head)
+        self.assertTrue(body.startswith(b'first\nrow 0\n'))
+
+    def test_server_sent_events(self):
+        resp = self.request('/events')
+        self.assertEqual('text/event-stream; charset=utf-8', resp.getheader('Content-Type'))
+        self.assertEqual('no-cache', resp.getheader('Cache-Control'))
+        self.assertEqual(b'data: hello\n\n:\n\nevent: update\nid: 7\ndata: a\ndata: b\n\n', resp.read())
+
+    def test_error_while_streaming_closes_connection(self):
+        resp = self.request('/broken')
+        self.assertEqual(200, resp.status)
+        with self.assertRaises(http.client.IncompleteRead) as cm:
+            resp.read()
+        self.assertEqual(b'partial', cm.exception.partial)
+
+
+class KeepAliveTest(ServerTestCase):
+    def middlewares(self) -> list:
+        routing = Routing()
+        routing.add_route('/echo', lambda req, resp: resp.html(f'{req.target} {req.header("Content-Length")}'))
+        return [routing, NotFound()]
+
+    def raw_request(self, data: bytes) -> bytes:
+        """Send data on a new socket, return all received until server closes connection."""
+        with socket.create_connection(self.server.server_address, timeout=5) as sock:
+            sock.sendall(data)
+            return b''.join(iter(lambda: sock.recv(65536), b''))
+
+    def test_pipelining(self):
+        response = self.raw_request(b'GET /echo?n=1 HTTP/1.1\r\n\r\n'
+                                    b'POST /echo?n=2 HTTP/1.1\r\nContent-Length: 2\r\n\r\nab'
+                                    b'GET /echo?n=3 HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual(3, response.count(b'HTTP/1.1 200'))
+        self.assertLess(response.index(b'/echo?n=1 None'), response.index(b'/echo?n=2 2'))
+        self.assertLess(response.index(b'/echo?n=2 2'), response.index(b'/echo?n=3 None'))
+
+    def test_max_requests(self):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        with mock.patch.object(RequestDispatcher, 'max_requests', 3):
+            for i in range(3):
+                resp = self.request('/echo', conn=conn)
+                resp.read()
+                self.assertEqual('close' if i == 2 else 'keep-alive', resp.getheader('Connection'))
+
+    def test_undrained_body_closes_connection(self):
+        with mock.patch.object(RequestDispatcher, 'keep_alive_timeout', 30), \
+                mock.patch.object(RequestDispatcher, 'max_discard_size', 10), \
+                socket.create_connection(self.server.server_address, timeout=5) as sock:
+            sock.sendall(b'POST /echo HTTP/1.1\r\nContent-Length: 10000000\r\n\r\n' + b'x' * 1000000)
+            response = b''
+            try:
+                for data in iter(lambda: sock.recv(65536), b''):
+                    response += data
+            except ConnectionResetError:
+                pass
+        self.assertIn(b'/echo 10000000', response)
+
+    def test_idle_timeout(self):
+        with mock.patch.object(RequestDispatcher, 'keep_alive_timeout', 0.2):
+            start = time.monotonic()
+            response = self.raw_request(b'GET /echo HTTP/1.1\r\n\r\n')
+        self.assertIn(b'Connection: keep-alive', response)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_idle_connections_do_not_starve_workers(self):
+        server = self.start_server(self.app, workers=2)
+        with mock.patch.object(RequestDispatcher, 'keep_alive_timeout', 30):
+            for _ in range(2):
+                conn = http.client.HTTPConnection(*server.server_address, timeout=30)
+                self.addCleanup(conn.close)
+                conn.request('GET', '/echo')
+                self.assertEqual('keep-alive', conn.getresponse().getheader('Connection'))
+            start = time.monotonic()
+            conn = http.client.HTTPConnection(*server.server_address, timeout=30)
+            self.addCleanup(conn.close)
+            conn.request('GET', '/echo')
+            self.assertEqual(200, conn.getresponse().status)
+            self.assertLess(time.monotonic() - start, 2)
+
+
+class ApplicationTest(ServerTestCase):
+    def middlewares(self) -> list:
+        routing = Routing()
+        routing.add_route('/hello', lambda req, resp: resp.html(f'Hello {req.query_string("name")}'))
+        return [routing, NotFound()]
+
+    def test_hooks(self):
+        @self.app.before_request
+        def require_token(ctx):
+            if ctx.request.path.startswith('/hello') and ctx.request.header('X-Token') != 'secret':
+                ctx.response.status(403).html('Forbidden')
+                return True
+            return False
+
+        @self.app.after_request
+        def add_header(ctx):
+            ctx.response.header('X-Status', str(ctx.response.get_status()))
+
+        resp = self.request('/hello?name=alice')
+        self.assertEqual((403, '403', b'Forbidden'), (resp.status, resp.getheader('X-Status'), resp.read()))
+        resp = self.request('/hello?name=alice', headers={'X-Token': 'secret'})
+        self.assertEqual((200, '200', b'Hello alice'), (resp.status, resp.getheader('X-Status'), resp.read()))
+        resp = self.request('/missing')
+        self.assertEqual((404, '404'), (resp.status, resp.getheader('X-Status')))
+
+    def test_context_reused(self):
+        contexts = set()
+        self.app.before_request(lambda ctx: contexts.add(id(ctx)))
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        for name in ['alice', 'bob', 'carol']:
+            resp = self.request(f'/hello?name={name}', conn=conn)
+            self.assertEqual(f'Hello {name}'.encode(), resp.read())
+            self.assertIsNone(resp.getheader('X-Status'))
+        self.assertEqual(1, len(contexts))
+
+
+class ResponseCacheTest(ServerTestCase):
+    def middlewares(self) -> list:
+        self.calls = collections.Counter()
+        self.delay = 0
+        routing = Routing()
+        page_cache = ResponseCache(ttl=60, query=['page'])
+
+        def render(req, resp, name):
+            self.calls[name] += 1
+            time.sleep(self.delay)
+            resp.html(f'{name} {self.calls[name]} {req.query_string("page")} {req.header("Accept-Language")}')
+
+        routing.add_route('/report/<name>', render)
+        routing.add_route('/page/<name>', page_cache.cached(render))
+        routing.add_route('/private/<name>', lambda req, resp, name: render(req, resp.header('Set-Cookie', 'a=1'), name))
+        self.cache = ResponseCache(ttl=0.3, stale=5, query=['page'], headers=['Accept-Language'],
+                                   prefixes=['/report', '/private'])
+        return [Compression(min_size=0), self.cache, routing, NotFound()]
+
+    def get(self, path: str, headers: dict = None) -> bytes:
+        resp = self.request(path, headers=headers)
+        self.assertEqual(200, resp.status)
+        return resp.read()
+
+    def test_key(self):
+        self.assertEqual(b'a 1 1 None', self.get('/report/a?page=1&other=x'))
+        self.assertEqual(b'a 1 1 None', self.get('/report/a?other=y&page=1'))
+        self.assertEqual(b'a 2 2 None', self.get('/report/a?page=2'))
+        self.assertEqual(b'a 3 1 fr', self.get('/report/a?page=1', {'Accept-Language': 'fr'}))
+        self.assertEqual(b'a 1 1 None', self.get('/report/a?page=1'))
+        self.assertEqual(3, self.calls['a'])
+
+    def test_not_cached(self):
+        self.get('/private/a')
+        self.get('/private/a')
+        self.assertEqual(2, self.calls['a'])
+        self.request('/report/b', 'POST').read()
+        self.get('/report/b')
+        self.assertEqual(2, self.calls['b'])
+
+    def test_compressed_after_cached(self):
+        name = 'a' * 300
+        self.get(f'/report/{name}')
+        resp = self.request(f'/report/{name}', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', resp.getheader('Content-Encoding'))
+        self.assertEqual(f'{name} 1 None None'.encode(), gzip.decompress(resp.read()))
+        self.assertEqual(f'{name} 1 None None'.encode(), self.get(f'/report/{name}'))
+
+    def test_single_flight(self):
+        self.delay = 0.3
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.get('/report/a'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([b'a 1 None None'] * 5, results)
+        self.assertEqual(1, self.calls['a'])
+
+    def test_stale_while_revalidate(self):
+        self.get('/report/a')
+        time.sleep(0.4)
+        self.delay = 0.5
+        leader = threading.Thread(target=lambda: self.assertEqual(b'a 2 None None', self.get('/report/a')))
+        leader.start()
+        time.sleep(0.1)
+        start = time.monotonic()
+        resp = self.request('/report/a')
+        self.assertEqual(b'a 1 None None', resp.read())
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertIsNotNone(resp.getheader('Age'))
+        leader.join()
+        self.assertEqual(b'a 2 None None', self.get('/report/a'))
+
+    def test_decorator(self):
+        self.assertEqual(b'a 1 1 None', self.get('/page/a?page=1'))
+        self.assertEqual(b'a 1 1 None', self.get('/page/a?page=1', {'Accept-Language': 'fr'}))
+        self.assertEqual(b'a 2 2 None', self.get('/page/a?page=2'))
+
+    def test_store_lru(self):
+        store = ResponseStore(max_entries=2)
+        for key in 'abc':
+            self.assertEqual((None, True), store.begin(key))
+            store.put(key, CachedResponse(200, {}, key.encode(), None, 60, 0))
+            store.end(key)
+        self.assertEqual(2, len(store))
+        self.assertEqual((None, True), store.begin('a'))
+        self.assertEqual(b'c', store.begin('c')[0].data)
+
+
+class ProxyTest(ServerTestCase):
+    def middlewares(self) -> list:
+        self.backend_event = threading.Event()
+        self.backends = [self.start_server(Application([self.backend_routing(name)], GenericError()))
+                         for name in ['b0', 'b1']]
+        self.upstreams = [Upstream(*x.server_address, max_connections=4) for x in self.backends]
+        self.group = UpstreamGroup(self.upstreams, health_path='/health', health_interval=0.1)
+        self.addCleanup(self.group.close)
+        return [Proxy('/api', self.group, strip_prefix=True), NotFound()]
+
+    def backend_routing(self, name: str) -> Routing:
+        routing = Routing()
+
+        @routing.route('/health')
+        def health(req, resp):
+            resp.data(b'ok')
+
+        @routing.route('/name')
+        def backend_name(req, resp):
+            resp.header('Connection', 'keep-alive').header('X-Backend', name)
+            resp.data(f'{name} {req.target} {req.header("X-Forwarded-For")} {req.header("Host")}'.encode())
+
+        @routing.route('/upload')
+        def upload(req, resp):
+            resp.data(f'{name} {req.method} {sum(len(x) for x in req.stream())}'.encode())
+
+        @routing.route('/stream')
+        def stream(req, resp):
+            yield b'first'
+            self.backend_event.wait(10)
+            yield b'last'
+
+        return routing
+
+    def test_forward(self):
+        resp = self.request('/api/name?x=1', headers={'Host': 'example.com', 'X-Forwarded-For': '10.0.0.1'})
+        self.assertEqual(200, resp.status)
+        name = resp.getheader('X-Backend')
+        self.assertEqual(1, len(resp.headers.get_all('Server')))
+        self.assertEqual(f'{name} /name?x=1 10.0.0.1, 127.0.0.1 example.com'.encode(), resp.read())
+        self.assertEqual(404, self.request('/apix/name').status)
+
+    def test_round_robin_and_reuse(self):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        names = []
+        for _ in range(6):
+            resp = self.request('/api/name', conn=conn)
+            resp.read()
+            names.append(resp.getheader('X-Backend'))
+        self.assertEqual(['b0', 'b1'] * 3 if names[0] == 'b0' else ['b1', 'b0'] * 3, names)
+        for upstream in self.upstreams:
+            self.assertEqual(1, upstream.stats()['created'])
+            self.assertEqual(2, upstream.stats()['reused'])
+
+    def test_least_connections(self):
+        group = UpstreamGroup(self.upstreams, balance='least_connections')
+        conn, _ = self.upstreams[0].acquire()
+        self.addCleanup(self.upstreams[0].release, conn, False)
+        self.assertIs(self.upstreams[1], group.choose())
+        self.assertIs(self.upstreams[1], group.choose())
+
+    def test_idle_timeout(self):
+        upstream = Upstream(*self.backends[0].server_address, idle_timeout=0.1)
+        self.addCleanup(upstream.close)
+        for _ in range(2):
+            conn, reused = upstream.acquire()
+            self.assertFalse(reused)
+            conn.request('GET', '/health')
+            conn.getresponse().read()
+            upstream.release(conn, True)
+            time.sleep(0.2)
+        self.assertEqual({'created': 2, 'reused': 0, 'failed': 0, 'open': 1, 'active': 0, 'idle': 1},
+                         upstream.stats())
+
+    def test_max_connections(self):
+        upstream = Upstream(*self.backends[0].server_address, max_connections=1)
+        self.addCleanup(upstream.close)
+        conn, _ = upstream.acquire()
+        conn.connect()
+        with self.assertRaises(TimeoutError):
+            upstream.acquire(timeout=0.1)
+        threading.Timer(0.1, upstream.release, (conn, True)).start()
+        self.assertIs(conn, upstream.acquire(timeout=5)[0])
+
+    def test_streaming_upload(self):
+        chunks = (b'x' * 65536 for _ in range(100))
+        resp = self.request('/api/upload', 'POST', {'Transfer-Encoding': 'chunked'}, chunks)
+        self.assertTrue(resp.read().endswith(b' POST 6553600'))
+        resp = self.request('/api/upload', 'PUT', body=b'y' * 1000)
+        self.assertTrue(resp.read().endswith(b' PUT 1000'))
+
+    def test_body_to_plain_http_server(self):
+        class PlainHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        backend = ThreadingHTTPServer(('127.0.0.1', 0), PlainHandler)
+        threading.Thread(target=backend.serve_forever, daemon=True).start()
+        self.addCleanup(backend.server_close)
+        self.addCleanup(backend.shutdown)
+        group = UpstreamGroup([Upstream(*backend.server_address)])
+        self.addCleanup(group.close)
+        self.server = self.start_server(Application([Proxy('/api', group), NotFound()], GenericError()))
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        self.addCleanup(conn.close)
+        for body in [b'hello', b'x' * 200000]:
+            resp = self.request('/api/x', 'POST', body=body, conn=conn)
+            self.assertEqual(200, resp.status)
+            self.assertEqual(body, resp.read())
+
+    def test_streaming_download(self):
+        resp = self.request('/api/stream')
+        self.assertEqual(b'first', resp.read(5))
+        self.backend_event.set()
+        self.assertEqual(b'last', resp.read())
+
+    def test_failover_and_health_check(self):
+        self.backends[1].shutdown()
+        self.backends[1].server_close()
+        names = {self.request('/api/name').getheader('X-Backend') for _ in range(4)}
+        self.assertEqual({'b0'}, names)
+        self.assertFalse(self.upstreams[1].healthy)
+        self.group.start_health_checks()
+        time.sleep(0.3)
+        self.assertTrue(self.upstreams[0].healthy)
+        self.assertFalse(self.upstreams[1].healthy)
+
+    def test_no_upstream(self):
+        for upstream in self.upstreams:
+            upstream.healthy = False
+        self.assertEqual(503, self.request('/api/name').status)
+
+
+class LimitsTest(ServerTestCase):
+    def middlewares(self) -> list:
+        self.metrics = Metrics(enabled=True)
+        patcher = mock.patch(f'{RequestDispatcher.__module__}.metrics', self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        routing = Routing()
+
+        @routing.route('/slow')
+        def slow(req, resp):
+            time.sleep(0.1)
+            resp.data(b'done')
+
+        @routing.route('/error')
+        def error(req, resp):
+            raise RuntimeError('failed')
+
+        self.rate_limit = RateLimit(rate=1, burst=2, key=lambda req: req.header('X-Client'))
+        self.shedding = LoadShedding(max_concurrent=2, target=0.05, interval=0.1, max_wait=0.5)
+        return [self.rate_limit, self.shedding, routing, NotFound()]
+
+    def test_rate_limit(self):
+        statuses = [self.request('/missing', headers={'X-Client': 'a'}).status for _ in range(3)]
+        self.assertEqual([404, 404, 429], statuses)
+        resp = self.request('/missing', headers={'X-Client': 'a'})
+        self.assertEqual((429, '1'), (resp.status, resp.getheader('Retry-After')))
+        self.assertEqual(404, self.request('/missing', headers={'X-Client': 'b'}).status)
+        self.assertEqual({'rejected': 2}, self.rate_limit.stats())
+        self.assertIn('http_requests_rejected_total{reason="rate_limit"} 2', self.metrics.render())
+
+    def test_token_bucket_refill(self):
+        limiter = RateLimiter(rate=10, burst=1)
+        self.assertEqual(0, limiter.acquire('a'))
+        self.assertAlmostEqual(0.1, limiter.acquire('a'), delta=0.02)
+        time.sleep(0.1)
+        self.assertEqual(0, limiter.acquire('a'))
+
+    def test_slot_released_after_error(self):
+        for i in range(3):
+            self.assertEqual(500, self.request('/error', headers={'X-Client': f'e{i}'}).status)
+        start = time.monotonic()
+        self.assertEqual(b'done', self.request('/slow').read())
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_overload(self):
+        results = []
+
+        def client():
+            conn = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+            self.addCleanup(conn.close)
+            conn.connect()
+            start = time.monotonic()
+            resp = self.request('/slow', headers={'X-Client': str(threading.get_ident()), 'Connection': 'close'},
+                                conn=conn)
+            resp.read()
+            results.append((resp.status, resp.getheader('Retry-After'), time.monotonic() - start))
+
+        threads = [threading.Thread(target=client) for _ in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        shed = [x for x in results if x[0] == 503]
+        served = [x for x in results if x[0] == 200]
+        self.assertEqual(40, len(shed) + len(served))
+        self.assertGreater(len(shed), 0)
+        self.assertGreater(len(served), 2)
+        self.assertTrue(all(x[1] == '1' for x in shed))
+        self.assertLess(max(x[2] for x in served), 1.2)
+        self.assertEqual(len(shed), self.shedding.stats()['rejected'])
+        self.assertIn(f'http_requests_rejected_total{{reason="overload"}} {len(shed)}', self.metrics.render())
+
+    def test_codel_dropping(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, target=0.02, interval=0.05, max_wait=1)
+        self.assertTrue(limiter.acquire())
+        threading.Timer(0.2, limiter.release).start()
+        start = time.monotonic()
+        self.assertTrue(limiter.acquire())
+        self.assertGreater(time.monotonic() - start, 0.15)
+        self.assertFalse(limiter.dropping)
+        for _ in range(3):
+            self.assertFalse(limiter.acquire())
+            time.sleep(0.03)
+        self.assertTrue(limiter.dropping)
+        start = time.monotonic()
+        self.assertFalse(limiter.acquire())
+        self.assertLess(time.monotonic() - start, 0.05)
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.dropping)
+
+    def test_async_limiter(self):
+        async def run():
+            limiter = AsyncConcurrencyLimiter(max_concurrent=1, max_wait=0.1)
+            self.assertTrue(await limiter.acquire())
+            start = time.monotonic()
+            self.assertFalse(await limiter.acquire())
+            self.assertGreater(time.monotonic() - start, 0.09)
+            asyncio.get_running_loop().call_later(0.05, limiter.release)
+            self.assertTrue(await limiter.acquire())
+        asyncio.run(run())
+
+
+class AsyncServerTest(unittest.TestCase):
+    """Run asyncio server in a background thread, and talk to it over real sockets."""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.routing = Routing()
+
+        @self.routing.route('/echo')
+        def echo(req, resp):
+            body = req.body.read()
+            resp.data(f'{req.method} {req.target} {req.header("X-Test")} {len(body)}'.encode())
+
+        self.app = Application([self.routing, StaticFile(self.root), NotFound()], GenericError())
+        self.server = AsyncHttpServer(self.app, max_requests=3)
+        self.start_server(self.server)
+
+    def start_server(self, server: AsyncHttpServer):
+        loop = asyncio.new_event_loop()
+        listener = loop.run_until_complete(server.start(('127.0.0.1', 0)))
+        self.address = listener.sockets[0].getsockname()[:2]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        self.loop_thread = thread
+
+        async def shutdown():
+            listener.close()
+            tasks = [x for x in asyncio.all_tasks() if x is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(10)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.addCleanup(stop)
+
+    def connect(self) -> http.client.HTTPConnection:
+        conn = http.client.HTTPConnection(*self.address, timeout=30)
+        self.addCleanup(conn.close)
+        return conn
+
+    def raw_request(self, data: bytes) -> bytes:
+        """Send data on a new socket, return all received until server closes connection."""
+        with socket.create_connection(self.address, timeout=30) as sock:
+            sock.sendall(data)
+            received = b''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return received
+                received += chunk
+
+    def test_request_line_and_headers(self):
+        conn = self.connect()
+        conn.request('GET', '/echo?x=1', headers={'X-Test': 'value'})
+        resp = conn.getresponse()
+        self.assertEqual(200, resp.status)
+        self.assertEqual(b'GET /echo?x=1 value 0', resp.read())
+        response = self.raw_request(b'GET /missing HTTP/1.0\r\nX-Test:  folded\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 404 '), response[:100])
+
+    def test_chunked_request_body(self):
+        conn = self.connect()
+        conn.request('POST', '/echo', body=(b'x' * 1000 for _ in range(100)), encode_chunked=True)
+        self.assertEqual(b'POST /echo None 100000', conn.getresponse().read())
+        conn.request('POST', '/echo', body=b'abc')
+        self.assertEqual(b'POST /echo None 3', conn.getresponse().read())
+
+    def test_keep_alive_and_max_requests(self):
+        conn = self.connect()
+        for i in range(3):
+            conn.request('GET', '/echo')
+            resp = conn.getresponse()
+            resp.read()
+            self.assertEqual('close' if i == 2 else 'keep-alive', resp.getheader('Connection'))
+        response = self.raw_request(b'GET /echo HTTP/1.0\r\n\r\n')
+        self.assertIn(b'Connection: close', response)
+
+    def test_pipelining(self):
+        response = self.raw_request(b'GET /echo?n=1 HTTP/1.1\r\n\r\n'
+                                    b'POST /echo?n=2 HTTP/1.1\r\nContent-Length: 2\r\n\r\nab'
+                                    b'GET /echo?n=3 HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual(3, response.count(b'HTTP/1.1 200'))
+        self.assertLess(response.index(b'GET /echo?n=1 None 0'), response.index(b'POST /echo?n=2 None 2'))
+        self.assertLess(response.index(b'POST /echo?n=2 None 2'), response.index(b'GET /echo?n=3 None 0'))
+
+    def test_sendfile_and_head(self):
+        data = os.urandom(200000)
+        with open(os.path.join(self.root, 'data.bin'), 'wb') as f:
+            f.write(data)
+        conn = self.connect()
+        conn.request('GET', '/data.bin')
+        self.assertEqual(data, conn.getresponse().read())
+        conn.request('HEAD', '/data.bin')
+        resp = conn.getresponse()
+        self.assertEqual('200000', resp.getheader('Content-Length'))
+        self.assertEqual(b'', resp.read())
+        conn.request('GET', '/echo')
+        self.assertEqual(b'GET /echo None 0', conn.getresponse().read())
+
+    def test_application_hooks_and_context_pool(self):
+        contexts = set()
+
+        @self.app.before_request
+        def require_token(ctx):
+            contexts.add(id(ctx))
+            if ctx.request.header('X-Token') != 'secret':
+                ctx.response.status(403).html('Forbidden')
+                return True
+            return False
+
+        @self.app.after_request
+        def add_header(ctx):
+            ctx.response.header('X-Status', str(ctx.response.get_status()))
+
+        conn = self.connect()
+        conn.request('GET', '/echo')
+        resp = conn.getresponse()
+        self.assertEqual((403, '403', b'Forbidden'), (resp.status, resp.getheader('X-Status'), resp.read()))
+        conn.request('GET', '/echo', headers={'X-Token': 'secret'})
+        resp = conn.getresponse()
+        self.assertEqual((200, '200', b'GET /echo None 0'), (resp.status, resp.getheader('X-Status'), resp.read()))
+        self.assertEqual(1, len(contexts))
+
+    def test_after_send_and_metrics_follow_body(self):
+        m = Metrics(enabled=True)
+        for name in (RequestDispatcher.__module__, AsyncHttpServer.__module__):
+            patcher = mock.patch(f'{name}.metrics', m)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        events = []
+        finished = threading.Event()
+
+        def chunks():
+            for _ in range(10):
+                yield b'x' * 1000
+            events.append('body')
+
+        def after_send(resp):
+            events.append('after_send')
+            finished.set()
+
+        @self.app.before_request
+        def register(ctx):
+            ctx.response.after_send(after_send)
+            return False
+
+        self.routing.add_route('/stream', lambda req, resp: resp.stream(chunks()))
+        conn = self.connect()
+        conn.request('GET', '/stream')
+        self.assertEqual(10000, len(conn.getresponse().read()))
+        self.assertTrue(finished.wait(10))
+        self.assertEqual(['body', 'after_send'], events)
+        self.assertIn('http_response_bytes_total{route="/stream"} 10000', m.render())
+
+    def test_blocking_work_runs_in_executor(self):
+        threads = {}
+
+        class Probe(Middleware):
+            def __init__(self, key: str, blocking: bool):
+                self.key = key
+                self.blocking = blocking
+
+            def handle(self, ctx):
+                threads[self.key] = threading.current_thread()
+                if self.blocking:
+                    ctx.response.before_send(lambda resp: threads.setdefault('send', threading.current_thread()))
+                return False
+
+        self.app.middlewares[:0] = [Probe('inline', False), Probe('blocking', True)]
+        conn = self.connect()
+        conn.request('GET', '/echo')
+        self.assertEqual(b'GET /echo None 0', conn.getresponse().read())
+        self.assertIs(self.loop_thread, threads['inline'])
+        self.assertIsNot(self.loop_thread, threads['blocking'])
+        self.assertIsNot(self.loop_thread, threads['send'])
+
+    def test_load_shedding_does_not_block_loop(self):
+        shedding = AsyncLoadShedding(1, max_wait=5)
+        self.app.middlewares.insert(0, shedding)
+
+        @self.routing.route('/slow')
+        def slow(req, resp):
+            yield b'first'
+            time.sleep(0.5)
+            yield b'last'
+
+        durations = []
+
+        def client():
+            start = time.monotonic()
+            conn = self.connect()
+            conn.request('GET', '/slow')
+            self.assertEqual(b'firstlast', conn.getresponse().read())
+            durations.append(time.monotonic() - start)
+
+        threads = [threading.Thread(target=client) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        durations.sort()
+        self.assertEqual(2, len(durations))
+        self.assertLess(durations[0], 0.9)
+        self.assertGreater(durations[1], 0.9)
+        self.assertEqual(0, shedding.stats()['rejected'])
+        with self.assertRaises(TypeError):
+            as_async(LoadShedding(1))
+
+    def test_bad_requests(self):
+        for data, status in [(b'GARBAGE\r\n\r\n', 400),
+                             (b'GET / FTP/1.0\r\n\r\n', 400),
+                             (b'POST /echo HTTP/1.1\r\nContent-Length: x\r\n\r\n', 400),
+                             (b'POST /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n', 400),
+                             (b'GET / HTTP/1.1\r\nX-Long: ' + b'x' * 100000 + b'\r\n\r\n', 431)]:
+            with self.subTest(status=status, data=data[:30]):
+                response = self.raw_request(data)
+                self.assertTrue(response.startswith(f'HTTP/1.1 {status} '.encode()), response[:100])
+                self.assertIn(b'Connection: close', response)
+
+
+class ServersTest(unittest.TestCase):
+    def test_listen_backlog(self):
+        for kwargs, expected in [({}, 1024), ({'queue_size': 4096}, 4096), ({'backlog': 64, 'queue_size': 16}, 64)]:
+            with mock.patch('socket.socket.listen') as listen:
+                server = ThreadPoolHTTPServer(('127.0.0.1', 0), RequestDispatcher, workers=1, **kwargs)
+                server.server_close()
+            listen.assert_called_once_with(expected)
+
+
+class FileCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = FileCache(max_entries=2)
+            paths = []
+            for name in ['a', 'b', 'c']:
+                path = os.path.join(root, name)
+                with open(path, 'wb') as f:
+                    f.write(name.encode())
+                paths.append(path)
+            for path in paths:
+                cache.get(path, os.stat(path))
+            self.assertEqual(2, len(cache))
+            self.assertEqual(b'c', cache.get(paths[2], os.stat(paths[2])).data)
+
+    def test_large_file_not_cached(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'0' * 100)
+            f.flush()
+            cache = FileCache(max_file_size=10)
+            self.assertIsNone(cache.get(f.name, os.stat(f.name)))
+            self.assertEqual(0, len(cache))
+
+
+def main():
+    unittest.main(__name__)
+
+
+if __name__ == '__main__':
+    main()
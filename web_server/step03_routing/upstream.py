@@ -0,0 +1,153 @@
+import collections
+import http.client
+import logging
+import threading
+import time
+import typing
+
+
+class Upstream:
+    """
+    Backend server with a pool of persistent connections.
+    At most max_connections are open at a time, callers wait for one to be released.
+    Idle connections are reused most recent first, and closed once idle for idle_timeout seconds.
+    """
+    def __init__(self, host: str, port: int, max_connections: int = 16, idle_timeout: float = 30,
+                 timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._idle = collections.deque()
+        self._open = 0
+        self._active = 0
+        self._cond = threading.Condition()
+        self._counters = dict.fromkeys(['created', 'reused', 'failed'], 0)
+
+    def __repr__(self):
+        return f'Upstream({self.host}:{self.port})'
+
+    @property
+    def active(self) -> int:
+        """Count of connections in use, for least-connections balancing."""
+        return self._active
+
+    def acquire(self, timeout: float = None) -> (http.client.HTTPConnection, bool):
+        """Return (connection, reused), raise TimeoutError if no connection is available in timeout."""
+        deadline = time.monotonic() + (self._timeout if timeout is None else timeout)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._idle and now - self._idle[0][1] > self._idle_timeout:
+                    self._close(self._idle.popleft()[0])
+                if self._idle:
+                    self._active += 1
+                    self._counters['reused'] += 1
+                    return self._idle.pop()[0], True
+                if self._open < self._max_connections:
+                    self._open += 1
+                    self._active += 1
+                    self._counters['created'] += 1
+                    break
+                if not self._cond.wait(deadline - now) and time.monotonic() >= deadline:
+                    raise TimeoutError(f'No connection available to {self!r}')
+        return http.client.HTTPConnection(self.host, self.port, timeout=self._timeout), False
+
+    def release(self, conn: http.client.HTTPConnection, reusable: bool):
+        """Return connection to pool, or close it if it can not be reused."""
+        with self._cond:
+            self._active -= 1
+            if reusable and conn.sock is not None:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._close(conn)
+            self._cond.notify()
+
+    def _close(self, conn: http.client.HTTPConnection):
+        conn.close()
+        self._open -= 1
+
+    def mark_failed(self):
+        with self._cond:
+            self.healthy = False
+            self._counters['failed'] += 1
+        self.close()
+
+    def check_health(self, path: str) -> bool:
+        """Request path on a new connection, upstream is healthy if it responds without server error."""
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self._timeout)
+        try:
+            conn.request('GET', path)
+            healthy = conn.getresponse().status < 500
+        except (OSError, http.client.HTTPException):
+            healthy = False
+        finally:
+            conn.close()
+        if self.healthy != healthy:
+            logging.getLogger('server').warning(f'{self!r} is {"up" if healthy else "down"}')
+        self.healthy = healthy
+        return healthy
+
+    def close(self):
+        """Close idle connections, connections in use are closed when released."""
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.popleft()[0])
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self._counters, open=self._open, active=self._active, idle=len(self._idle))
+
+
+class UpstreamGroup:
+    """
+    Upstreams serving the same content, balanced by 'round_robin' or 'least_connections'.
+    Upstream which failed is skipped, until a health check finds it up again.
+    """
+    BALANCES = ('round_robin', 'least_connections')
+
+    def __init__(self, upstreams: typing.List[Upstream], balance: str = 'round_robin',
+                 health_path: str = '/', health_interval: float = 5):
+        if balance not in self.BALANCES:
+            raise ValueError(f'Unknown balance {balance}, must be one of {self.BALANCES}')
+        self.upstreams = list(upstreams)
+        self._balance = balance
+        self._health_path = health_path
+        self._health_interval = health_interval
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def choose(self, exclude: typing.Collection[Upstream] = ()) -> Upstream:
+        """Return a healthy upstream not in exclude, or None if there is none."""
+        candidates = [x for x in self.upstreams if x.healthy and x not in exclude]
+        if not candidates:
+            return None
+        if self._balance == 'least_connections':
+            return min(candidates, key=lambda x: x.active)
+        with self._lock:
+            self._next += 1
+            return candidates[self._next % len(candidates)]
+
+    def start_health_checks(self):
+        """Check health of each upstream periodically, in a daemon thread."""
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=self._check_loop, daemon=True)
+            self._health_thread.start()
+
+    def close(self):
+        """Stop health checks and close idle connections of all upstreams."""
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+            self._health_thread = None
+        for upstream in self.upstreams:
+            upstream.close()
+
+    def _check_loop(self):
+        while not self._stop.wait(self._health_interval):
+            for upstream in self.upstreams:
+                upstream.check_health(self._health_path)